@@ -1,22 +1,28 @@
+from bisect import bisect_right
 import errno
 import logging
 import os
+import signal
 from threading import Thread, RLock
 from thread import get_ident
 import sys
-from time import sleep
+from time import sleep, time
+import uuid
 
 from circus import zmq
 from zmq.eventloop import ioloop
+from zmq.utils.jsonapi import jsonmod as json
 
 from circus.controller import Controller
 from circus.exc import AlreadyExist
 from circus import logger
 from circus.watcher import Watcher
-from circus.util import debuglog, _setproctitle
+from circus.util import (debuglog, _setproctitle, set_child_subreaper,
+                         get_process_tree, reset_process_tree)
 from circus.config import get_config
 from circus.plugins import get_plugin_cmd
 from circus.sockets import CircusSocket, CircusSockets
+from circus.spawner import Spawner
 
 import select
 
@@ -53,23 +59,44 @@ class Arbiter(object):
     - **debug** -- if True, adds a lot of debug info in the stdout (default:
       False)
     - **proc_name** -- the arbiter process name
+    - **parallel_stop** -- if True, the watchers that have the same
+      priority are stopped at the same time, so stopping all the watchers
+      only takes as long as the slowest watcher of each priority.
+      (default: False)
+    - **stall_timeout** -- if set, a thread watches the loop, and when it
+      doesn't run the callbacks for more than *stall_timeout* seconds the
+      stack of the loop is logged and a *circus.stall* event published.
+      (default: 0, disabled)
+    - **use_spawner** -- if True, the processes are spawned by a small
+      process started with circusd, instead of forking circusd. Needs
+      Linux 3.4 or later. (default: False)
     """
 
     restart_after_stop = False
+
+    # number of finished jobs remembered for the jobstatus command
+    max_finished_jobs = 100
+
     def __init__(self, watchers, endpoint, pubsub_endpoint, check_delay=.5,
                  prereload_fn=None, context=None, loop=None,
                  stats_endpoint=None, plugins=None, sockets=None,
                  warmup_delay=0, httpd=False, httpd_host='localhost',
                  httpd_port=8080, debug=False, ssh_server=None,
-                 proc_name='circusd'):
+                 proc_name='circusd', parallel_stop=False,
+                 stall_timeout=0, use_spawner=False):
         self.watchers = watchers
         self.endpoint = endpoint
         self.check_delay = check_delay
         self.prereload_fn = prereload_fn
         self.pubsub_endpoint = pubsub_endpoint
         self.proc_name = proc_name
+        self.parallel_stop = parallel_stop
+        self.stall_timeout = stall_timeout
+        self.use_spawner = use_spawner
+        self.spawner = None
 
         self.ctrl = self.loop = None
+        self.evpub_socket = None
         self.socket_event = False
 
         # initialize zmq context
@@ -144,8 +171,32 @@ class Arbiter(object):
         self.sockets = CircusSockets(sockets)
         self.warmup_delay = warmup_delay
         self.loop = ioloop.IOLoop.instance()
+
+        # the watchers sorted by priority, and the processes of the
+        # watchers by pid. Both are kept up to date as watchers and
+        # processes come and go, so the checks don't have to rebuild them
+        self._priorities = []
+        self._sorted_watchers = []
+        for watcher in self.watchers:
+            self._index_watcher(watcher)
+        self._pids = {}
+
+        # the processes spawned by the watchers lead their own session,
+        # which their descendants keep: the sessions of the processes
+        # that left, with their watcher and the time they left, and the
+        # descendants found in them once they were orphaned, and the
+        # ones already killed
+        self._sessions = {}
+        self._orphans = {}
+        self._killed_orphans = set()
+        self.subreaper = False
+
+        # the background jobs run by the commands, by id
+        self._jobs = {}
+        self._finished_jobs = []
+
         self.ctrl = Controller(self.endpoint, self.context, self.loop, self,
-                               self.check_delay)
+                               self.check_delay, self.stall_timeout)
 
     def get_socket(self, name):
         for i in self.sockets:
@@ -184,6 +235,9 @@ class Arbiter(object):
             debug=cfg.get('debug', False),
             stream_backend=cfg.get('stream_backend', 'thread'),
             ssh_server=cfg.get('ssh_server', None),
+            parallel_stop=cfg.get('parallel_stop', False),
+            stall_timeout=cfg.get('stall_timeout', 0),
+            use_spawner=cfg.get('use_spawner', False),
     )
 
     def reload_from_config(self, config_file=None):
@@ -270,6 +324,7 @@ class Arbiter(object):
             w.stop()
             del self._watchers_names[w.name.lower()]
             self.watchers.remove(w)
+            self._unindex_watcher(w)
 
         # get added watchers
         for n in added_watcher_names:
@@ -277,6 +332,7 @@ class Arbiter(object):
             w.initialize(self.evpub_socket, self.sockets, self)
             w.start()
             self.watchers.append(w)
+            self._index_watcher(w)
             self._watchers_names[w.name.lower()] = w
 
         return False
@@ -314,7 +370,10 @@ class Arbiter(object):
                       httpd_host=cfg.get('httpd_host', 'localhost'),
                       httpd_port=cfg.get('httpd_port', 8080),
                       debug=cfg.get('debug', False),
-                      ssh_server=cfg.get('ssh_server', None))
+                      ssh_server=cfg.get('ssh_server', None),
+                      parallel_stop=cfg.get('parallel_stop', False),
+                      stall_timeout=cfg.get('stall_timeout', 0),
+                      use_spawner=cfg.get('use_spawner', False))
 
         # store the cfg which will be used, so it can be used later for checking if the cfg has been changed
         arbiter.cfg = arbiter.cfg2dict(cfg)
@@ -324,16 +383,56 @@ class Arbiter(object):
         return arbiter
 
     def iter_watchers(self, reverse=True):
-        watchers = [(watcher.priority, watcher) for watcher in self.watchers]
-        watchers.sort(reverse=reverse)
-        for __, watcher in watchers:
-            yield watcher
+        watchers = self._sorted_watchers[:]
+        if reverse:
+            watchers.reverse()
+        return iter(watchers)
+
+    def _index_watcher(self, watcher):
+        index = bisect_right(self._priorities, watcher.priority)
+        self._priorities.insert(index, watcher.priority)
+        self._sorted_watchers.insert(index, watcher)
+
+    def _unindex_watcher(self, watcher):
+        index = self._sorted_watchers.index(watcher)
+        del self._priorities[index]
+        del self._sorted_watchers[index]
+
+    def register_process(self, watcher, process):
+        """Called by the watchers when they spawn a process."""
+        self._pids[process.pid] = watcher, process
+        # the pid is reused, the session it led is over
+        self._sessions.pop(process.pid, None)
+
+    def unregister_process(self, pid):
+        """Called by the watchers when they let a process go."""
+        watcher = self._pids.pop(pid, (None, None))[0]
+        if watcher is not None:
+            self._sessions[pid] = watcher, time()
 
     @debuglog
     def initialize(self):
         # set process title
         _setproctitle(self.proc_name)
 
+        # the orphaned descendants of the processes are reparented to
+        # circusd instead of init, so they are reaped and don't get lost
+        if not self.subreaper:
+            self.subreaper = set_child_subreaper()
+            if not self.subreaper:
+                logger.debug('circusd is not a child subreaper, the '
+                             'orphaned processes go to init')
+
+        # start the spawner while circusd is still small
+        if self.use_spawner and self.spawner is None:
+            # the processes are reparented to circusd by the spawner
+            if Spawner.available() and self.subreaper:
+                self.spawner = Spawner()
+                self.spawner.start()
+            else:
+                logger.warning('The spawner needs Linux 3.4 or later, the '
+                               'processes are spawned by circusd')
+
         # event pub socket
         self.evpub_socket = self.context.socket(zmq.PUB)
         self.evpub_socket.bind(self.pubsub_endpoint)
@@ -350,11 +449,9 @@ class Arbiter(object):
             watcher.initialize(self.evpub_socket, self.sockets, self)
 
     def start_watcher(self, watcher):
-        """Aska a specific watcher to start and wait for the specified
-        warmup delay."""
+        """Ask a specific watcher to start, unless it's not autostarted."""
         if watcher.autostart:
             watcher.start()
-            sleep(self.warmup_delay)
 
     @debuglog
     def start(self):
@@ -372,8 +469,9 @@ class Arbiter(object):
         try:
             # initialize processes
             logger.debug('Initializing watchers')
-            for watcher in self.iter_watchers():
-                self.start_watcher(watcher)
+            watchers = [watcher for watcher in self.iter_watchers()
+                        if watcher.autostart]
+            self._call_paced(self.start_watcher, watchers)
 
             logger.info('Arbiter now waiting for commands')
 
@@ -390,26 +488,37 @@ class Arbiter(object):
         finally:
             self.ctrl.stop()
             self.evpub_socket.close()
+            if self.spawner is not None:
+                self.spawner.close()
+                self.spawner = None
 
     def stop(self, restart_after_stop=False):
+        """Stops all the watchers, then the loop.
+
+        When the loop is running, the watchers are stopped
+        asynchronously and the loop is stopped once they are done.
+        """
         self.restart_after_stop = restart_after_stop
 
-        if self.alive:
-            self.stop_watchers(stop_alive=True)
+        def _stopped():
+            if self.loop.running():
+                self.loop.stop()
 
-        if self.loop.running():
-            self.loop.stop()
+            # close sockets
+            self.sockets.close_all()
 
-        # close sockets
-        self.sockets.close_all()
+        if self.alive:
+            self.stop_watchers(stop_alive=True, callback=_stopped)
+        else:
+            _stopped()
 
     def reap_processes(self):
-        # map watcher to pids
-        watchers_pids = {}
-        for watcher in self.iter_watchers():
-            if not watcher.stopped:
-                for process in watcher.processes.values():
-                    watchers_pids[process.pid] = watcher
+        """Reap the dead children.
+
+        Returns the list of the watchers that lost processes.
+        """
+        start = time()
+        reaped = []
 
         # detect dead children
         while True:
@@ -419,24 +528,103 @@ class Arbiter(object):
                 if not pid:
                     break
 
-                if pid in watchers_pids:
-                    watcher = watchers_pids[pid]
+                if pid in self._pids:
+                    # the processes of a stopped watcher are reaped too,
+                    # so their status isn't lost
+                    watcher = self._pids[pid][0]
                     watcher.reap_process(pid, status)
+                    if watcher not in reaped:
+                        reaped.append(watcher)
+                elif pid in self._orphans:
+                    watcher = self._orphans.pop(pid)
+                    self._killed_orphans.discard(pid)
+                    logger.debug('reaping orphan %s [%s]' % (pid,
+                                                           watcher.name))
             except OSError as e:
                 if e.errno == errno.EAGAIN:
                     sleep(0)
                     continue
                 elif e.errno == errno.ECHILD:
                     # process already reaped
-                    return
+                    break
                 else:
                     raise
 
+        if self._sessions:
+            self.manage_orphans()
+
+        self.ctrl.record_latency('reap_processes', time() - start)
+        return reaped
+
+    def manage_orphans(self):
+        """Find the descendants the processes of the watchers left behind,
+        and kill them if the *orphan_policy* of their watcher says so.
+
+        The orphans are reparented to circusd, and belong to the watcher
+        of the session they are in. A session is forgotten once it has no
+        orphans left.
+        """
+        tree = get_process_tree()
+        orphans = {}
+        for pid in tree.get_children(os.getpid()):
+            session = self._sessions.get(tree.get_session(pid))
+            if session is None or pid in self._pids:
+                # not an orphan, or one of the spawner, the templates...
+                continue
+
+            watcher = orphans[pid] = session[0]
+            if pid not in self._orphans:
+                logger.info('%s: process %s was orphaned' % (watcher.name,
+                                                            pid))
+                watcher.notify_event("orphan", {"process_pid": pid,
+                                                "time": time()})
+
+            if (watcher.orphan_policy == 'kill' and
+                    pid not in self._killed_orphans):
+                # the orphan stays around until it's reaped
+                self._killed_orphans.add(pid)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError as e:
+                    if e.errno != errno.ESRCH:
+                        raise
+                    continue
+                watcher.notify_event("kill", {"process_pid": pid,
+                                              "time": time()})
+
+        # the orphans not found are gone, reaped by init when circusd is
+        # not a subreaper
+        self._orphans = orphans
+        self._killed_orphans.intersection_update(orphans)
+        sessions = set(tree.get_session(pid) for pid in orphans)
+        for pid, (watcher, left) in self._sessions.items():
+            # the snapshot may be older than the session
+            if pid not in sessions and tree.created > left:
+                del self._sessions[pid]
+
+    def reap_and_manage_processes(self):
+        """Reap the dead children and respawn the processes of the
+        watchers they belonged to.
+
+        Called by the controller as soon as a SIGCHLD is received, so a
+        crashed process doesn't wait for the next check to be replaced.
+        """
+        if not self.alive:
+            return
+
+        with self._lock:
+            reset_process_tree()
+            for watcher in self.reap_processes():
+                watcher.manage_processes()
+
     def manage_watchers(self):
         if not self.alive:
             return
 
+        start = time()
         with self._lock:
+            # the processes tree is read once for the whole check
+            reset_process_tree()
             need_on_demand = False
             # manage and reap processes
             self.reap_processes()
@@ -447,17 +635,54 @@ class Arbiter(object):
             if need_on_demand:
                  (rlist, wlist, xlist) = select.select([x.fileno() for x in self.sockets.values()], [], [], 0)
                  if rlist:
-                     self.socket_event = True
-                     self.start_watchers()
-                     self.socket_event = False
+                     self._call_paced(self._start_on_event,
+                                      self.iter_watchers())
+
+        self.ctrl.record_latency('manage_watchers', time() - start)
+
+    def _start_on_event(self, watcher):
+        # on_demand watchers only start when an event was received
+        self.socket_event = True
+        try:
+            watcher.start()
+        finally:
+            self.socket_event = False
+
+    def _call_paced(self, func, watchers, callback=None):
+        """Calls *func* on each watcher, *warmup_delay* seconds apart, then
+        calls *callback*.
+
+        The delay is waited for on the loop, so the arbiter keeps serving
+        commands and managing processes meanwhile. The watchers left are
+        skipped once the arbiter is stopping.
+        """
+        watchers = list(watchers)
+
+        def _call_next():
+            if not self.alive:
+                if callback is not None:
+                    callback()
+                return
+
+            while watchers:
+                func(watchers.pop(0))
+                if watchers and self.warmup_delay > 0:
+                    self.loop.add_timeout(time() + self.warmup_delay,
+                                          _call_next)
+                    return
+
+            if callback is not None:
+                callback()
 
+        _call_next()
 
     @debuglog
-    def reload(self, graceful=True):
+    def reload(self, graceful=True, callback=None):
         """Reloads everything.
 
         Run the :func:`prereload_fn` callable if any, then gracefuly
-        reload all watchers.
+        reload all watchers. *callback* is called once every watcher has
+        been reloaded.
         """
         if self.prereload_fn is not None:
             self.prereload_fn(self)
@@ -470,10 +695,28 @@ class Arbiter(object):
                 handler.stream = open(handler.baseFilename, handler.mode)
                 handler.release()
 
-        # gracefully reload watchers
-        for watcher in self.iter_watchers():
-            watcher.reload(graceful=graceful)
-            sleep(self.warmup_delay)
+        # gracefully reload watchers: a rolling reload is over once all
+        # its batches are done
+        state = {'reloading': 0, 'paced': False}
+
+        def _reloaded():
+            state['reloading'] -= 1
+            _check_done()
+
+        def _paced():
+            state['paced'] = True
+            _check_done()
+
+        def _check_done():
+            if state['paced'] and state['reloading'] == 0:
+                if callback is not None:
+                    callback()
+
+        def _reload(watcher):
+            state['reloading'] += 1
+            watcher.reload(graceful=graceful, callback=_reloaded)
+
+        self._call_paced(_reload, self.iter_watchers(), _paced)
 
     def numprocesses(self):
         """Return the number of processes running across all watchers."""
@@ -509,44 +752,142 @@ class Arbiter(object):
         watcher = Watcher(name, cmd, **kw)
         watcher.initialize(self.evpub_socket, self.sockets, self)
         self.watchers.append(watcher)
+        self._index_watcher(watcher)
         self._watchers_names[watcher.name.lower()] = watcher
         return watcher
 
-    def rm_watcher(self, name):
+    def rm_watcher(self, name, callback=None):
         """Deletes a watcher.
 
         Options:
 
         - **name**: name of the watcher to delete
+        - **callback**: called once the watcher is stopped
         """
         logger.debug('Deleting %r watcher', name)
 
         # remove the watcher from the list
         watcher = self._watchers_names.pop(name)
         del self.watchers[self.watchers.index(watcher)]
+        self._unindex_watcher(watcher)
 
         # stop the watcher
-        watcher.stop()
+        watcher.stop(callback=callback)
 
-    def start_watchers(self):
-        for watcher in self.iter_watchers():
-            watcher.start()
-            sleep(self.warmup_delay)
+    def run_job(self, command, func, *args, **kw):
+        """Runs a long running *command* in the background and returns the
+        id of the job.
+
+        *func* is called with *args* and *kw*, plus a *callback* it has to
+        call once the work is done. A ``job.<id>.done`` event is published
+        at that point, or ``job.<id>.failed`` if *func* raised an error.
+        """
+        job_id = uuid.uuid4().hex
+        job = {'job_id': job_id, 'command': command, 'status': 'running',
+               'started': time()}
+        self._jobs[job_id] = job
+
+        def _done():
+            self._end_job(job, 'done')
+
+        try:
+            func(*args, callback=_done, **kw)
+        except Exception as e:
+            logger.exception('Job %s (%s) failed', job_id, command)
+            self._end_job(job, 'failed', reason=str(e))
+
+        return job_id
+
+    def _end_job(self, job, status, reason=None):
+        if job['status'] != 'running':
+            return
+
+        job['status'] = status
+        job['ended'] = time()
+        if reason is not None:
+            job['reason'] = reason
+
+        self._finished_jobs.append(job['job_id'])
+        while len(self._finished_jobs) > self.max_finished_jobs:
+            self._jobs.pop(self._finished_jobs.pop(0), None)
 
-    def stop_watchers(self, stop_alive=False):
+        self.notify_event('job.%s.%s' % (job['job_id'], status), job)
+
+    def get_job(self, job_id):
+        """Return the job *job_id*."""
+        return self._jobs[job_id]
+
+    def jobs(self):
+        """Return the jobs that are running or recently finished."""
+        return self._jobs.values()
+
+    def notify_event(self, topic, msg):
+        """Publish a message on the event publisher channel"""
+        if self.evpub_socket is None or self.evpub_socket.closed:
+            return
+
+        json_msg = json.dumps(msg)
+        if isinstance(json_msg, unicode):
+            json_msg = json_msg.encode('utf8')
+
+        self.evpub_socket.send_multipart([topic, json_msg])
+
+    def start_watchers(self, callback=None):
+        """Starts the watchers in priority order, *warmup_delay* seconds
+        apart. *callback* is called once they are all started.
+        """
+        self._call_paced(lambda watcher: watcher.start(),
+                         self.iter_watchers(), callback)
+
+    def stop_watchers(self, stop_alive=False, callback=None):
+        """Stops the watchers in priority order.
+
+        The watchers are stopped one after the other, unless
+        *parallel_stop* is set: then all the watchers that have the same
+        priority are stopped together. *callback* is called once they are
+        all stopped, or right away if the arbiter is already stopping.
+        """
         if not self.alive:
+            if callback is not None:
+                callback()
             return
 
         if stop_alive:
             logger.info('Arbiter exiting')
             self.alive = False
 
+        tiers = []
         for watcher in self.iter_watchers(reverse=False):
-            watcher.stop()
+            if (self.parallel_stop and tiers and
+                    tiers[-1][0].priority == watcher.priority):
+                tiers[-1].append(watcher)
+            else:
+                tiers.append([watcher])
+
+        def _stop_next_tier():
+            if not tiers:
+                if callback is not None:
+                    callback()
+                return
+
+            tier = tiers.pop(0)
+            pending = [len(tier)]
+
+            def _stopped():
+                pending[0] -= 1
+                if pending[0] == 0:
+                    _stop_next_tier()
 
-    def restart(self):
-        self.stop_watchers()
-        self.start_watchers()
+            for watcher in tier:
+                watcher.stop(callback=_stopped)
+
+        _stop_next_tier()
+
+    def restart(self, callback=None):
+        def _start():
+            self.start_watchers(callback=callback)
+
+        self.stop_watchers(callback=_start)
 
 
 class ThreadedArbiter(Arbiter, Thread):
@@ -565,3 +906,6 @@ class ThreadedArbiter(Arbiter, Thread):
         self.loop.add_callback(self._stop)
         if get_ident() != self.ident:
             self.join()
+
+    def _stop(self):
+        Arbiter.stop(self)
@@ -124,6 +124,9 @@ class ControllerApp(object):
             if hasattr(args, 'start'):
                 opts['start'] = args.start
 
+            if hasattr(args, 'stop_on_error'):
+                opts['stop_on_error'] = args.stop_on_error
+
             if args.endpoint is None:
                 if cmd.msg_type == 'sub':
                     args.endpoint = DEFAULT_ENDPOINT_SUB
@@ -340,6 +343,9 @@ def parse_arguments(args, commands):
             if command == 'add':
                 subparser.add_argument('--start', action='store_true',
                                        default=False)
+            elif command == 'batch':
+                subparser.add_argument('--stop-on-error', action='store_true',
+                                       default=False)
 
     args = parser.parse_args(args)
 
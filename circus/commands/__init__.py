@@ -1,10 +1,12 @@
 from circus.commands import (   # NOQA
     addwatcher,
+    batch,
     decrproc,
     dstats,
     get,
     globaloptions,
     incrproc,
+    jobstatus,
     list,
     listen,
     listsockets,
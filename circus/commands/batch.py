@@ -0,0 +1,136 @@
+import shlex
+
+from circus.commands.base import Command, get_commands
+from circus.exc import ArgumentError, MessageError
+
+
+class Batch(Command):
+    """\
+        Run several commands at once
+        ============================
+
+        This command runs a list of commands, in order, and returns
+        their responses. All the commands are sent in a single message,
+        which saves a round trip per command.
+
+        ZMQ Message
+        -----------
+
+        ::
+
+            {
+                "command": "batch",
+                "properties": {
+                    "commands": [
+                        {
+                            "command": "incr",
+                            "properties": {"name": "<watchername>"}
+                        },
+                        {
+                            "command": "numprocesses",
+                            "properties": {"name": "<watchername>"}
+                        }
+                    ],
+                    "stop_on_error": false
+                }
+            }
+
+        The response contains the responses of the commands, in the same
+        order, in the "results" property::
+
+            {
+                "status": "ok",
+                "results": [
+                    {"status": "ok", "numprocesses": 2, "time": <timestamp>},
+                    {"status": "ok", "numprocesses": 2, "time": <timestamp>}
+                ],
+                "time", "timestamp"
+            }
+
+        When "stop_on_error" is true, the commands following the first one
+        that fails are not run, and "results" stops with the error.
+
+        The *batch* and *quit* commands can't be part of a batch.
+
+        Command line
+        ------------
+
+        ::
+
+            $ circusctl batch [--stop-on-error] "<command> [<args>]" ...
+
+        Options
+        +++++++
+
+        - <command>: a command with its arguments, as given to circusctl.
+        - --stop-on-error: don't run the commands following a failure.
+
+    """
+
+    name = "batch"
+    options = [('', 'stop-on-error', False,
+                "don't run the commands following a failure")]
+    properties = ['commands']
+    forbidden = ('batch', 'quit')
+
+    def message(self, *args, **opts):
+        if len(args) < 1:
+            raise ArgumentError("number of arguments invalid")
+
+        commands = get_commands()
+        messages = []
+        for line in args:
+            cmd_args = shlex.split(line)
+            if not cmd_args:
+                raise ArgumentError("empty command")
+
+            cmd_name = cmd_args.pop(0).lower()
+            cmd = commands.get(cmd_name)
+            if (cmd is None or cmd.msg_type != 'dealer' or
+                    cmd_name in self.forbidden):
+                raise ArgumentError("can't batch the %r command" % cmd_name)
+
+            messages.append(cmd.message(*cmd_args))
+
+        return self.make_message(commands=messages,
+                                 stop_on_error=opts.get('stop_on_error',
+                                                        False))
+
+    def execute(self, arbiter, props):
+        stop_on_error = props.get('stop_on_error', False)
+        results = []
+        for msg in props['commands']:
+            resp = arbiter.ctrl.execute_command(msg)
+            results.append(resp)
+            if stop_on_error and resp['status'] == 'error':
+                break
+
+        return {"results": results}
+
+    def validate(self, props):
+        super(Batch, self).validate(props)
+
+        commands = props['commands']
+        if not isinstance(commands, list):
+            raise MessageError("'commands' property should be a list")
+
+        for msg in commands:
+            if not isinstance(msg, dict) or 'command' not in msg:
+                raise MessageError("invalid command in the batch: %r" % msg)
+
+            if str(msg['command']).lower() in self.forbidden:
+                raise MessageError("can't batch the %r command"
+                                   % msg['command'])
+
+    def console_msg(self, msg):
+        if msg.get('status') != "ok":
+            return self.console_error(msg)
+
+        lines = []
+        for i, result in enumerate(msg.get('results', [])):
+            if result.get('status') == "error":
+                line = self.console_error(result)
+            else:
+                line = "ok"
+            lines.append("%d: %s" % (i, line))
+        return "\n".join(lines)
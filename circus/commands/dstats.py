@@ -5,6 +5,8 @@ from circus.util import get_info
 _INFOLINE = ("%(pid)s  %(cmdline)s %(username)s %(nice)s %(mem_info1)s "
              "%(mem_info2)s %(cpu)s %(mem)s %(ctime)s")
 
+_LATENCYLINE = "%(name)s: %(count)d calls, mean %(mean).4fs, max %(max).4fs"
+
 
 class Daemontats(Command):
     """\
@@ -25,7 +27,18 @@ class Daemontats(Command):
 
 
        The response returns a mapping the property "infos"
-       containing some process informations::
+       containing some process informations, and the number of commands
+       waiting to be dispatched by the controller in "queue_depth"
+       ("max_queue_depth" is the highest value seen since circusd
+       started). The commands waiting on the socket are queued together
+       before they're dispatched, so "max_queue_depth" is the largest
+       burst of commands the controller got at once.
+
+       "commands" gives how long each command took to run, and
+       "latencies" how long the "manage_watchers" and "reap_processes"
+       checks took and how late the loop ran its callbacks ("loop_lag").
+       Each one is a histogram of the durations, in seconds, since
+       circusd started::
 
             {
               "info": {
@@ -40,10 +53,29 @@ class Daemontats(Command):
                 "pid": 47864,
                 "username": "root"
               },
+              "queue_depth": 0,
+              "max_queue_depth": 3,
+              "latencies": {
+                "loop_lag": {
+                  "count": 120,
+                  "mean": 0.0004,
+                  "max": 0.0123,
+                  "buckets": {"1ms": 117, "5ms": 2, "10ms": 0,
+                              "50ms": 1, ..., "inf": 0}
+                },
+                "manage_watchers": {...},
+                "reap_processes": {...}
+              },
+              "commands": {
+                "list": {...}
+              },
               "status": "ok",
               "time": 1332265655.897085
             }
 
+       Everything but "info" is also published every 10 seconds in the
+       *arbiter.dstats* event.
+
        Command Line
        ------------
 
@@ -61,9 +93,12 @@ class Daemontats(Command):
         return self.make_message()
 
     def execute(self, arbiter, props):
-        return {'info': get_info(interval=0.01)}
+        resp = arbiter.ctrl.instrumentation()
+        resp['info'] = get_info(interval=0.01)
+        return resp
 
-    def _to_str(self, info):
+    def _to_str(self, msg):
+        info = msg['info']
         children = info.pop("children", [])
         ret = ['Main Process:',  '    ' + _INFOLINE % info]
 
@@ -72,10 +107,24 @@ class Daemontats(Command):
             for child in children:
                 ret.append('    ' + _INFOLINE % child)
 
+        if 'queue_depth' in msg:
+            ret.append('Queued commands: %(queue_depth)s '
+                       '(max: %(max_queue_depth)s)' % msg)
+
+        for title, key in (('Latencies', 'latencies'),
+                           ('Commands', 'commands')):
+            latencies = msg.get(key)
+            if not latencies:
+                continue
+            ret.append('%s:' % title)
+            for name in sorted(latencies):
+                ret.append('    ' + _LATENCYLINE % dict(latencies[name],
+                                                        name=name))
+
         return "\n".join(ret)
 
     def console_msg(self, msg):
         if msg['status'] == "ok":
-            return self._to_str(msg['info'])
+            return self._to_str(msg)
         else:
             return self.console_error(msg)
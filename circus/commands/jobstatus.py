@@ -0,0 +1,92 @@
+from circus.commands.base import Command
+from circus.exc import ArgumentError, MessageError
+
+
+class JobStatus(Command):
+    """\
+        Get the status of a job or all jobs
+        ===================================
+
+        The *stop*, *restart*, *reload* and *rm* commands run in the
+        background and return a job id. This command gives the status of
+        these jobs: "running", "done" or "failed".
+
+        ZMQ Message
+        -----------
+
+        ::
+
+            {
+                "command": "jobstatus",
+                "properties": {
+                    "job_id": "<job_id>",
+                }
+            }
+
+        The response returns the job in the "job" property::
+
+            {
+                "status": "ok",
+                "job": {
+                    "job_id": "<job_id>",
+                    "command": "restart",
+                    "status": "done",
+                    "started": <timestamp>,
+                    "ended": <timestamp>
+                },
+                "time", "timestamp"
+            }
+
+        A failed job has a "reason" property. Without a job id, all the
+        running and recently finished jobs are returned in the "jobs"
+        property.
+
+        Command line
+        ------------
+
+        ::
+
+            $ circusctl jobstatus [<job_id>]
+
+        Options
+        +++++++
+
+        - <job_id>: id of the job
+
+    """
+
+    name = "jobstatus"
+
+    def message(self, *args, **opts):
+        if len(args) > 1:
+            raise ArgumentError("message invalid")
+
+        if len(args) == 1:
+            return self.make_message(job_id=args[0])
+        else:
+            return self.make_message()
+
+    def execute(self, arbiter, props):
+        if 'job_id' in props:
+            try:
+                return {"job": arbiter.get_job(props['job_id'])}
+            except KeyError:
+                raise MessageError("job %s not found" % props['job_id'])
+        else:
+            return {"jobs": arbiter.jobs()}
+
+    def _job_str(self, job):
+        line = "%(job_id)s: %(command)s %(status)s" % job
+        if 'reason' in job:
+            line += " (%s)" % job['reason']
+        return line
+
+    def console_msg(self, msg):
+        if msg.get('status') != "ok":
+            return self.console_error(msg)
+
+        if "job" in msg:
+            return self._job_str(msg['job'])
+
+        jobs = sorted(msg.get("jobs", []), key=lambda job: job['started'])
+        return "\n".join([self._job_str(job) for job in jobs])
@@ -31,8 +31,13 @@ class Reload(Command):
                 }
             }
 
-        The response return the status "ok". If the property graceful is
-        set to true the processes will be exited gracefully.
+        The response returns the id of the job running the command in
+        the "job_id" property, right away. Once the reload is done,
+        a *job.<job_id>.done* event is published, or *job.<job_id>.failed*
+        if it failed. See the *jobstatus* command.
+
+        If the property graceful is set to true the processes will be
+        exited gracefully.
 
         If the property name is present, then the reload will be applied
         to the watcher.
@@ -68,6 +73,9 @@ class Reload(Command):
     def execute(self, arbiter, props):
         if 'name' in props:
             watcher = self._get_watcher(arbiter, props['name'])
-            watcher.reload(graceful=props.get('graceful', True))
+            job_id = arbiter.run_job(self.name, watcher.reload,
+                                     graceful=props.get('graceful', True))
         else:
-            arbiter.reload(graceful=props.get('graceful', True))
+            job_id = arbiter.run_job(self.name, arbiter.reload,
+                                     graceful=props.get('graceful', True))
+        return {"job_id": job_id}
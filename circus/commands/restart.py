@@ -22,7 +22,10 @@ class Restart(Command):
                 }
             }
 
-        The response return the status "ok".
+        The response returns the id of the job running the command in
+        the "job_id" property, right away. Once the restart is done,
+        a *job.<job_id>.done* event is published, or *job.<job_id>.failed*
+        if it failed. See the *jobstatus* command.
 
         If the property name is present, then the reload will be applied
         to the watcher.
@@ -56,6 +59,7 @@ class Restart(Command):
     def execute(self, arbiter, props):
         if 'name' in props:
             watcher = self._get_watcher(arbiter, props['name'])
-            watcher.restart()
+            job_id = arbiter.run_job(self.name, watcher.restart)
         else:
-            arbiter.restart()
+            job_id = arbiter.run_job(self.name, arbiter.restart)
+        return {"job_id": job_id}
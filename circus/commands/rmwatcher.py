@@ -26,7 +26,10 @@ class RmWatcher(Command):
 
         - name: name of watcher
 
-        The response return a status "ok".
+        The response returns the id of the job running the command in
+        the "job_id" property, right away. Once the watcher removal is done,
+        a *job.<job_id>.done* event is published, or *job.<job_id>.failed*
+        if it failed. See the *jobstatus* command.
 
         Command line
         ------------
@@ -53,4 +56,5 @@ class RmWatcher(Command):
 
     def execute(self, arbiter, props):
         self._get_watcher(arbiter, props['name'])
-        arbiter.rm_watcher(props['name'])
+        job_id = arbiter.run_job(self.name, arbiter.rm_watcher, props['name'])
+        return {"job_id": job_id}
@@ -70,7 +70,8 @@ class Signal(Command):
             }
 
         Last, you can send a signal to the process *and* its children, with
-        the *recursive* option::
+        the *recursive* option. If the watcher has the *use_killpg* option,
+        the signal is sent to the process group at once::
 
             {
                 "command": "signal",
@@ -148,13 +149,12 @@ class Signal(Command):
                 watcher.send_signal_child(pid, childpid, signum)
             elif children:
                 watcher.send_signal_children(pid, signum)
+            elif recursive:
+                # send to the given pid and its children
+                watcher.send_signal_recursive(pid, signum)
             else:
                 # send to the given pid
                 watcher.send_signal(pid, signum)
-
-                if recursive:
-                    # also send to the children
-                    watcher.send_signal_children(pid, signum)
         else:
             # send to all the pids for this watcher
             watcher.send_signal_processes(signum)
@@ -20,7 +20,10 @@ class Stop(Command):
                 }
             }
 
-        The response return the status "ok".
+        The response returns the id of the job running the command in
+        the "job_id" property, right away. Once the stop is done,
+        a *job.<job_id>.done* event is published, or *job.<job_id>.failed*
+        if it failed. See the *jobstatus* command.
 
         If the property name is present, then the reload will be applied
         to the watcher.
@@ -50,6 +53,7 @@ class Stop(Command):
     def execute(self, arbiter, props):
         if 'name' in props:
             watcher = self._get_watcher(arbiter, props['name'])
-            watcher.stop()
+            job_id = arbiter.run_job(self.name, watcher.stop)
         else:
-            arbiter.stop_watchers()
+            job_id = arbiter.run_job(self.name, arbiter.stop_watchers)
+        return {"job_id": job_id}
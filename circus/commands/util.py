@@ -38,6 +38,18 @@ def convert_option(key, val):
         return int(val)
     elif key == 'max_age_variance':
         return int(val)
+    elif key == 'reload_batch_size':
+        return int(val)
+    elif key == 'reload_settle_time':
+        return float(val)
+    elif key == 'preload':
+        return val
+    elif key == 'preload_timeout':
+        return float(val)
+    elif key == 'use_killpg':
+        return util.to_bool(val)
+    elif key == 'orphan_policy':
+        return val
 
     raise ArgumentError("unknown key %r" % key)
 
@@ -47,16 +59,18 @@ def validate_option(key, val):
                    'gid', 'send_hup', 'shell', 'env', 'cmd', 'copy_env',
                    'flapping_attempts', 'flapping_window', 'retry_in',
                    'max_retry', 'graceful_timeout', 'stdout_stream',
-                   'stderr_stream', 'max_age', 'max_age_variance'):
+                   'stderr_stream', 'max_age', 'max_age_variance',
+                   'reload_batch_size', 'reload_settle_time', 'preload',
+                   'preload_timeout', 'use_killpg', 'orphan_policy'):
         raise MessageError('unknown key %r' % key)
 
     if key in ('numprocesses', 'flapping_attempts', 'max_retry', 'max_age',
-               'max_age_variance'):
+               'max_age_variance', 'reload_batch_size'):
         if not isinstance(val, int):
             raise MessageError("%r isn't an integer" % key)
 
     if key in ('warmup_delay', 'flapping_window', 'retry_in',
-               'graceful_timeout',):
+               'graceful_timeout', 'reload_settle_time', 'preload_timeout'):
         if not isinstance(val, (int, float,)):
             raise MessageError("%r isn't a number" % key)
 
@@ -64,10 +78,14 @@ def validate_option(key, val):
         if not isinstance(val, int) and not isinstance(val, string_types):
             raise MessageError("%r isn't an integer or string" % key)
 
-    if key in ('send_hup', 'shell', 'copy_env'):
+    if key in ('send_hup', 'shell', 'copy_env', 'use_killpg'):
         if not isinstance(val, bool):
             raise MessageError("%r isn't a valid boolean" % key)
 
+    if key == 'orphan_policy':
+        if val not in ('reap', 'kill'):
+            raise MessageError("%r must be 'reap' or 'kill'" % key)
+
     if key in ('env', ):
         if not isinstance(val, dict):
             raise MessageError("%r isn't a valid object" % key)
@@ -79,5 +97,6 @@ def validate_option(key, val):
     if key in ('stderr_stream', 'stdout_stream'):
         for k, v in val.items():
             if not k in ('class', 'filename', 'refresh_time', 'max_bytes',
-                         'backup_count'):
+                         'backup_count', 'queue_size', 'overflow',
+                         'spill_dir', 'flush_size', 'flush_interval'):
                 raise MessageError("%r is an invalid option for %r" % (k, key))
@@ -59,6 +59,8 @@ class DefaultConfigParser(StrictConfigParser):
             return self.get(section, option)
         elif type is int:
             return self.getint(section, option)
+        elif type is float:
+            return self.getfloat(section, option)
         elif type is bool:
             return self.getboolean(section, option)
         else:
@@ -127,6 +129,9 @@ def get_config(config_file):
     config['httpd_host'] = dget('circus', 'httpd_host', 'localhost', str)
     config['httpd_port'] = dget('circus', 'httpd_port', 8080, int)
     config['debug'] = dget('circus', 'debug', False, bool)
+    config['parallel_stop'] = dget('circus', 'parallel_stop', False, bool)
+    config['stall_timeout'] = dget('circus', 'stall_timeout', 0, float)
+    config['use_spawner'] = dget('circus', 'use_spawner', False, bool)
 
     # Initialize watchers, plugins & sockets to manage
     watchers = []
@@ -202,6 +207,9 @@ def get_config(config_file):
                 elif opt == 'copy_path':
                     watcher['copy_path'] = dget(section, "copy_path", False,
                                                 bool)
+                elif opt == 'use_killpg':
+                    watcher['use_killpg'] = dget(section, "use_killpg", False,
+                                                 bool)
                 elif opt.startswith('hooks.'):
                     hook_name = opt[len('hooks.'):]
                     val = [elmt.strip() for elmt in val.split(',', 1)]
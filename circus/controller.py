@@ -1,4 +1,8 @@
+import errno
+import os
 import sys
+from thread import get_ident
+import time
 import traceback
 try:
     from queue import Queue, Empty  # NOQA
@@ -15,17 +19,44 @@ from circus import logger
 from circus.exc import MessageError
 from circus.py3compat import string_types
 from circus.sighandler import SysHandler
+from circus.util import (close_on_exec, set_nonblocking, Histogram,
+                         reset_process_tree)
+from circus.watchdog import LoopWatchdog
 
 
 class Controller(object):
-    def __init__(self, endpoint, context, loop, arbiter, check_delay=1.0):
+
+    # delay between two measures of the loop lag
+    lag_probe_delay = .5
+
+    # delay between two publications of the arbiter.dstats event
+    report_delay = 10.
+
+    # how many commands are read from the socket before they're dispatched
+    max_batch = 1000
+
+    def __init__(self, endpoint, context, loop, arbiter, check_delay=1.0,
+                 stall_timeout=0):
         self.arbiter = arbiter
         self.endpoint = endpoint
         self.context = context
         self.loop = loop
         self.check_delay = check_delay * 1000
+        self.stall_timeout = stall_timeout
 
         self.jobs = Queue()
+        self.max_queue_depth = 0
+
+        # how long the commands and the arbiter checks take, and how late
+        # the loop runs the callbacks
+        self.command_latencies = {}
+        self.latencies = {}
+        self._lag_probe = self.reporter = self.watchdog = None
+        self.probe_deadline = None
+
+        # written to by the signal handlers to wake up the loop
+        self._wakeup_pipe = None
+        self._reap_pending = False
 
         # initialize the sys handler
         self.sys_hdl = SysHandler(self)
@@ -41,42 +72,192 @@ class Controller(object):
         self.stream = zmqstream.ZMQStream(self.ctrl_socket, self.loop)
         self.stream.on_recv(self.handle_message)
 
+        # signal handlers can't safely touch the loop, so they just write
+        # into this pipe and the work is done when the loop picks it up
+        self._wakeup_pipe = os.pipe()
+        for fd in self._wakeup_pipe:
+            close_on_exec(fd)
+            set_nonblocking(fd)
+        self.loop.add_handler(self._wakeup_pipe[0], self.handle_wakeup,
+                              ioloop.IOLoop.READ)
+
     def start(self):
         self.initialize()
         self.caller = ioloop.PeriodicCallback(self.wakeup, self.check_delay,
                                               self.loop)
         self.caller.start()
 
+        self._probe_loop()
+        self.reporter = ioloop.PeriodicCallback(self.publish_instrumentation,
+                                                self.report_delay * 1000,
+                                                self.loop)
+        self.reporter.start()
+
+        if self.stall_timeout > 0:
+            self.watchdog = LoopWatchdog(self, self.stall_timeout,
+                                         get_ident())
+            self.watchdog.start()
+
     def stop(self):
         self.caller.stop()
+        self.reporter.stop()
+        if self.watchdog is not None:
+            self.watchdog.stop()
+            self.watchdog.join()
+            self.watchdog = None
+        if self._lag_probe is not None:
+            self.loop.remove_timeout(self._lag_probe)
+            self._lag_probe = None
         self.stream.flush()
         self.stream.close()
         self.ctrl_socket.close()
 
+        if self._wakeup_pipe is not None:
+            self.loop.remove_handler(self._wakeup_pipe[0])
+            pipe, self._wakeup_pipe = self._wakeup_pipe, None
+            for fd in pipe:
+                os.close(fd)
+
     def wakeup(self):
-        job = None
+        self.arbiter.manage_watchers()
+
+    def record_latency(self, name, duration, latencies=None):
+        if latencies is None:
+            latencies = self.latencies
+        if name not in latencies:
+            latencies[name] = Histogram()
+        latencies[name].add(duration)
+
+    def _probe_loop(self, deadline=None):
+        now = time.time()
+        if deadline is not None:
+            lag = max(now - deadline, 0)
+            self.record_latency('loop_lag', lag)
+            if self.stall_timeout > 0 and lag > self.stall_timeout:
+                logger.warning('The loop was stalled for %.2fs', lag)
+                self.arbiter.notify_event('circus.stall',
+                                          {'duration': lag, 'time': now})
+
+        deadline = self.probe_deadline = now + self.lag_probe_delay
+        self._lag_probe = self.loop.add_timeout(
+            deadline, lambda: self._probe_loop(deadline))
+
+    def instrumentation(self):
+        """Returns the command queue depth and the latencies measured
+        since circusd started."""
+        def _dump(latencies):
+            return dict([(name, histogram.to_dict())
+                         for name, histogram in latencies.items()])
+
+        return {'queue_depth': self.jobs.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'latencies': _dump(self.latencies),
+                'commands': _dump(self.command_latencies)}
+
+    def publish_instrumentation(self):
+        self.arbiter.notify_event('arbiter.dstats', self.instrumentation())
+
+    def _wake_loop(self):
+        if self._wakeup_pipe is None:
+            return
         try:
-            job = self.jobs.get(block=False)
-        except Empty:
-            pass
+            os.write(self._wakeup_pipe[1], '.')
+        except OSError as e:
+            # EAGAIN means a wake up is already pending
+            if e.errno not in (errno.EAGAIN, errno.EBADF):
+                raise
 
-        if job is not None:
-            self.dispatch(job)
-        self.arbiter.manage_watchers()
+    def notify_sigchld(self):
+        """Wakes up the loop so the dead children get reaped.
+
+        Called from the SIGCHLD handler.
+        """
+        self._reap_pending = True
+        self._wake_loop()
+
+    def handle_wakeup(self, fd, events):
+        try:
+            while os.read(fd, 1024):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        if self._reap_pending:
+            self._reap_pending = False
+            self.arbiter.reap_and_manage_processes()
+
+        self.dispatch_jobs()
 
     def add_job(self, cid, msg):
+        """Queues a command.
+
+        Safe to call from a signal handler: the command is dispatched once
+        the loop wakes up.
+        """
+        self._queue_job(cid, msg)
+        self._wake_loop()
+
+    def _queue_job(self, cid, msg):
         self.jobs.put((cid, msg), False)
-        self.wakeup()
+        depth = self.jobs.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+    def dispatch_jobs(self):
+        """Dispatches every queued command, in order.
+
+        Once the arbiter is stopping, the commands left get an error.
+        """
+        depth = self.jobs.qsize()
+        if depth > 1:
+            logger.debug("%d commands queued", depth)
+
+        while True:
+            try:
+                job = self.jobs.get(block=False)
+            except Empty:
+                break
+            if self.arbiter.alive:
+                self.dispatch(job)
+            else:
+                self.reject(job, "arbiter is stopping")
+
+    def reject(self, job, reason):
+        cid, msg = job
+        try:
+            cast = json.loads(msg).get('msg_type') == "cast"
+        except (ValueError, AttributeError):
+            cast = False
+        self.send_error(cid, msg, reason, cast=cast)
 
     def handle_message(self, raw_msg):
-        cid, msg = raw_msg
-        msg = msg.strip()
-
-        if not msg:
-            self.send_response(cid, msg, "error: empty command")
-        else:
-            logger.debug("got message %s", msg)
-            self.add_job(cid, msg)
+        # the commands already waiting on the socket are queued too, and
+        # dispatched in one go
+        while raw_msg is not None:
+            cid, msg = raw_msg
+            msg = msg.strip()
+
+            if not msg:
+                self.send_response(cid, msg, "error: empty command")
+            else:
+                logger.debug("got message %s", msg)
+                # we are already in the loop, no need to wake it up
+                self._queue_job(cid, msg)
+
+            if self.jobs.qsize() >= self.max_batch:
+                break
+            raw_msg = self._recv_pending()
+
+        self.dispatch_jobs()
+
+    def _recv_pending(self):
+        try:
+            return self.ctrl_socket.recv_multipart(zmq.NOBLOCK)
+        except zmq.ZMQError as e:
+            if e.errno != zmq.EAGAIN:
+                raise
+            return None
 
     def dispatch(self, job):
         cid, msg = job
@@ -88,52 +269,67 @@ class Controller(object):
                                    errno=errors.INVALID_JSON)
 
         cmd_name = json_msg.get('command')
-        properties = json_msg.get('properties', {})
         cast = json_msg.get('msg_type') == "cast"
 
+        start = time.time()
+        # the processes tree is read once for the whole command
+        reset_process_tree()
+        resp = self.execute_command(json_msg, msg)
+        if (isinstance(cmd_name, string_types) and
+                cmd_name.lower() in self.commands):
+            self.record_latency(cmd_name.lower(), time.time() - start,
+                                self.command_latencies)
+        self.send_response(cid, msg, resp, cast=cast)
+
+        if resp['status'] == "ok" and cmd_name.lower() == "quit":
+            if cid is not None:
+                self.stream.flush()
+
+            self.arbiter.stop()
+
+    def execute_command(self, json_msg, msg=None):
+        """Runs the command described by *json_msg* and returns the
+        response mapping, whether the command succeeded or not.
+
+        *msg* is the raw message, used in the error reports.
+        """
+        if msg is None:
+            msg = json_msg
+
+        cmd_name = json_msg.get('command')
+        properties = json_msg.get('properties', {})
+
         try:
             cmd = self.commands[cmd_name.lower()]
-        except KeyError:
-            error = "unknown command: %r" % cmd_name
-            return self.send_error(cid, msg, error, cast=cast,
-                                   errno=errors.UNKNOWN_COMMAND)
+        except (KeyError, AttributeError):
+            return error("unknown command: %r" % cmd_name,
+                         errno=errors.UNKNOWN_COMMAND)
 
         try:
             cmd.validate(properties)
             resp = cmd.execute(self.arbiter, properties)
         except MessageError as e:
-            return self.send_error(cid, msg, str(e), cast=cast,
-                                   errno=errors.MESSAGE_ERROR)
+            return error(str(e), errno=errors.MESSAGE_ERROR)
         except OSError as e:
-            return self.send_error(cid, msg, str(e), cast=cast,
-                                   errno=errors.OS_ERROR)
+            return error(str(e), errno=errors.OS_ERROR)
         except:
             exctype, value = sys.exc_info()[:2]
             tb = traceback.format_exc()
             reason = "command %r: %s" % (msg, value)
             logger.debug("error: command %r: %s\n\n%s", msg, value, tb)
-            return self.send_error(cid, msg, reason, tb, cast=cast,
-                                   errno=errors.COMMAND_ERROR)
+            return error(reason, tb, errno=errors.COMMAND_ERROR)
 
         if resp is None:
-            resp = ok()
+            return ok()
 
         if not isinstance(resp, (dict, list,)):
-            msg = "msg %r tried to send a non-dict: %s" % (msg, str(resp))
             logger.error("msg %r tried to send a non-dict: %s", msg, str(resp))
-            return self.send_error(cid, msg, "server error", cast=cast,
-                                   errno=errors.BAD_MSG_DATA_ERROR)
+            return error("server error", errno=errors.BAD_MSG_DATA_ERROR)
 
         if isinstance(resp, list):
             resp = {"results": resp}
 
-        self.send_ok(cid, msg, resp, cast=cast)
-
-        if cmd_name.lower() == "quit":
-            if cid is not None:
-                self.stream.flush()
-
-            self.arbiter.stop()
+        return ok(resp)
 
     def send_error(self, cid, msg, reason="unknown", tb=None, cast=False,
                    errno=errors.NOT_SPECIFIED):
@@ -0,0 +1,359 @@
+"""Fork server for the watchers that preload a Python application.
+
+circusd starts a template process that imports the *preload* modules
+once, then asks it to fork the workers. The workers start with the
+application already imported, and share its memory with the template
+until they write to it.
+
+circusd and the template talk over a unix socket, the stdin of the
+template, with one JSON message per line:
+
+- the template sends ``{"ready": <pid>}`` once it imported the
+  modules: circusd doesn't wait for it, the spawns are queued meanwhile;
+- circusd sends ``{"args": [...], "env": {...}}`` to fork a worker;
+- the template answers ``{"pid": <pid>}`` or ``{"error": <reason>}``;
+- the template sends ``{"exit": <pid>, "status": <status>}`` when one
+  of its workers exits, since circusd can't wait for them.
+
+"""
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from zmq.eventloop import ioloop
+
+from circus import logger
+from circus.process import Process
+from circus.py3compat import bytestring
+from circus.util import resolve_name
+
+
+def _retry(func, *args):
+    while True:
+        try:
+            return func(*args)
+        except (OSError, IOError, select.error), e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+
+class ForkServer(object):
+    """Runs the template process of a watcher, and forks workers from it.
+
+    Options:
+
+    - **modules**: the list of the modules the template imports.
+
+    - **on_exit**: called with the pid and the status of every worker
+      that exits.
+
+    - **on_close**: called with the fork server once its template process
+      is gone, or about to be.
+
+    - **timeout**: the number of seconds the template has to import the
+      modules, and then to answer a request. If it's not ready in time,
+      it's closed.
+
+    - **watcher**: the watcher the template belongs to. With **use_fds**,
+      the template inherits its sockets.
+
+    The other options are the ones of :class:`circus.process.Process`,
+    used to run the template. The workers inherit them.
+    """
+    def __init__(self, modules, on_exit, on_close=None, working_dir=None,
+                 uid=None, gid=None, env=None, rlimits=None, use_fds=False,
+                 timeout=30., loop=None, watcher=None):
+        self.modules = modules
+        self.on_exit = on_exit
+        self.on_close = on_close
+        self.timeout = timeout
+        self.loop = loop or ioloop.IOLoop.instance()
+        self.workers = set()
+        self.retired = False
+        self.closed = False
+        self.ready = False
+        self._buffer = ''
+        self._exits = []
+        # called once the template is ready
+        self._on_ready = []
+
+        self.sock, child = socket.socketpair()
+        try:
+            self.process = Process(0, sys.executable,
+                                   args=['-m', 'circus.forkserver'] + modules,
+                                   working_dir=working_dir, uid=uid, gid=gid,
+                                   env=env, rlimits=rlimits, use_fds=use_fds,
+                                   stdin=child.fileno(), watcher=watcher)
+        except:
+            self.sock.close()
+            raise
+        finally:
+            child.close()
+
+        self.sock.settimeout(timeout)
+        self.loop.add_handler(self.sock.fileno(), self._handle_events,
+                              ioloop.IOLoop.READ)
+        self._ready_timeout = self.loop.add_timeout(time.time() + timeout,
+                                                    self._not_ready)
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def when_ready(self, callback):
+        """Call *callback* once the template imported the modules, unless
+        it's gone by then."""
+        if self.ready:
+            return callback()
+        if callback not in self._on_ready:
+            self._on_ready.append(callback)
+
+    def spawn(self, args, env):
+        """Fork a worker running *args* with the environment *env*.
+
+        Returns the pid of the worker. Raises an :class:`OSError` if the
+        template couldn't fork it. The template should be ready: see
+        :meth:`when_ready`, otherwise this waits for it.
+        """
+        if self.closed:
+            raise OSError('the template process is gone')
+
+        msg = json.dumps({'args': args, 'env': env}) + '\n'
+        try:
+            self.sock.sendall(msg)
+            while True:
+                msg = self._read_message()
+                if 'exit' in msg:
+                    self._exits.append(msg)
+                elif 'ready' in msg:
+                    self._set_ready()
+                else:
+                    break
+            self._exits.extend(self._pop_messages())
+        except (socket.error, ValueError), e:
+            self.close()
+            raise OSError('the template process failed: %s' % e)
+        finally:
+            if self._exits and self.loop.running():
+                self.loop.add_callback(self._dispatch_exits)
+
+        if 'error' in msg:
+            raise OSError(msg['error'])
+
+        self.workers.add(msg['pid'])
+        return msg['pid']
+
+    def retire(self):
+        """No more workers are forked: the template goes away with the
+        last of its workers."""
+        self.retired = True
+        if not self.workers:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._on_ready = []
+        if self._ready_timeout is not None:
+            self.loop.remove_timeout(self._ready_timeout)
+            self._ready_timeout = None
+        self.loop.remove_handler(self.sock.fileno())
+        # the template exits once its control socket is closed
+        self.sock.close()
+        if self.on_close is not None:
+            self.on_close(self)
+        self.process.stop()
+
+    def _read_message(self):
+        while '\n' not in self._buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise socket.error('connection closed')
+            self._buffer += data
+
+        line, self._buffer = self._buffer.split('\n', 1)
+        return json.loads(line)
+
+    def _pop_messages(self):
+        messages = []
+        while '\n' in self._buffer:
+            line, self._buffer = self._buffer.split('\n', 1)
+            msg = json.loads(line)
+            if 'ready' in msg:
+                self._set_ready()
+            else:
+                messages.append(msg)
+        return messages
+
+    def _set_ready(self):
+        if self.ready:
+            return
+        self.ready = True
+        if self._ready_timeout is not None:
+            self.loop.remove_timeout(self._ready_timeout)
+            self._ready_timeout = None
+
+        callbacks, self._on_ready = self._on_ready, []
+        if callbacks:
+            # the spawns don't run from the middle of a read
+            self.loop.add_callback(lambda: self._call_ready(callbacks))
+
+    def _call_ready(self, callbacks):
+        for callback in callbacks:
+            if self.closed:
+                return
+            try:
+                callback()
+            except Exception:
+                logger.exception('Ready callback %r failed' % callback)
+
+    def _not_ready(self):
+        self._ready_timeout = None
+        logger.error('the template process %s did not import %s in %ss',
+                     self.pid, ', '.join(self.modules), self.timeout)
+        self.close()
+
+    def _handle_events(self, fd, events):
+        try:
+            data = self.sock.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+
+        if not data:
+            if not self.retired:
+                logger.error('the template process %s is gone', self.pid)
+            return self.close()
+
+        self._buffer += data
+        self._exits.extend(self._pop_messages())
+        self._dispatch_exits()
+
+    def _dispatch_exits(self):
+        exits, self._exits = self._exits, []
+        for msg in exits:
+            self.workers.discard(msg['exit'])
+            self.on_exit(msg['exit'], msg['status'])
+
+        if self.retired and not self.workers:
+            self.close()
+
+
+class Template(object):
+    """The loop of the template process: forks a worker for each request
+    received on *sock* and reports the exit of the workers."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._buffer = ''
+
+    def run(self):
+        # a SIGCHLD interrupts the select, so the workers are reaped
+        # right away
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        while True:
+            try:
+                readable = select.select([self.sock], [], [], 1.)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+
+            self.reap_workers()
+            if not readable:
+                continue
+
+            data = _retry(self.sock.recv, 4096)
+            if not data:
+                # circusd closed the socket
+                return
+
+            self._buffer += data
+            while '\n' in self._buffer:
+                line, self._buffer = self._buffer.split('\n', 1)
+                self.spawn(json.loads(line))
+
+    def send(self, msg):
+        _retry(self.sock.sendall, json.dumps(msg) + '\n')
+
+    def spawn(self, request):
+        try:
+            pid = os.fork()
+        except OSError, e:
+            return self.send({'error': str(e)})
+
+        if pid == 0:
+            self.sock.close()
+            run_worker([bytestring(arg) for arg in request['args']],
+                       dict((bytestring(key), bytestring(value))
+                            for key, value in request['env'].items()))
+
+        self.send({'pid': pid})
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = _retry(os.waitpid, -1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+
+            if not pid:
+                return
+            self.send({'exit': pid, 'status': status})
+
+
+def run_worker(args, env):
+    """Run the worker callable named by the first item of *args*, with
+    the other items as arguments, and exit with its result."""
+    code = 1
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.setsid()
+        os.environ.clear()
+        os.environ.update(env)
+        sys.argv = args
+        code = resolve_name(args[0])(*args[1:])
+    except SystemExit, e:
+        code = e.code
+    except:
+        traceback.print_exc()
+    finally:
+        if code is not None and not isinstance(code, int):
+            sys.stderr.write('%s\n' % code)
+            code = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code or 0)
+
+
+def main(modules=None):
+    if modules is None:
+        modules = sys.argv[1:]
+
+    # the control socket is our stdin
+    sock = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+
+    for module in modules:
+        __import__(module)
+
+    template = Template(sock)
+    template.send({'ready': os.getpid()})
+    template.run()
+
+
+if __name__ == '__main__':
+    main()
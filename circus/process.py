@@ -10,17 +10,20 @@ except ImportError:
 
 import errno
 import os
+import re
 import resource
-from subprocess import PIPE
+import signal
+from subprocess import PIPE, Popen
 import time
 import shlex
 import warnings
 
-from psutil import Popen, STATUS_ZOMBIE, STATUS_DEAD, NoSuchProcess
+from psutil import Process as PSProcess, NoSuchProcess
 
 from circus.py3compat import bytestring, string_types
 from circus.util import (get_info, to_uid, to_gid, debuglog, get_working_dir,
-                         ObjectDict, replace_gnu_args)
+                         ObjectDict, replace_gnu_args, close_fds_on_exec,
+                         get_socket_names, get_process_tree)
 from circus import logger
 
 
@@ -28,15 +31,118 @@ _INFOLINE = ("%(pid)s  %(cmdline)s %(username)s %(nice)s %(mem_info1)s "
              "%(mem_info2)s %(cpu)s %(mem)s %(ctime)s")
 
 
+_WID_VAR = re.compile(r'\$\(circus\.wid\)', re.I)
+
+
 RUNNING = 0
 DEAD_OR_ZOMBIE = 1
 UNEXISTING = 2
 OTHER = 3
+STOPPING = 4
+
+
+class SpawnSpec(object):
+    """The command line and the options of the processes of a watcher,
+    prepared once for all its processes.
+
+    The variables of the command line are replaced and the command line
+    is split when the spec is created: only the arguments using the *wid*
+    of a process are formatted when it's spawned. The uid and the gid are
+    resolved, and the fds of the inherited sockets listed, at the same
+    time.
+
+    The options are the ones of :class:`Process`, without the *wid*.
+    """
+    def __init__(self, cmd, args=None, working_dir=None, shell=False,
+                 uid=None, gid=None, env=None, rlimits=None, executable=None,
+                 use_fds=False, watcher=None):
+        self.cmd = cmd
+        self.args = args
+        self.working_dir = working_dir or get_working_dir()
+        self.shell = shell
+        self.uid = to_uid(uid) if uid else None
+        self.gid = to_gid(gid) if gid else None
+        self.env = env or {}
+        self.rlimits = rlimits or {}
+        self.executable = executable
+        self.use_fds = use_fds
+        self.watcher = watcher
+
+        sockets = {}
+        if watcher is not None:
+            sockets = watcher._get_sockets_fds()
+        self.cmdline = self._split_cmdline(sockets)
+        self.fds = self._get_inherited_fds(sockets)
+
+        # the arguments still holding a variable of the wid
+        self._wid_args = [(i, arg) for i, arg in enumerate(self.cmdline)
+                          if _WID_VAR.search(arg) or '$WID' in arg]
+
+    def _split_cmdline(self, sockets):
+        logger.debug('cmd: ' + bytestring(self.cmd))
+        logger.debug('args: ' + str(self.args))
+
+        format_kwargs = {
+            'shell': self.shell, 'args': self.args,
+            'env': ObjectDict(self.env.copy()),
+            'working_dir': self.working_dir, 'uid': self.uid,
+            'gid': self.gid, 'rlimits': self.rlimits,
+            'executable': self.executable, 'use_fds': self.use_fds}
+
+        if self.watcher is not None:
+            format_kwargs['sockets'] = sockets
+            for option in self.watcher.optnames:
+                if option not in format_kwargs\
+                        and hasattr(self.watcher, option):
+                    format_kwargs[option] = getattr(self.watcher, option)
+
+        cmd = replace_gnu_args(self.cmd, **format_kwargs)
+
+        if '$WID' in cmd or (self.args and '$WID' in self.args):
+            msg = "Using $WID in the command is deprecated. You should use "\
+                  "the python string format instead. In you case, this means "\
+                  "replacing the $WID in your command by $(WID)."
+
+            warnings.warn(msg, DeprecationWarning)
+
+        if self.args is not None:
+            if isinstance(self.args, string_types):
+                args = shlex.split(bytestring(replace_gnu_args(
+                    self.args, **format_kwargs)))
+            else:
+                args = [bytestring(replace_gnu_args(arg, **format_kwargs))
+                        for arg in self.args]
+            return shlex.split(bytestring(cmd)) + args
+        return shlex.split(bytestring(cmd))
+
+    def _get_inherited_fds(self, sockets):
+        if not self.use_fds or self.watcher is None:
+            return []
+
+        names = get_socket_names(self.watcher.cmd, self.args)
+        if names:
+            sockets = dict((name, fd) for name, fd in sockets.items()
+                           if name.lower() in names)
+        return sorted(sockets.values())
+
+    def format_args(self, wid):
+        """Return the command line of the process *wid*."""
+        args = list(self.cmdline)
+        wid = str(wid)
+        for index, arg in self._wid_args:
+            arg = _WID_VAR.sub(lambda match: wid, arg)
+            args[index] = arg.replace('$WID', wid)
+        return args
 
 
 class Process(object):
     """Wraps a process.
 
+    The process is spawned with :class:`subprocess.Popen`. The
+    :class:`psutil.Process` used to get its information and its children
+    is only created when they are asked for, and dropped once it's no
+    longer used: see :meth:`release_psutil`.
+
     Options:
 
     - **wid**: the process unique identifier. This value will be used to
@@ -75,25 +181,59 @@ class Process(object):
     - **rlimits**: a mapping containing rlimit names and values that will
       be set before the command runs.
 
-    - **use_fds**: if True, will not close the fds in the subprocess.
-      default: False.
+    - **use_fds**: if True, the process inherits the fds of the sockets
+      used in its command line, or of all the sockets of its watcher if
+      it uses none. The other fds are always closed. default: False.
+
+    - **stdin**: the file descriptor used as the stdin of the process.
+      Optional.
+
+    - **spawner**: if given, the :class:`circus.spawner.Spawner` that
+      spawns the process instead of circusd. The process then only
+      inherits the fds of the sockets, when **use_fds** is True.
+
+    - **spec**: if given, the :class:`SpawnSpec` the process is spawned
+      from, in place of the options from **cmd** to **watcher**.
     """
+    # number of seconds the psutil object of a process is kept once it's
+    # no longer used
+    psutil_idle_time = 60.
+
     def __init__(self, wid, cmd, args=None, working_dir=None, shell=False,
                  uid=None, gid=None, env=None, rlimits=None, executable=None,
-                 use_fds=False, watcher=None, spawn=True):
+                 use_fds=False, watcher=None, spawn=True, stdin=None,
+                 spawner=None, spec=None):
+
+        if spec is None:
+            spec = SpawnSpec(cmd, args=args, working_dir=working_dir,
+                             shell=shell, uid=uid, gid=gid, env=env,
+                             rlimits=rlimits, executable=executable,
+                             use_fds=use_fds, watcher=watcher)
 
         self.wid = wid
-        self.cmd = cmd
-        self.args = args
-        self.working_dir = working_dir or get_working_dir()
-        self.shell = shell
-        self.uid = to_uid(uid) if uid else None
-        self.gid = to_gid(gid) if gid else None
-        self.env = env or {}
-        self.rlimits = rlimits or {}
-        self.executable = executable
-        self.use_fds = use_fds
-        self.watcher = watcher
+        self.spec = spec
+        self.cmd = spec.cmd
+        self.args = spec.args
+        self.working_dir = spec.working_dir
+        self.shell = spec.shell
+        self.uid = spec.uid
+        self.gid = spec.gid
+        self.env = spec.env
+        self.rlimits = spec.rlimits
+        self.executable = spec.executable
+        self.use_fds = spec.use_fds
+        self.watcher = spec.watcher
+        self.stdin = stdin
+        self.spawner = spawner
+
+        # the state of the process, as far as circusd knows
+        self.returncode = None
+        self.stopping = False
+
+        # the Popen of the process when circusd spawned it, and its
+        # psutil object once needed
+        self._worker = self._psutil = None
+        self._psutil_used = 0
 
         if spawn:
             self.spawn()
@@ -101,9 +241,23 @@ class Process(object):
     def spawn(self):
         args = self.format_args()
 
+        fds = self.get_inherited_fds()
+
+        if self.spawner is not None:
+            pid, self._stdout, self._stderr = self.spawner.spawn(
+                args, executable=self.executable, shell=self.shell,
+                working_dir=self.working_dir, env=self.env, uid=self.uid,
+                gid=self.gid, rlimits=self.rlimits, fds=fds)
+            self._pid = pid
+            self.started = time.time()
+            return
+
         def preexec_fn():
             os.setsid()
 
+            # the pipes of subprocess are already in place
+            close_fds_on_exec(keep=fds)
+
             for limit, value in self.rlimits.items():
                 res = getattr(resource, 'RLIMIT_%s' % limit.upper(), None)
                 if res is None:
@@ -126,78 +280,153 @@ class Process(object):
 
         self._worker = Popen(args, cwd=self.working_dir,
                              shell=self.shell, preexec_fn=preexec_fn,
-                             env=self.env, close_fds=not self.use_fds,
-                             stdout=PIPE, stderr=PIPE,
+                             env=self.env, close_fds=False,
+                             stdin=self.stdin, stdout=PIPE, stderr=PIPE,
                              executable=self.executable)
+        self._pid = self._worker.pid
+        self._stdout = self._worker.stdout
+        self._stderr = self._worker.stderr
 
         self.started = time.time()
 
+    def get_inherited_fds(self):
+        """Return the fds of the sockets the process inherits."""
+        return self.spec.fds
+
     def format_args(self):
         """ It's possible to use environment variables and some other variables
         that are available in this context, when spawning the processes.
         """
-        logger.debug('cmd: ' + bytestring(self.cmd))
-        logger.debug('args: ' + str(self.args))
-
-        current_env = ObjectDict(self.env.copy())
-
-        format_kwargs = {
-            'wid': self.wid, 'shell': self.shell, 'args': self.args,
-            'env': current_env, 'working_dir': self.working_dir,
-            'uid': self.uid, 'gid': self.gid, 'rlimits': self.rlimits,
-            'executable': self.executable, 'use_fds': self.use_fds}
-
-        if self.watcher is not None:
-            format_kwargs['sockets'] = self.watcher._get_sockets_fds()
-            for option in self.watcher.optnames:
-                if option not in format_kwargs\
-                        and hasattr(self.watcher, option):
-                    format_kwargs[option] = getattr(self.watcher, option)
-
-        cmd = replace_gnu_args(self.cmd, **format_kwargs)
-
-        if '$WID' in cmd or (self.args and '$WID' in self.args):
-            msg = "Using $WID in the command is deprecated. You should use "\
-                  "the python string format instead. In you case, this means "\
-                  "replacing the $WID in your command by $(WID)."
-
-            warnings.warn(msg, DeprecationWarning)
-            self.cmd = cmd.replace('$WID', str(self.wid))
-
-        if self.args is not None:
-            if isinstance(self.args, string_types):
-                args = shlex.split(bytestring(replace_gnu_args(
-                    self.args, **format_kwargs)))
-            else:
-                args = [bytestring(replace_gnu_args(arg, **format_kwargs))
-                        for arg in self.args]
-            args = shlex.split(bytestring(cmd)) + args
-        else:
-            args = shlex.split(bytestring(cmd))
-
+        args = self.spec.format_args(self.wid)
         logger.debug("process args: %s", args)
         return args
 
     @debuglog
     def poll(self):
-        return self._worker.poll()
+        """Return the exit code of the process, or None if it's running.
+
+        The process is waited for if it exited, unless circusd did it
+        already and recorded its exit status with :meth:`set_exit_status`.
+        """
+        if self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                # waited for by someone else: the exit status is lost
+                self._set_returncode(0)
+            else:
+                if pid:
+                    self.set_exit_status(status)
+        return self.returncode
+
+    def exists(self):
+        """Return False if the process is gone.
+
+        Unlike :meth:`poll`, the process is not waited for: it exists
+        until circusd gets its exit status, or someone else does.
+        """
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, 0)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+                # waited for by someone else: the exit status is lost
+                self._set_returncode(0)
+        return self.returncode is None
+
+    def set_exit_status(self, status):
+        """Record the exit *status* of the process, as returned by
+        :func:`os.waitpid`."""
+        if os.WIFSIGNALED(status):
+            self._set_returncode(-os.WTERMSIG(status))
+        # process exited using exit(2) system call; return the
+        # integer exit(2) system call has been called with
+        elif os.WIFEXITED(status):
+            self._set_returncode(os.WEXITSTATUS(status))
+        else:
+            # should never happen
+            raise RuntimeError("Unknown process exit status")
+
+    def _set_returncode(self, returncode):
+        self.returncode = returncode
+        self._psutil = None
+        if self._worker is not None:
+            # or subprocess would wait for the pid once the Popen is
+            # garbage collected, when it may be another of our processes
+            self._worker.returncode = returncode
+
+    def get_psutil(self):
+        """Return the :class:`psutil.Process` of the process, created if
+        needed."""
+        # once the process is waited for, its pid can be reused
+        if self.returncode is not None:
+            raise NoSuchProcess(self.pid)
+
+        if self._psutil is None:
+            self._psutil = PSProcess(self.pid)
+        self._psutil_used = time.time()
+        return self._psutil
+
+    def release_psutil(self, idle_time=None):
+        """Drop the :class:`psutil.Process` of the process if it wasn't
+        used for *idle_time* seconds, :attr:`psutil_idle_time` by
+        default."""
+        if idle_time is None:
+            idle_time = self.psutil_idle_time
+        if (self._psutil is not None and
+                time.time() - self._psutil_used >= idle_time):
+            self._psutil = None
 
     @debuglog
     def send_signal(self, sig):
         """Sends a signal **sig** to the process."""
         logger.debug("sending signal %s to %s" % (sig, self.pid))
-        return self._worker.send_signal(sig)
+        # once the process is waited for, its pid can be reused
+        if self.returncode is not None:
+            raise NoSuchProcess(self.pid)
+
+        try:
+            os.kill(self.pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+            raise NoSuchProcess(self.pid)
+
+    @debuglog
+    def send_signal_group(self, sig):
+        """Sends a signal **sig** to the process group of the process: the
+        process and all its descendants that didn't leave it.
+
+        The process leads its own group, as it's spawned in a new session.
+        """
+        logger.debug("sending signal %s to the group of %s" % (sig, self.pid))
+        # once the process is waited for, its pid can be reused
+        if self.returncode is not None:
+            raise NoSuchProcess(self.pid)
+
+        try:
+            os.killpg(self.pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+            raise NoSuchProcess(self.pid)
 
     @debuglog
     def stop(self):
         """Terminate the process."""
         try:
             try:
-                if self._worker.poll() is None:
-                    return self._worker.terminate()
+                if self.returncode is None:
+                    self.stopping = True
+                    return self.send_signal(signal.SIGTERM)
             finally:
-                self._worker.stderr.close()
-                self._worker.stdout.close()
+                if self._stderr is not None:
+                    self._stderr.close()
+                if self._stdout is not None:
+                    self._stdout.close()
         except NoSuchProcess:
             pass
 
@@ -221,43 +450,49 @@ class Process(object):
         - **cmdline**: the command line the process was run with.
         """
         try:
-            info = get_info(self._worker)
+            info = get_info(self.get_psutil())
         except NoSuchProcess:
             return "No such process (stopped?)"
 
         info["age"] = self.age()
         info["started"] = self.started
         info["children"] = []
-        for child in self._worker.get_children():
-            info["children"].append(get_info(child))
+        for pid in self.children():
+            try:
+                info["children"].append(get_info(PSProcess(pid)))
+            except NoSuchProcess:
+                pass
 
         return info
 
     def children(self):
-        """Return a list of children pids."""
-        return [child.pid for child in self._worker.get_children()]
+        """Return a list of children pids.
+
+        The children are read from the snapshot of the process tree
+        shared by all the processes: see :func:`get_process_tree`.
+        """
+        # once the process is waited for, its pid can be reused
+        if self.returncode is not None:
+            return []
+        return get_process_tree().get_children(self.pid)
 
     def is_child(self, pid):
         """Return True is the given *pid* is a child of that process."""
-        pids = [child.pid for child in self._worker.get_children()]
-        if pid in pids:
-            return True
-        return False
+        return pid in self.children()
 
     @debuglog
     def send_signal_child(self, pid, signum):
         """Send signal *signum* to child *pid*."""
-        children = dict([(child.pid, child)
-                         for child in self._worker.get_children()])
-
-        children[pid].send_signal(signum)
+        if pid not in self.children():
+            raise NoSuchProcess(pid)
+        os.kill(pid, signum)
 
     @debuglog
     def send_signal_children(self, signum):
         """Send signal *signum* to all children."""
-        for child in self._worker.get_children():
+        for pid in self.children():
             try:
-                child.send_signal(signum)
+                os.kill(pid, signum)
             except OSError as e:
                 if e.errno != errno.ESRCH:
                     raise
@@ -267,34 +502,34 @@ class Process(object):
         """Return the process status as a constant
 
         - RUNNING
-        - DEAD_OR_ZOMBIE
-        - UNEXISTING
-        - OTHER
+        - STOPPING: the process was asked to stop
+        - UNEXISTING: the process exited
+
+        The status is tracked from the signals sent by circusd and the
+        exit statuses returned by :func:`os.waitpid`, without reading
+        /proc: the process is running until circusd waits for it.
+        DEAD_OR_ZOMBIE and OTHER are no longer used.
         """
-        try:
-            if self._worker.status in (STATUS_ZOMBIE, STATUS_DEAD):
-                return DEAD_OR_ZOMBIE
-        except NoSuchProcess:
+        if not self.exists():
             return UNEXISTING
-
-        if self._worker.is_running():
-            return RUNNING
-        return OTHER
+        if self.stopping:
+            return STOPPING
+        return RUNNING
 
     @property
     def pid(self):
         """Return the *pid*"""
-        return self._worker.pid
+        return self._pid
 
     @property
     def stdout(self):
         """Return the *stdout* stream"""
-        return self._worker.stdout
+        return self._stdout
 
     @property
     def stderr(self):
         """Return the *stdout* stream"""
-        return self._worker.stderr
+        return self._stderr
 
     def __eq__(self, other):
         return self is other
@@ -304,3 +539,31 @@ class Process(object):
 
     def __gt__(self, other):
         return self.started > other.started
+
+
+class ForkedProcess(Process):
+    """A process forked by the template process of a
+    :class:`circus.forkserver.ForkServer`, instead of being executed.
+
+    The first item of the command line is the name of the callable the
+    process runs, the other ones are its arguments. The process inherits
+    the working dir, the user, the rlimits and the output of the
+    template.
+    """
+    def __init__(self, wid, cmd, forkserver, **kw):
+        self.forkserver = forkserver
+        Process.__init__(self, wid, cmd, **kw)
+
+    def spawn(self):
+        args = self.format_args()
+        self._pid = self.forkserver.spawn(args, self.env)
+        self._stdout = self._stderr = None
+        self.started = time.time()
+
+    @debuglog
+    def poll(self):
+        # the template waits for the process and reports its exit, unless
+        # it's gone and the process with it
+        if self.forkserver.closed:
+            self.exists()
+        return self.returncode
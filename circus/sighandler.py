@@ -32,6 +32,11 @@ class SysHandler(object):
             signal.siginterrupt(signal.SIGQUIT, False)
             signal.siginterrupt(signal.SIGUSR1, False)
 
+        # SIGCHLD is not logged: it is received every time a process dies
+        signal.signal(signal.SIGCHLD, self.handle_chld)
+        if hasattr(signal, 'siginterrupt'):
+            signal.siginterrupt(signal.SIGCHLD, False)
+
     def signal(self, sig, frame):
         signame = self.SIG_NAMES.get(sig)
         logger.info('Got signal SIG_%s' % signame.upper())
@@ -56,6 +61,9 @@ class SysHandler(object):
     def handle_quit(self):
         self.controller.add_job(None, make_json("quit"))
 
+    def handle_chld(self, sig, frame):
+        self.controller.notify_sigchld()
+
     def handle_winch(self):
         pass
 
@@ -0,0 +1,324 @@
+"""A small process spawning the processes for circusd.
+
+Forking circusd gets slower as its memory grows, and running Python code
+between the fork and the exec isn't safe when circusd has threads. The
+spawner is a separate process that only imports the standard library:
+it forks and execs the processes in place of circusd.
+
+The spawner forks twice, so the processes are reparented to circusd,
+which must be a child subreaper. circusd then waits for them as if it
+had spawned them itself.
+
+circusd sends the requests over a unix socket, the stdin of the
+spawner. Each message is a JSON mapping preceded by its length. The
+write ends of the stdout and stderr pipes of the process, and the
+sockets it inherits, follow the request as file descriptors.
+"""
+import errno
+import fcntl
+import json
+import os
+import resource
+import signal
+import socket
+import struct
+import subprocess
+import sys
+from threading import Lock
+
+try:
+    from _multiprocessing import sendfd, recvfd
+except ImportError:
+    sendfd = recvfd = None      # NOQA
+
+
+_HEADER = struct.Struct('!I')
+
+
+def _retry(func, *args):
+    while True:
+        try:
+            return func(*args)
+        except (OSError, IOError, socket.error), e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+
+def _recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = _retry(sock.recv, size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def send_message(sock, msg):
+    data = json.dumps(msg)
+    _retry(sock.sendall, _HEADER.pack(len(data)) + data)
+
+
+def recv_message(sock):
+    """Return the next message, or None if the socket was closed."""
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exactly(sock, _HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+class Spawner(object):
+    """Runs the spawner process, and spawns processes through it.
+
+    Options:
+
+    - **timeout**: the number of seconds to wait for the spawner to
+      answer a request.
+    """
+    def __init__(self, timeout=5.):
+        self.timeout = timeout
+        self._lock = Lock()
+        self._process = self.sock = None
+
+    @staticmethod
+    def available():
+        return sendfd is not None
+
+    def start(self):
+        if self.sock is not None:
+            return
+
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        sock, child = socket.socketpair()
+        try:
+            self._process = subprocess.Popen(
+                [sys.executable, '-E', '-S', script], stdin=child,
+                close_fds=True)
+        except:
+            sock.close()
+            raise
+        finally:
+            child.close()
+
+        sock.settimeout(self.timeout)
+        self.sock = sock
+
+    def close(self):
+        if self.sock is None:
+            return
+
+        # the spawner exits once its socket is closed
+        self.sock.close()
+        self.sock = None
+
+    @property
+    def pid(self):
+        if self._process is None:
+            return None
+        return self._process.pid
+
+    def spawn(self, args, executable=None, shell=False, working_dir=None,
+              env=None, uid=None, gid=None, rlimits=None, fds=()):
+        """Spawn a process like :class:`subprocess.Popen`, with its
+        stdout and stderr piped.
+
+        *fds* lists the file descriptors of circusd the process inherits,
+        under the same numbers.
+
+        Returns the pid of the process, and its stdout and stderr.
+        Raises an :class:`OSError` if the process couldn't be spawned.
+        """
+        request = {'args': args, 'executable': executable, 'shell': shell,
+                   'working_dir': working_dir, 'env': env, 'uid': uid,
+                   'gid': gid, 'rlimits': rlimits or {}, 'fds': list(fds)}
+
+        stdout, stdout_w = os.pipe()
+        stderr, stderr_w = os.pipe()
+        try:
+            with self._lock:
+                reply = self._request(request, [stdout_w, stderr_w] +
+                                      list(fds))
+        except:
+            os.close(stdout)
+            os.close(stderr)
+            raise
+        finally:
+            os.close(stdout_w)
+            os.close(stderr_w)
+
+        return (reply['pid'], os.fdopen(stdout, 'rb', 0),
+                os.fdopen(stderr, 'rb', 0))
+
+    def _request(self, request, fds):
+        self.start()
+        error = 'connection closed'
+        try:
+            send_message(self.sock, request)
+            for fd in fds:
+                sendfd(self.sock.fileno(), fd)
+            reply = recv_message(self.sock)
+        except (socket.error, ValueError), e:
+            reply = None
+            error = e
+
+        if reply is None:
+            # a new spawner is started by the next request
+            self.close()
+            raise OSError('the spawner failed: %s' % error)
+
+        if 'error' in reply:
+            raise OSError(reply['errno'], reply['error'])
+        return reply
+
+
+def _close(fd):
+    try:
+        os.close(fd)
+    except OSError:
+        pass
+
+
+def _str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _exec(request, fds, close_fds, error_pipe):
+    """Run in the spawned process, until the exec."""
+    try:
+        # move the received fds out of the way, then in place
+        targets = [1, 2] + request['fds']
+        floor = max(targets) + 1
+        moved = [fcntl.fcntl(fd, fcntl.F_DUPFD, floor) for fd in fds]
+        for fd in set(fds) | set(close_fds):
+            _close(fd)
+
+        for fd, target in zip(moved, targets):
+            os.dup2(fd, target)
+        for fd in moved:
+            _close(fd)
+
+        if request['working_dir'] is not None:
+            os.chdir(request['working_dir'])
+
+        os.setsid()
+
+        for limit, value in request['rlimits'].items():
+            res = getattr(resource, 'RLIMIT_%s' % limit.upper(), None)
+            if res is None:
+                raise ValueError('unknown rlimit "%s"' % limit)
+            resource.setrlimit(res, (value, value))
+
+        if request['gid']:
+            os.setgid(request['gid'])
+        if request['uid']:
+            os.setuid(request['uid'])
+
+        # the same as subprocess.Popen
+        args = [_str(arg) for arg in request['args']]
+        executable = request['executable']
+        if executable is not None:
+            executable = _str(executable)
+        if request['shell']:
+            args = ['/bin/sh', '-c'] + args
+            if executable:
+                args[0] = executable
+        if executable is None:
+            executable = args[0]
+
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        env = request['env']
+        if env is None:
+            os.execvp(executable, args)
+        else:
+            env = dict((_str(key), _str(value))
+                       for key, value in env.items())
+            os.execvpe(executable, args, env)
+    except Exception, e:
+        code = getattr(e, 'errno', None) or 0
+        msg = getattr(e, 'strerror', None) or str(e)
+        _retry(os.write, error_pipe, '%d:%s' % (code, msg))
+    finally:
+        os._exit(255)
+
+
+def _read_all(fd):
+    data = ''
+    while True:
+        chunk = _retry(os.read, fd, 1024)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def spawn(request, fds, sock):
+    pid_r, pid_w = os.pipe()
+    error_r, error_w = os.pipe()
+    fcntl.fcntl(error_w, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+    try:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # the process is orphaned as soon as we exit, and gets
+                # reparented to circusd
+                child = os.fork()
+                if child == 0:
+                    _exec(request, fds, (sock.fileno(), pid_r, pid_w,
+                                         error_r), error_w)
+                os.write(pid_w, str(child))
+            finally:
+                os._exit(0)
+    finally:
+        os.close(pid_w)
+        os.close(error_w)
+
+    try:
+        _retry(os.waitpid, pid, 0)
+        child = _read_all(pid_r)
+        # the error pipe is closed by the exec
+        error = _read_all(error_r)
+    finally:
+        os.close(pid_r)
+        os.close(error_r)
+
+    if not child:
+        raise OSError(errno.EAGAIN, 'fork failed')
+    if error:
+        code, msg = error.split(':', 1)
+        raise OSError(int(code), msg)
+    return int(child)
+
+
+def main():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # the control socket is our stdin
+    sock = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+
+    while True:
+        request = recv_message(sock)
+        if request is None:
+            return
+
+        fds = [recvfd(sock.fileno()) for i in range(2 + len(request['fds']))]
+        try:
+            reply = {'pid': spawn(request, fds, sock)}
+        except OSError, e:
+            reply = {'errno': e.errno or 0, 'error': e.strerror or str(e)}
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+        send_message(sock, reply)
+
+
+if __name__ == '__main__':
+    main()
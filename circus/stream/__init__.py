@@ -2,20 +2,44 @@ import sys
 import random
 
 from datetime import datetime
-from Queue import Queue
+from Queue import Queue, Empty, Full
 
 from circus.util import resolve_name
 from circus.stream.file_stream import FileStream
 from circus.stream.redirector import Redirector
+from circus.stream.writer import StreamWriter
 
 
 class QueueStream(Queue):
-
-    def __init__(self, **kwargs):
-        Queue.__init__(self)
+    """Puts the data in a queue of up to *maxsize* items, unbounded by
+    default. When it's full, *overflow* is one of the policies of
+    :class:`circus.stream.writer.StreamWriter` but *spill*.
+    """
+    def __init__(self, maxsize=0, overflow='block', **kwargs):
+        if overflow not in ('block', 'drop_oldest', 'drop_newest'):
+            raise ValueError('unknown overflow policy %r' % overflow)
+        Queue.__init__(self, int(maxsize))
+        self.overflow = overflow
+        self.dropped = self.dropped_bytes = 0
 
     def __call__(self, data):
-        self.put(data)
+        if self.overflow == 'block':
+            return self.put(data)
+
+        while True:
+            try:
+                return self.put_nowait(data)
+            except Full:
+                if self.overflow == 'drop_newest':
+                    return self._drop(data)
+            try:
+                self._drop(self.get_nowait())
+            except Empty:
+                pass
+
+    def _drop(self, data):
+        self.dropped += 1
+        self.dropped_bytes += len(data['data'])
 
     def close(self):
         pass
@@ -127,13 +151,21 @@ def get_stream(conf):
     else:
         raise ValueError("stream configuration invalid")
 
+    # the stream is written from a thread
+    queue_size = int(conf.get('queue_size', 0))
+    if queue_size > 0:
+        inst = StreamWriter(inst, queue_size,
+                            conf.get('overflow', 'block'),
+                            conf.get('spill_dir'))
+
     # default refresh_time
     refresh_time = float(conf.get('refresh_time', 0.3))
 
     return {'stream': inst, 'refresh_time': refresh_time}
 
 
-def get_pipe_redirector(redirect, extra_info=None, buffer=1024, loop=None):
+def get_pipe_redirector(redirect, extra_info=None, buffer=1024, loop=None,
+                        on_detach=None):
     """Redirects data received in pipes to the redirect callable.
 
     The data is a mapping with a **data** key containing the data
@@ -146,6 +178,8 @@ def get_pipe_redirector(redirect, extra_info=None, buffer=1024, loop=None):
     - **buffer**: the size of the buffer when reading data
     - **loop**: the ioloop to use. If not provided will use the
       global IOLoop
+    - **on_detach**: called with the name of a pipe, its process and the
+      reason when a pipe is detached, at its end or when it fails
     """
     # XXX backend is deprecated
 
@@ -157,4 +191,5 @@ def get_pipe_redirector(redirect, extra_info=None, buffer=1024, loop=None):
     refresh_time = redirect.get('refresh_time', 0.3)
 
     # finally setup the redirection
-    return Redirector(stream, refresh_time, extra_info, buffer, loop=loop)
+    return Redirector(stream, refresh_time, extra_info, buffer, loop=loop,
+                      on_detach=on_detach)
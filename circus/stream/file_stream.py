@@ -1,10 +1,13 @@
 import os
+from threading import Lock, Timer
+import time
 
 from circus import logger
 
 
 class FileStream(object):
-    def __init__(self, filename=None, max_bytes=0, backup_count=0, **kwargs):
+    def __init__(self, filename=None, max_bytes=0, backup_count=0,
+                 flush_size=0, flush_interval=0, **kwargs):
         '''
         File writer handler which writes output to a file, allowing rotation
         behaviour based on Python's ``logging.handlers.RotatingFileHandler``.
@@ -25,33 +28,104 @@ class FileStream(object):
         respectively.
 
         If max_bytes is zero, rollover never occurs.
+
+        The data is written as it comes by default. With flush_size, it's
+        kept in memory until flush_size bytes are waiting, and with
+        flush_interval, for up to flush_interval seconds. The size of the
+        file is tracked in memory from the size it has when it's opened.
         '''
         super(FileStream, self).__init__()
         self._filename = filename
-        self._max_bytes = max_bytes
-        self._backup_count = backup_count
-        self._file = self._open()
+        self._max_bytes = int(max_bytes)
+        self._backup_count = int(backup_count)
+        self._flush_size = int(flush_size)
+        self._flush_interval = float(flush_interval)
+        self._lock = Lock()
+        self._timer = None
         self._buffer = []
+        self._buffered = 0
+        self._last_flush = time.time()
+        self._fd = self._open()
 
     def _open(self):
-        return open(self._filename, 'a+')
+        fd = os.open(self._filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0666)
+        # the size of the file is tracked from there
+        self._size = os.fstat(fd).st_size
+        return fd
 
     def __call__(self, data):
-        if self._should_rollover(data['data']):
-            self._do_rollover()
-        self._file.write(data['data'])
-        self._file.flush()
+        data = data['data']
+        with self._lock:
+            if self._fd is None:
+                # closed
+                return
+
+            if self._should_rollover(data):
+                self._flush()
+                self._do_rollover()
+
+            if not self._flush_size and not self._flush_interval:
+                # nothing is buffered
+                return self._write(data)
+
+            self._buffer.append(data)
+            self._buffered += len(data)
+
+            if self._flush_size and self._buffered >= self._flush_size:
+                self._flush()
+            elif self._flush_interval > 0:
+                if time.time() - self._last_flush >= self._flush_interval:
+                    self._flush()
+                elif self._timer is None:
+                    # what is buffered is written even if nothing comes
+                    # next
+                    self._timer = Timer(self._flush_interval,
+                                        self._flush_timer)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush_timer(self):
+        with self._lock:
+            self._timer = None
+            self._flush()
+
+    def _flush(self):
+        self._last_flush = time.time()
+        if not self._buffered or self._fd is None:
+            return
+
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._write(data)
+
+    def _write(self, data):
+        while data:
+            written = os.write(self._fd, data)
+            self._size += written
+            data = data[written:]
 
     def close(self):
-        self._file.close()
+        with self._lock:
+            if self._fd is None:
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._flush()
+            os.close(self._fd)
+            self._fd = None
 
     def _do_rollover(self):
         """
         Do a rollover, as described in __init__().
         """
-        if self._file:
-            self._file.close()
-            self._file = None
+        os.close(self._fd)
         if self._backup_count > 0:
             for i in range(self._backup_count - 1, 0, -1):
                 sfn = "%s.%d" % (self._filename, i)
@@ -66,7 +140,7 @@ class FileStream(object):
                 os.remove(dfn)
             os.rename(self._filename, dfn)
             logger.debug("Log rotating %s -> %s" % (self._filename, dfn))
-        self._file = self._open()
+        self._fd = self._open()
 
     def _should_rollover(self, raw_data):
         """
@@ -75,10 +149,8 @@ class FileStream(object):
         Basically, see if the supplied raw_data would cause the file to exceed
         the size limit we have.
         """
-        if self._file is None:                 # delay was set...
-            self._file = self._open()
         if self._max_bytes > 0:                   # are we rolling over?
-            self._file.seek(0, 2)  # due to non-posix-compliant Windows feature
-            if self._file.tell() + len(raw_data) >= self._max_bytes:
+            size = self._size + self._buffered + len(raw_data)
+            if size >= self._max_bytes:
                 return 1
         return 0
@@ -5,29 +5,65 @@ import sys
 
 from zmq.eventloop import ioloop
 
+from circus import logger
+
 
 class NamedPipe(object):
-    def __init__(self, pipe, process, name):
+    """A pipe of a process, read straight from its fd.
+
+    The size of the reads starts at *buffer*, doubles while the reads
+    fill it, up to *max_buffer*, and halves back when they don't fill a
+    quarter of it.
+    """
+    def __init__(self, pipe, process, name, buffer=1024, max_buffer=65536):
         self.pipe = pipe
         self.process = process
         self.name = name
         fcntl.fcntl(pipe, fcntl.F_SETFL, os.O_NONBLOCK)
         self._fileno = pipe.fileno()
+        self.min_buffer = self.buffer = buffer
+        self.max_buffer = max(buffer, max_buffer)
 
     def fileno(self):
         return self._fileno
 
-    def read(self, buffer):
+    def read(self):
         if self.pipe.closed:
-            return
-        return self.pipe.read(buffer)
+            return ''
+
+        data = os.read(self._fileno, self.buffer)
+        if len(data) == self.buffer:
+            self.buffer = min(self.buffer * 2, self.max_buffer)
+        elif len(data) < self.buffer // 4:
+            self.buffer = max(self.buffer // 2, self.min_buffer)
+        return data
 
 
 class Redirector(object):
+    """Reads the pipes of the processes, and sends what they get to the
+    *redirect* callable.
+
+    The pipes are registered with the loop, shared by all the watchers,
+    and only read when they have data. *refresh_time* is not used
+    anymore.
+
+    A readable pipe is read until it's empty, or until *max_read* bytes
+    were read so the other pipes get their turn. The reads start with
+    *buffer* bytes, and grow up to *max_buffer* bytes for the busy pipes.
+
+    A pipe at its end, or that fails, is detached on its own: the other
+    pipes are still read. *on_detach* is then called with the name of
+    the pipe, its process and the reason, "eof" or the errno name.
+    """
+    max_buffer = 65536
+    max_read = 262144
+
     def __init__(self, redirect, refresh_time=1.0, extra_info=None,
-                 buffer=1024, loop=None):
+                 buffer=1024, loop=None, on_detach=None):
         self.pipes = []
         self._names = {}
+        # the pipes registered with the loop, by fd
+        self._fds = {}
         self.redirect = redirect
         self.extra_info = extra_info
         self.buffer = buffer
@@ -37,46 +73,128 @@ class Redirector(object):
         self.extra_info = extra_info
         self.refresh_time = refresh_time * 1000
         self.loop = loop or ioloop.IOLoop.instance()
-        self.caller = None
+        self.on_detach = on_detach
 
     def start(self):
-        self.caller = ioloop.PeriodicCallback(self._select, self.refresh_time,
-                                              self.loop)
-        self.caller.start()
+        if self.running:
+            return
+        self.running = True
+        for pipe in self.pipes:
+            self._register(pipe)
 
     def kill(self):
-        if self.caller is None:
+        if not self.running:
             return
-        self.caller.stop()
+        self.running = False
+        for pipe in self.pipes:
+            self._unregister(pipe)
 
     def add_redirection(self, name, process, pipe):
-        npipe = NamedPipe(pipe, process, name)
+        npipe = NamedPipe(pipe, process, name, self.buffer, self.max_buffer)
         self.pipes.append(npipe)
         self._names[process.pid, name] = npipe
+        if self.running:
+            self._register(npipe)
 
     def remove_redirection(self, name, process):
+        """Stop reading the pipe of a process.
+
+        Must be called before the pipe is closed: its fd can be reused
+        right away.
+        """
         key = process.pid, name
         if key not in self._names:
             return
         pipe = self._names[key]
+        if self._fds.get(pipe.fileno()) is pipe:
+            # what the process wrote before exiting
+            try:
+                self._read(pipe)
+            except OSError:
+                pass
+        self._forget(pipe)
+
+    def _forget(self, pipe):
+        self._unregister(pipe)
         self.pipes.remove(pipe)
-        del self._names[key]
+        del self._names[pipe.process.pid, pipe.name]
 
-    def _select(self):
-        if len(self.pipes) == 0:
+    def _detach(self, pipe, reason):
+        logger.debug('the %s of %s is detached: %s' % (pipe.name,
+                                                       pipe.process.pid,
+                                                       reason))
+        self._forget(pipe)
+        if self.on_detach is not None:
+            self.on_detach(pipe.name, pipe.process, reason)
+
+    def _register(self, pipe):
+        if pipe.pipe.closed:
+            return
+        self._fds[pipe.fileno()] = pipe
+        self.loop.add_handler(pipe.fileno(), self._handle_events,
+                              ioloop.IOLoop.READ)
+
+    def _unregister(self, pipe):
+        fd = pipe.fileno()
+        if self._fds.get(fd) is not pipe:
+            return
+        del self._fds[fd]
+        self.loop.remove_handler(fd)
+
+    def _handle_events(self, fd, events):
+        pipe = self._fds.get(fd)
+        if pipe is None:
             return
 
-        # we just try to read, if we see some data
-        # we just redirect it.
         try:
-            for pipe in self.pipes:
-                data = pipe.read(self.buffer)
-                if data:
-                    datamap = {'data': data, 'pid': pipe.process.pid,
-                               'name': pipe.name}
-                    datamap.update(self.extra_info)
-                    self.redirect(datamap)
-        except IOError, ex:
-            if ex[0] != errno.EAGAIN:
-                raise
-            sys.exc_clear()
+            more = self._read(pipe)
+        except OSError, ex:
+            self._detach(pipe, errno.errorcode.get(ex.errno, str(ex)))
+            return
+
+        if not more:
+            # the pipe is at its end, or was closed: the loop would
+            # report it as readable forever
+            self._detach(pipe, 'eof')
+
+    def _read(self, pipe):
+        """Read the data waiting in a pipe, and redirect it.
+
+        Returns False once the pipe is at its end. Raises an OSError if
+        it can't be read, once what was read is redirected.
+        """
+        chunks = []
+        size = 0
+        more = True
+        error = None
+        while size < self.max_read:
+            try:
+                data = pipe.read()
+            except OSError, ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                if ex.errno != errno.EAGAIN:
+                    error = ex
+                sys.exc_clear()
+                break
+
+            if not data:
+                more = False
+                break
+            chunks.append(data)
+            size += len(data)
+
+        if chunks:
+            datamap = {'data': ''.join(chunks), 'pid': pipe.process.pid,
+                       'name': pipe.name}
+            datamap.update(self.extra_info)
+            try:
+                self.redirect(datamap)
+            except Exception:
+                # the pipe is still read
+                logger.exception('could not redirect the %s of %s'
+                                 % (pipe.name, pipe.process.pid))
+
+        if error is not None:
+            raise error
+        return more
@@ -0,0 +1,196 @@
+import atexit
+import cPickle
+from collections import deque
+import os
+import struct
+import tempfile
+from threading import Condition, Thread
+import time
+import weakref
+
+from circus import logger
+
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop_newest', 'spill')
+
+_HEADER = struct.Struct('!I')
+# the live writers, by id: WeakSet needs Python 2.7
+_WRITERS = weakref.WeakValueDictionary()
+
+
+class StreamWriter(object):
+    """Sends the data of the processes to a stream from a thread, so a
+    slow stream doesn't stall the loop.
+
+    The data waits in a queue of up to *queue_size* bytes. When it's
+    full, *overflow* says what becomes of the new data:
+
+    - **block**: the loop waits for the stream to catch up.
+    - **drop_oldest**: the oldest data waiting is dropped.
+    - **drop_newest**: the new data is dropped.
+    - **spill**: the new data is written to a temporary file in
+      *spill_dir*, and sent to the stream once the queue is empty.
+
+    *dropped* and *dropped_bytes* count the data dropped, *spilled_bytes*
+    the data written to the spill file.
+    """
+    def __init__(self, stream, queue_size=1048576, overflow='block',
+                 spill_dir=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy %r' % overflow)
+
+        self.stream = stream
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        self.dropped = self.dropped_bytes = self.spilled_bytes = 0
+
+        self._queue = deque()
+        self._size = 0
+        self._cond = Condition()
+        self._closed = False
+        self._overflowing = False
+        # the thread is sending data to the stream
+        self._busy = False
+        # the spill file, written by the loop and read by the thread
+        self._spill = self._spill_reader = None
+        self._spilled = 0
+
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        _WRITERS[id(self)] = self
+
+    def __call__(self, data):
+        size = len(data['data'])
+        with self._cond:
+            if self._closed:
+                return
+
+            if self._spilled:
+                # keep the order: the queue is sent first
+                return self._spill_data(data, size)
+
+            if self._size + size > self.queue_size and self._queue:
+                self._overflow(data, size)
+                if self.overflow in ('drop_newest', 'spill'):
+                    return
+
+            self._queue.append(data)
+            self._size += size
+            self._cond.notify_all()
+
+    def _overflow(self, data, size):
+        if not self._overflowing:
+            self._overflowing = True
+            logger.warning('the queue of the stream %r is full (overflow: '
+                           '%s)' % (self.stream, self.overflow))
+
+        if self.overflow == 'block':
+            while self._size + size > self.queue_size and self._queue:
+                self._cond.wait()
+        elif self.overflow == 'drop_oldest':
+            while self._size + size > self.queue_size and self._queue:
+                oldest = len(self._queue.popleft()['data'])
+                self._size -= oldest
+                self._drop(oldest)
+        elif self.overflow == 'drop_newest':
+            self._drop(size)
+        else:
+            self._spill_data(data, size)
+
+    def _drop(self, size):
+        self.dropped += 1
+        self.dropped_bytes += size
+
+    def _spill_data(self, data, size):
+        if self._spill is None:
+            fd, path = tempfile.mkstemp(prefix='circus-spill-',
+                                        dir=self.spill_dir)
+            self._spill = os.fdopen(fd, 'w+b')
+            self._spill_reader = open(path, 'rb')
+            os.remove(path)
+
+        record = cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+        self._spill.write(_HEADER.pack(len(record)) + record)
+        self._spilled += 1
+        self.spilled_bytes += size
+        self._cond.notify_all()
+
+    def _unspill(self):
+        self._spill.flush()
+        header = self._spill_reader.read(_HEADER.size)
+        record = self._spill_reader.read(_HEADER.unpack(header)[0])
+        self._spilled -= 1
+        if not self._spilled:
+            # start the file over
+            self._spill.seek(0)
+            self._spill.truncate()
+            self._spill_reader.seek(0)
+        return cPickle.loads(record)
+
+    def _next(self):
+        with self._cond:
+            while not (self._queue or self._spilled or self._closed):
+                self._cond.wait()
+
+            if self._queue:
+                data = self._queue.popleft()
+                self._size -= len(data['data'])
+            elif self._spilled:
+                data = self._unspill()
+            else:
+                return None
+
+            if not self._queue and not self._spilled:
+                self._overflowing = False
+            self._busy = True
+            self._cond.notify_all()
+            return data
+
+    def _run(self):
+        while True:
+            data = self._next()
+            if data is None:
+                return
+            try:
+                self.stream(data)
+            except Exception:
+                logger.exception('could not write to the stream %r'
+                                 % self.stream)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until the stream got all the data, or for *timeout*
+        seconds."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._queue or self._spilled or self._busy:
+                if deadline is None:
+                    self._cond.wait()
+                elif time.time() < deadline:
+                    self._cond.wait(deadline - time.time())
+                else:
+                    return
+
+    def close(self):
+        """Send the data left to the stream, then close it."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+        if self._spill is not None:
+            self._spill.close()
+            self._spill_reader.close()
+        self.stream.close()
+
+
+@atexit.register
+def _flush_writers():
+    # the threads of the writers go away with circusd
+    for writer in _WRITERS.values():
+        writer.flush(timeout=5.)
@@ -0,0 +1,61 @@
+"""Measures the cost of the arbiter bookkeeping done on every wakeup, as
+the number of managed processes grows.
+
+Run it with::
+
+    $ python -m circus.tests.bench_arbiter
+
+"""
+import sys
+from timeit import Timer
+
+from circus.arbiter import Arbiter
+from circus.watcher import Watcher
+
+
+NUM_WATCHERS = 300
+NUM_PROCESSES = (300, 1000, 5000, 20000)
+NUM_TICKS = 200
+
+
+class FakeProcess(object):
+
+    status = None
+
+    def __init__(self, pid):
+        self.pid = pid
+
+
+def make_arbiter(numwatchers, numprocesses):
+    watchers = [Watcher(name='w%d' % i, cmd='serve', priority=i % 10,
+                        stopped=False) for i in range(numwatchers)]
+    arbiter = Arbiter(watchers, None, None)
+    for watcher in watchers:
+        watcher.initialize(None, None, arbiter)
+
+    # pids that can't be our children, so waitpid never reaps them
+    for pid in range(numprocesses):
+        watcher = watchers[pid % numwatchers]
+        watcher._add_process(FakeProcess(-pid - 1))
+
+    return arbiter
+
+
+def tick(arbiter):
+    arbiter.reap_processes()
+    for watcher in arbiter.iter_watchers():
+        pass
+
+
+def main(numwatchers=NUM_WATCHERS, ticks=NUM_TICKS):
+    print('%d watchers, %d ticks' % (numwatchers, ticks))
+    for numprocesses in NUM_PROCESSES:
+        arbiter = make_arbiter(numwatchers, numprocesses)
+        timer = Timer(lambda: tick(arbiter))
+        duration = min(timer.repeat(3, ticks)) / ticks
+        print('%6d processes: %.1f usec per tick' % (numprocesses,
+                                                     duration * 1000000))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
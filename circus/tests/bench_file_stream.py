@@ -0,0 +1,75 @@
+"""Measures how many small chunks of output a FileStream writes per
+second, compared to seeking, writing and flushing a file object for each
+chunk like it used to.
+
+Run it with::
+
+    $ python -m circus.tests.bench_file_stream
+
+"""
+import os
+import sys
+import tempfile
+import time
+
+from circus.stream import FileStream
+
+
+WRITES = 100000
+CHUNK = 'x' * 100
+
+
+class FileObjectStream(object):
+    """The way FileStream used to write."""
+
+    def __init__(self, filename, max_bytes=0):
+        self._file = open(filename, 'a+')
+        self._max_bytes = max_bytes
+
+    def __call__(self, data):
+        if self._max_bytes > 0:
+            self._file.seek(0, 2)
+            if self._file.tell() + len(data['data']) >= self._max_bytes:
+                raise AssertionError('no rollover in this benchmark')
+        self._file.write(data['data'])
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def rate(factory, writes=WRITES):
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        stream = factory(filename)
+        data = {'data': CHUNK, 'pid': 1, 'name': 'stdout'}
+        start = time.time()
+        for i in xrange(writes):
+            stream(data)
+        stream.close()
+        duration = time.time() - start
+        assert os.path.getsize(filename) == writes * len(CHUNK)
+    finally:
+        os.remove(filename)
+    return writes / duration
+
+
+def main(writes=WRITES):
+    max_bytes = writes * len(CHUNK) * 2
+    print('%d writes of %d bytes, with max_bytes set, per second'
+          % (writes, len(CHUNK)))
+    print('%-30s %10.0f' % ('seek, write and flush:',
+                            rate(lambda f: FileObjectStream(f, max_bytes),
+                                 writes)))
+    print('%-30s %10.0f' % ('os.write:',
+                            rate(lambda f: FileStream(f, max_bytes),
+                                 writes)))
+    print('%-30s %10.0f' % ('buffering 64 KB:',
+                            rate(lambda f: FileStream(f, max_bytes,
+                                                      flush_size=65536),
+                                 writes)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""Measures how fast the output of the processes is redirected, in MB/s
+per process, reading one buffer per loop iteration like the redirector
+used to, or draining the pipes with growing buffers.
+
+Run it with::
+
+    $ python -m circus.tests.bench_redirector
+
+"""
+import sys
+import time
+
+from zmq.eventloop import ioloop
+
+from circus.process import Process
+from circus.stream import Redirector
+
+
+PROCESSES = (1, 4, 16)
+MEGABYTES = 64
+
+WRITER = """
+import os, sys
+chunk = 'x' * 4096
+for i in xrange(int(sys.argv[1]) * 256):
+    os.write(1, chunk)
+"""
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.size = 0
+
+    def __call__(self, data):
+        self.size += len(data['data'])
+
+
+def throughput(processes, drain=True, megabytes=MEGABYTES):
+    loop = ioloop.IOLoop()
+    counter = Counter()
+    redirector = Redirector(counter, loop=loop)
+    if not drain:
+        redirector.max_buffer = redirector.max_read = redirector.buffer
+
+    expected = processes * megabytes * 1024 * 1024
+    workers = []
+    start = time.time()
+    for i in range(processes):
+        process = Process(i, sys.executable,
+                          args=['-c', WRITER, str(megabytes)])
+        redirector.add_redirection('stdout', process, process.stdout)
+        workers.append(process)
+    redirector.start()
+
+    def _check():
+        if counter.size >= expected:
+            loop.stop()
+
+    checker = ioloop.PeriodicCallback(_check, 10, loop)
+    checker.start()
+    loop.start()
+    duration = time.time() - start
+
+    checker.stop()
+    redirector.kill()
+    for process in workers:
+        process.stop()
+    loop.close()
+    return megabytes / duration
+
+
+def main(megabytes=MEGABYTES):
+    print('MB/s per process, writing %d MB each' % megabytes)
+    for processes in PROCESSES:
+        print('%3d processes: %8.1f reading 1 KB per iteration, %8.1f '
+              'draining the pipes' % (processes,
+                                      throughput(processes, False, megabytes),
+                                      throughput(processes, True, megabytes)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""Measures the time it takes to spawn a process:
+
+- as the memory of circusd grows, with and without the spawner;
+- as the RLIMIT_NOFILE limit grows, closing the fds like subprocess or
+  like circus;
+- for the processes of a large watcher, preparing the command line and
+  the options for each process or once for the watcher.
+
+Run it with::
+
+    $ python -m circus.tests.bench_spawn
+
+"""
+import os
+import pwd
+import resource
+import socket
+from subprocess import Popen
+import sys
+import time
+
+from circus.process import Process
+from circus.spawner import Spawner
+from circus.util import set_child_subreaper
+from circus.watcher import Watcher
+
+
+BALLAST_MB = (0, 256, 1024)
+NOFILE = (1024, 16384, 65536, 1048576)
+NUM_SPAWNS = 50
+NUM_PROCESSES = 1000
+
+
+def _median(durations):
+    durations.sort()
+    return durations[len(durations) // 2]
+
+
+def spawn_latency(spawner=None, spawns=NUM_SPAWNS):
+    durations = []
+    for i in range(spawns):
+        start = time.time()
+        process = Process(i, '/bin/true', spawner=spawner)
+        durations.append(time.time() - start)
+        os.waitpid(process.pid, 0)
+        process.stop()
+    return _median(durations)
+
+
+def popen_latency(spawns=NUM_SPAWNS):
+    durations = []
+    for i in range(spawns):
+        start = time.time()
+        process = Popen(['/bin/true'], close_fds=True)
+        durations.append(time.time() - start)
+        process.wait()
+    return _median(durations)
+
+
+def bench_nofile(spawns=NUM_SPAWNS):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    print('median spawn time, %d spawns' % spawns)
+    try:
+        for nofile in NOFILE:
+            try:
+                # raising the hard limit needs to be root
+                resource.setrlimit(resource.RLIMIT_NOFILE,
+                                   (nofile, max(nofile, hard)))
+            except (ValueError, resource.error):
+                print('%8d fds: over the hard limit (%d)' % (nofile, hard))
+                continue
+            print('%8d fds: %7.2f ms with close_fds, %6.2f ms listing the '
+                  'fds' % (nofile, popen_latency(spawns) * 1000,
+                           spawn_latency(spawns=spawns) * 1000))
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+def bench_memory(spawns=NUM_SPAWNS):
+    if not Spawner.available() or not set_child_subreaper():
+        print('the spawner needs Linux 3.4 or later')
+        return
+
+    spawner = Spawner()
+    spawner.start()
+    ballast = []
+    try:
+        print('median spawn time, %d spawns' % spawns)
+        for size in BALLAST_MB:
+            while len(ballast) < size:
+                # touched memory, like the one of a busy circusd
+                ballast.append(bytearray(1024 * 1024))
+            print('%5d MB: %6.2f ms forking circusd, %6.2f ms with the '
+                  'spawner' % (size, spawn_latency(spawns=spawns) * 1000,
+                               spawn_latency(spawner, spawns) * 1000))
+    finally:
+        spawner.close()
+
+
+def _spawn_rate(watcher, processes, cached, spawn=True):
+    duration = 0
+    for i in range(processes):
+        if not cached:
+            watcher._reset_spawn_spec()
+
+        start = time.time()
+        if spawn:
+            process = watcher.spawn_process()
+        else:
+            process = Process(i, watcher.cmd, spawn=False,
+                              spec=watcher._get_spawn_spec())
+        duration += time.time() - start
+
+        if spawn:
+            os.waitpid(process.pid, 0)
+            watcher._pop_process(process.pid)
+            process.stop()
+    return processes / duration
+
+
+def bench_watcher(processes=NUM_PROCESSES):
+    sock = socket.socket()
+    user = pwd.getpwuid(os.getuid()).pw_name
+    watcher = Watcher('bench', '/bin/true --fd $(circus.sockets.web) '
+                      '--worker $(circus.wid) --of $(circus.numprocesses)',
+                      args=['--user', '$(circus.uid)'], uid=user,
+                      env={'PATH': os.environ.get('PATH', '')},
+                      numprocesses=processes, use_sockets=True,
+                      stopped=False)
+    watcher.initialize(None, {'web': sock}, None)
+    try:
+        print('%d processes, per second' % processes)
+        for spawn in (False, True):
+            print('%-13s %8.0f preparing each process, %8.0f preparing '
+                  'the watcher' % ('spawned:' if spawn else 'prepared:',
+                                   _spawn_rate(watcher, processes, False,
+                                               spawn),
+                                   _spawn_rate(watcher, processes, True,
+                                               spawn)))
+    finally:
+        sock.close()
+
+
+def main(spawns=NUM_SPAWNS):
+    bench_nofile(spawns)
+    bench_memory(spawns)
+    bench_watcher()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +1,27 @@
 import os
+import signal
 import sys
-import unittest
+import time
+from subprocess import Popen, PIPE, STDOUT
 from tempfile import mkstemp
 
 from mock import patch
 
+from circus import zmq
 from circus.arbiter import Arbiter
 from circus.watcher import Watcher
-from circus.client import CallError, CircusClient, make_message
-from circus.tests.support import TestCircus, poll_for, truncate_file
+from circus.client import CallError, CircusClient, make_message, make_json
+from circus.util import (DEFAULT_ENDPOINT_DEALER, reset_process_tree,
+                         set_child_subreaper)
+from circus.tests.support import (TestCircus, poll_for, truncate_file,
+                                  unittest)
 from circus.plugins import CircusPlugin
 
 
+_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
 class Plugin(CircusPlugin):
     name = 'dummy'
 
@@ -241,6 +251,107 @@ class TestTrainer(TestCircus):
         resp = self.cli.call(make_message("status", name="test"))
         self.assertEqual(resp.get('status'), "active")
 
+    def test_reap_on_sigchld(self):
+        self.assertTrue(poll_for(self.test_file, 'START'))
+        # the periodic check is disabled, so only SIGCHLD can respawn
+        self.arbiters[-1].ctrl.caller.stop()
+
+        msg = make_message("list", name="test")
+        pid = self.cli.call(msg).get('pids')[0]
+        os.kill(pid, signal.SIGKILL)
+
+        pids = [pid]
+        start = time.time()
+        while (pid in pids or not pids) and time.time() - start < 5:
+            time.sleep(.1)
+            pids = self.cli.call(msg).get('pids')
+
+        self.assertEqual(len(pids), 1)
+        self.assertNotEqual(pids[0], pid)
+
+    def test_commands_burst(self):
+        socket = zmq.Context.instance().socket(zmq.DEALER)
+        socket.linger = 0
+        socket.connect(DEFAULT_ENDPOINT_DEALER)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        try:
+            for i in range(50):
+                socket.send(make_json('incr', name='test', nb=0))
+
+            # every command gets its answer without waiting for the checks
+            for i in range(50):
+                self.assertTrue(poller.poll(1000))
+                socket.recv()
+        finally:
+            socket.close()
+
+        resp = self.cli.call(make_message("dstats"))
+        self.assertEqual(resp.get('queue_depth'), 0)
+        self.assertTrue(resp.get('max_queue_depth') >= 1)
+
+    def test_jobs(self):
+        resp = self.cli.call(make_message("restart", name="test"))
+        job_id = resp.get('job_id')
+        self.assertTrue(job_id)
+
+        msg = make_message("jobstatus", job_id=job_id)
+        start = time.time()
+        job = self.cli.call(msg)['job']
+        while job['status'] == 'running' and time.time() - start < 5:
+            time.sleep(.1)
+            job = self.cli.call(msg)['job']
+
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['command'], 'restart')
+
+        resp = self.cli.call(make_message("jobstatus"))
+        self.assertEqual([job['job_id'] for job in resp['jobs']], [job_id])
+
+        resp = self.cli.call(make_message("jobstatus", job_id='unknown'))
+        self.assertEqual(resp.get('status'), 'error')
+
+    def test_batch(self):
+        msg = make_message("batch", commands=[
+            make_message("incr", name="test"),
+            make_message("numprocesses", name="test"),
+            make_message("incr", name="unknown"),
+            make_message("decr", name="test")])
+        resp = self.cli.call(msg)
+        self.assertEqual(resp.get('status'), 'ok')
+
+        results = resp['results']
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0]['numprocesses'], 2)
+        self.assertEqual(results[1]['numprocesses'], 2)
+        self.assertEqual(results[2]['status'], 'error')
+        self.assertEqual(results[3]['numprocesses'], 1)
+
+    def test_batch_stop_on_error(self):
+        msg = make_message("batch", stop_on_error=True, commands=[
+            make_message("incr", name="unknown"),
+            make_message("incr", name="test")])
+        resp = self.cli.call(msg)
+        self.assertEqual(len(resp['results']), 1)
+        self.assertEqual(resp['results'][0]['status'], 'error')
+
+        resp = self.cli.call(make_message("numprocesses", name="test"))
+        self.assertEqual(resp.get('numprocesses'), 1)
+
+    def test_batch_forbidden(self):
+        msg = make_message("batch", commands=[make_message("quit")])
+        resp = self.cli.call(msg)
+        self.assertEqual(resp.get('status'), 'error')
+
+    def test_dstats_latencies(self):
+        self.cli.call(make_message("list"))
+        time.sleep(1.)
+
+        resp = self.cli.call(make_message("dstats"))
+        self.assertEqual(resp['commands']['list']['count'], 1)
+        for name in ('loop_lag', 'manage_watchers', 'reap_processes'):
+            self.assertTrue(resp['latencies'][name]['count'] > 0)
+
     def test_plugins(self):
         # killing the setUp runner
         self._stop_runners()
@@ -291,10 +402,42 @@ class TestTrainer(TestCircus):
 
 class MockWatcher(Watcher):
 
+    started = False
+
     def start(self):
         self.started = True
 
 
+class SlowReloadWatcher(Watcher):
+
+    reload_callback = None
+
+    def reload(self, graceful=True, callback=None):
+        self.reload_callback = callback
+
+
+class SlowStopWatcher(Watcher):
+
+    stop_callback = None
+
+    def stop(self, callback=None):
+        self.stop_callback = callback
+
+
+class FakeProcess(object):
+
+    status = None
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def stop(self):
+        pass
+
+    def set_exit_status(self, status):
+        pass
+
+
 class TestArbiter(unittest.TestCase):
     """
     Unit tests for the arbiter class to codify requirements within
@@ -315,15 +458,250 @@ class TestArbiter(unittest.TestCase):
         self.assertFalse(getattr(watcher, 'started', False))
 
     def test_start_watchers_warmup_delay(self):
-        watcher = MockWatcher(name='foo', cmd='serve', priority=1)
-        arbiter = Arbiter([], None, None, warmup_delay=10)
+        foo = MockWatcher(name='foo', cmd='serve', priority=1)
+        bar = MockWatcher(name='bar', cmd='serve', priority=0)
+        arbiter = Arbiter([foo, bar], None, None, warmup_delay=10)
         with patch('circus.arbiter.sleep') as mock_sleep:
-            arbiter.start_watcher(watcher)
-            mock_sleep.assert_called_with(10)
-
-        # now make sure we don't sleep when there is a autostart
+            with patch.object(arbiter.loop, 'add_timeout') as add_timeout:
+                arbiter.start_watchers()
+            self.assertFalse(mock_sleep.called)
+
+        # the next watcher is started once the delay is over
+        self.assertTrue(foo.started)
+        self.assertFalse(bar.started)
+        deadline, start_next = add_timeout.call_args[0]
+        self.assertTrue(deadline > time.time() + 9)
+        start_next()
+        self.assertTrue(bar.started)
+
+        # now make sure we don't start the watcher when there is no
+        # autostart
         watcher = MockWatcher(name='foo', cmd='serve', priority=1,
                               autostart=False)
-        with patch('circus.arbiter.sleep') as mock_sleep:
-            arbiter.start_watcher(watcher)
-            assert not mock_sleep.called
+        arbiter.start_watcher(watcher)
+        self.assertFalse(watcher.started)
+
+    def test_reload_waits_for_the_watchers(self):
+        foo = SlowReloadWatcher(name='foo', cmd='serve', priority=1)
+        bar = SlowReloadWatcher(name='bar', cmd='serve', priority=0)
+        arbiter = Arbiter([foo, bar], None, None)
+        job_id = arbiter.run_job('reload', arbiter.reload)
+
+        # the rolling reloads are still going on
+        self.assertTrue(foo.reload_callback is not None)
+        self.assertTrue(bar.reload_callback is not None)
+        foo.reload_callback()
+        self.assertEqual(arbiter.get_job(job_id)['status'], 'running')
+        bar.reload_callback()
+        self.assertEqual(arbiter.get_job(job_id)['status'], 'done')
+
+    def _get_stop_watchers(self):
+        return [SlowStopWatcher(name='foo', cmd='serve', priority=1),
+                SlowStopWatcher(name='bar', cmd='serve', priority=1),
+                SlowStopWatcher(name='baz', cmd='serve', priority=0)]
+
+    def test_stop_watchers(self):
+        foo, bar, baz = watchers = self._get_stop_watchers()
+        arbiter = Arbiter(watchers, None, None)
+        stopped = []
+        arbiter.stop_watchers(callback=lambda: stopped.append(True))
+
+        # the lowest priority is stopped first, then one watcher at a time
+        self.assertTrue(baz.stop_callback is not None)
+        self.assertTrue(foo.stop_callback is bar.stop_callback is None)
+        baz.stop_callback()
+        stopping = [w for w in (foo, bar) if w.stop_callback is not None]
+        self.assertEqual(len(stopping), 1)
+        stopping[0].stop_callback()
+        self.assertTrue(foo.stop_callback is not None)
+        self.assertTrue(bar.stop_callback is not None)
+        self.assertFalse(stopped)
+        (set([foo, bar]) - set(stopping)).pop().stop_callback()
+        self.assertTrue(stopped)
+
+    def test_stop_watchers_parallel(self):
+        foo, bar, baz = watchers = self._get_stop_watchers()
+        arbiter = Arbiter(watchers, None, None, parallel_stop=True)
+        stopped = []
+        arbiter.stop_watchers(callback=lambda: stopped.append(True))
+
+        self.assertTrue(baz.stop_callback is not None)
+        self.assertTrue(foo.stop_callback is bar.stop_callback is None)
+        baz.stop_callback()
+
+        # both watchers with the same priority are stopped together
+        self.assertTrue(foo.stop_callback is not None)
+        self.assertTrue(bar.stop_callback is not None)
+        foo.stop_callback()
+        self.assertFalse(stopped)
+        bar.stop_callback()
+        self.assertTrue(stopped)
+
+    def test_jobs_while_stopping(self):
+        arbiter = Arbiter(self._get_stop_watchers(), None, None)
+        arbiter.alive = False
+
+        # the jobs end even though there's nothing left to do
+        for command, func in (('stop', arbiter.stop_watchers),
+                              ('start', arbiter.start_watchers),
+                              ('restart', arbiter.restart)):
+            job_id = arbiter.run_job(command, func)
+            self.assertEqual(arbiter.get_job(job_id)['status'], 'done')
+
+    def _run_isolated(self, name):
+        # circusd can't stop being a subreaper once it is: the test runs
+        # in its own process
+        code = ('import sys\n'
+                'from circus.tests.support import unittest\n'
+                'from circus.tests.test_arbiter import OrphanTest\n'
+                'result = unittest.TextTestRunner().run(OrphanTest(%r))\n'
+                'sys.exit(result.skipped and 3 or '
+                'not result.wasSuccessful())\n' % name)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([_ROOT] + sys.path)
+        process = Popen([sys.executable, '-c', code], stdout=PIPE,
+                        stderr=STDOUT, env=env)
+        output = process.communicate()[0]
+        if process.returncode == 3:
+            raise self.skipTest('needs Linux 3.4 or later')
+        self.assertEqual(process.returncode, 0, output)
+
+    def test_reap_orphans(self):
+        self._run_isolated('check_reap_orphans')
+
+    def test_kill_orphans(self):
+        self._run_isolated('check_kill_orphans')
+
+    def test_run_job(self):
+        arbiter = Arbiter([], None, None)
+        callbacks = []
+
+        def _work(callback):
+            callbacks.append(callback)
+
+        job_id = arbiter.run_job('work', _work)
+        self.assertEqual(arbiter.get_job(job_id)['status'], 'running')
+        callbacks[0]()
+        self.assertEqual(arbiter.get_job(job_id)['status'], 'done')
+
+        def _fail(callback):
+            raise ValueError('boom')
+
+        job_id = arbiter.run_job('fail', _fail)
+        job = arbiter.get_job(job_id)
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['reason'], 'boom')
+
+    def test_dispatch_jobs_stopping(self):
+        arbiter = Arbiter([], None, None)
+        controller = arbiter.ctrl
+        controller._queue_job('cid', make_json('list'))
+        controller._queue_job(None, make_json('list'))
+        arbiter.alive = False
+
+        with patch.object(controller, 'send_response') as send_response:
+            with patch.object(controller, 'dispatch') as dispatch:
+                controller.dispatch_jobs()
+
+        # the commands left get an error instead of being dropped
+        self.assertFalse(dispatch.called)
+        self.assertEqual(controller.jobs.qsize(), 0)
+        self.assertEqual(send_response.call_count, 2)
+        cid, msg, resp = send_response.call_args_list[0][0]
+        self.assertEqual(cid, 'cid')
+        self.assertEqual(resp['status'], 'error')
+        self.assertEqual(resp['reason'], 'arbiter is stopping')
+
+    def test_watchers_index(self):
+        foo = Watcher(name='foo', cmd='serve', priority=1)
+        bar = Watcher(name='bar', cmd='serve', priority=0)
+        arbiter = Arbiter([foo, bar], None, None)
+        arbiter.evpub_socket = None
+        baz = arbiter.add_watcher('baz', 'serve', priority=2)
+        self.assertEqual(list(arbiter.iter_watchers()), [baz, foo, bar])
+        self.assertEqual(list(arbiter.iter_watchers(reverse=False)),
+                         [bar, foo, baz])
+
+        arbiter.rm_watcher('baz')
+        self.assertEqual(list(arbiter.iter_watchers()), [foo, bar])
+
+    def test_reap_processes_index(self):
+        watcher = Watcher(name='foo', cmd='serve', stopped=False)
+        arbiter = Arbiter([watcher], None, None)
+        watcher.initialize(None, None, arbiter)
+
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+
+        watcher._add_process(FakeProcess(pid))
+        self.assertTrue(arbiter._pids[pid][0] is watcher)
+
+        reaped = []
+        timeout = time.time() + 5
+        while not reaped and time.time() < timeout:
+            reaped = arbiter.reap_processes()
+            time.sleep(.01)
+
+        self.assertEqual(reaped, [watcher])
+        self.assertFalse(pid in watcher.processes)
+        self.assertFalse(pid in arbiter._pids)
+
+
+class OrphanTest(unittest.TestCase):
+    """Run by :class:`TestArbiter`, each test in a new process."""
+
+    def _orphan(self, orphan_policy):
+        if not set_child_subreaper():
+            raise self.skipTest('needs Linux 3.4 or later')
+
+        # the process exits right after forking a child
+        code = ('import os, time\n'
+                'pid = os.fork()\n'
+                'if pid: print pid\n'
+                'else: time.sleep(10)\n')
+        watcher = Watcher('test', sys.executable, args=['-c', code],
+                          orphan_policy=orphan_policy, stopped=False)
+        self.events = []
+        watcher.notify_event = lambda topic, msg: self.events.append(topic)
+        arbiter = Arbiter([watcher], None, None)
+        watcher.initialize(None, {}, arbiter)
+        process = watcher.spawn_process()
+        orphan = int(process.stdout.readline())
+
+        start = time.time()
+        while process.pid in arbiter._pids and time.time() - start < 5:
+            time.sleep(.1)
+            reset_process_tree()
+            arbiter.reap_processes()
+        self.assertFalse(process.pid in arbiter._pids)
+        return arbiter, orphan
+
+    def _wait_orphans(self, arbiter):
+        start = time.time()
+        while arbiter._sessions and time.time() - start < 5:
+            time.sleep(.1)
+            reset_process_tree()
+            arbiter.reap_processes()
+
+    def check_reap_orphans(self):
+        arbiter, orphan = self._orphan('reap')
+
+        # the orphan is reparented to circusd, and attributed to the
+        # watcher, until it exits
+        self.assertEqual(arbiter._orphans.keys(), [orphan])
+        os.kill(orphan, signal.SIGTERM)
+        self._wait_orphans(arbiter)
+        self.assertEqual(arbiter._orphans, {})
+        self.assertEqual(arbiter._sessions, {})
+
+    def check_kill_orphans(self):
+        arbiter, orphan = self._orphan('kill')
+        # the snapshot of the tree still has the orphan
+        arbiter.manage_orphans()
+        self._wait_orphans(arbiter)
+        self.assertEqual(arbiter._sessions, {})
+        self.assertRaises(OSError, os.kill, orphan, 0)
+        # the orphan is killed once
+        self.assertEqual(self.events.count('kill'), 1)
+        self.assertEqual(arbiter._killed_orphans, set())
@@ -0,0 +1,113 @@
+import os
+import signal
+import time
+import unittest
+
+from psutil import Process
+from zmq.eventloop import ioloop
+
+from circus import get_arbiter
+from circus.forkserver import ForkServer
+from circus.tests.support import TestCircus, poll_for
+
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+
+class TestPreload(TestCircus):
+
+    def _create_preload_circus(self, testfile):
+        worker = {'name': 'test', 'cmd': 'circus.tests.support.run_process',
+                  'args': [testfile], 'preload': 'circus.tests.support',
+                  'working_dir': os.path.abspath(_ROOT),
+                  'graceful_timeout': 4}
+        arbiter = get_arbiter([worker], background=True)
+        arbiter.start()
+        self.arbiters.append(arbiter)
+        return arbiter
+
+    def pids(self):
+        return self.call('list', name='test').get('pids')
+
+    def test_forked_processes(self):
+        testfile = self.get_tmpfile()
+        arbiter = self._create_preload_circus(testfile)
+        self.assertTrue(poll_for(testfile, 'START'))
+
+        watcher = arbiter.get_watcher('test')
+        template = watcher._forkservers[-1]
+        pids = self.pids()
+        self.assertEqual(len(pids), 1)
+        self.assertEqual(Process(pids[0]).ppid, template.pid)
+
+        # the template reports the exit, and the process is replaced
+        os.kill(pids[0], signal.SIGKILL)
+        start = time.time()
+        while self.pids() in ([], pids) and time.time() - start < 5:
+            time.sleep(.1)
+
+        new_pids = self.pids()
+        self.assertEqual(len(new_pids), 1)
+        self.assertNotEqual(new_pids, pids)
+        self.assertEqual(Process(new_pids[0]).ppid, template.pid)
+
+    def test_reload(self):
+        testfile = self.get_tmpfile()
+        arbiter = self._create_preload_circus(testfile)
+        self.assertTrue(poll_for(testfile, 'START'))
+
+        watcher = arbiter.get_watcher('test')
+        template = watcher._forkservers[-1]
+        self.assertEqual(self.call('reload', name='test').get('status'), 'ok')
+
+        # the new process is forked from a new template, and the old one
+        # goes away with its process
+        start = time.time()
+        while (template in watcher._forkservers and
+               time.time() - start < 5):
+            time.sleep(.1)
+
+        self.assertFalse(template in watcher._forkservers)
+        self.assertEqual(len(watcher._forkservers), 1)
+        pids = self.pids()
+        self.assertEqual(len(pids), 1)
+        self.assertEqual(Process(pids[0]).ppid, watcher._forkservers[0].pid)
+
+
+class TestForkServer(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = ioloop.IOLoop()
+        self.closed = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _run(self, forkserver):
+        # until the template is ready or gone
+        forkserver.when_ready(self.loop.stop)
+        self.loop.add_timeout(time.time() + 5, self.loop.stop)
+        self.loop.start()
+
+    def _forkserver(self, timeout):
+        return ForkServer(['circus.tests.support'], lambda pid, status: None,
+                          lambda forkserver: self.loop.stop(),
+                          working_dir=os.path.abspath(_ROOT),
+                          timeout=timeout, loop=self.loop)
+
+    def test_ready(self):
+        forkserver = self._forkserver(5)
+        try:
+            # the loop doesn't wait for the imports
+            self.assertFalse(forkserver.ready)
+            self._run(forkserver)
+            self.assertTrue(forkserver.ready)
+            self.assertFalse(forkserver.closed)
+        finally:
+            forkserver.close()
+
+    def test_not_ready_in_time(self):
+        forkserver = self._forkserver(.001)
+        self._run(forkserver)
+        self.assertFalse(forkserver.ready)
+        self.assertTrue(forkserver.closed)
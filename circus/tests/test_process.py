@@ -1,8 +1,13 @@
 import os
+import signal
 import sys
 import time
 
-from circus.process import Process, RUNNING
+from psutil import NoSuchProcess, STATUS_ZOMBIE
+from psutil import Process as PSProcess
+
+from circus.process import (Process, SpawnSpec, RUNNING, STOPPING,
+                            UNEXISTING)
 from circus.tests.support import TestCircus
 
 
@@ -42,7 +47,7 @@ class TestProcess(TestCircus):
 
         process = Process('test', cmd, args=args, rlimits=rlimits)
         # wait for the process to finish
-        while process.status == RUNNING:
+        while process.poll() is None:
             time.sleep(1)
 
         f = open(output_file, 'r')
@@ -73,6 +78,75 @@ class TestProcess(TestCircus):
         p1.stop()
         p2.stop()
 
+    def test_status(self):
+        process = Process('test', sys.executable,
+                          args=['-c', 'import time; time.sleep(10)'])
+        self.assertEqual(process.status, RUNNING)
+        self.assertEqual(process.poll(), None)
+
+        process.stop()
+        self.assertEqual(process.status, STOPPING)
+        _, status = os.waitpid(process.pid, 0)
+
+        # circusd waited for the process and records its status
+        process.set_exit_status(status)
+        self.assertEqual(process.poll(), -signal.SIGTERM)
+        self.assertEqual(process.status, UNEXISTING)
+
+        # its pid may be reused: it's not sent signals anymore
+        self.assertRaises(NoSuchProcess, process.send_signal, signal.SIGTERM)
+
+    def test_send_signal_group(self):
+        code = ('import os, sys, time\n'
+                'if os.fork():\n'
+                '    print "forked"\n'
+                '    sys.stdout.flush()\n'
+                'time.sleep(10)\n')
+        process = Process('test', sys.executable, args=['-c', code])
+        self.assertEqual(process.stdout.readline().strip(), 'forked')
+        child = PSProcess(process.pid).get_children()[0]
+
+        # the signal reaches the child too
+        process.send_signal_group(signal.SIGKILL)
+        _, status = os.waitpid(process.pid, 0)
+        process.set_exit_status(status)
+        start = time.time()
+        while (child.is_running() and child.status != STATUS_ZOMBIE and
+               time.time() - start < 5):
+            time.sleep(.1)
+        self.assertFalse(child.is_running() and
+                         child.status != STATUS_ZOMBIE)
+
+        self.assertRaises(NoSuchProcess, process.send_signal_group,
+                          signal.SIGKILL)
+
+    def test_psutil(self):
+        process = Process('test', sys.executable,
+                          args=['-c', 'import time; time.sleep(10)'])
+        try:
+            # the psutil object is only created when needed
+            self.assertEqual(process._psutil, None)
+            self.assertEqual(process.info()['pid'], process.pid)
+            worker = process._psutil
+            self.assertEqual(worker.pid, process.pid)
+
+            process.release_psutil()
+            self.assertTrue(process._psutil is worker)
+            process.release_psutil(idle_time=0)
+            self.assertEqual(process._psutil, None)
+        finally:
+            process.stop()
+
+    def test_exit_code(self):
+        process = Process('test', sys.executable,
+                          args=['-c', 'import sys; sys.exit(3)'])
+        start = time.time()
+        while process.poll() is None and time.time() - start < 5:
+            time.sleep(.1)
+        self.assertEqual(process.poll(), 3)
+        self.assertEqual(process.status, UNEXISTING)
+        process.stop()
+
     def test_process_parameters(self):
         # all the options passed to the process should be available by the
         # command / process
@@ -92,3 +166,66 @@ class TestProcess(TestCircus):
                      env={'type': 'macchiato'})
         self.assertEquals(['yeah', 'macchiato'], p3.format_args())
         os.environ.pop('coffee_type')
+
+    def test_fds(self):
+        fd = os.open(os.devnull, os.O_RDONLY)
+        try:
+            cmd = sys.executable
+            args = ['-c', 'import os, sys; os.fstat(int(sys.argv[1]))',
+                    str(fd)]
+            process = Process('test', cmd, args=args)
+            _, status = os.waitpid(process.pid, 0)
+            # the fds of circusd are not inherited
+            self.assertEqual(os.WEXITSTATUS(status), 1)
+            process.stop()
+        finally:
+            os.close(fd)
+
+    def test_inherited_fds(self):
+
+        class FakeWatcher(object):
+            cmd = 'serve --fd $(circus.sockets.web)'
+            optnames = ()
+
+            def _get_sockets_fds(self):
+                return {'web': 5, 'admin': 6}
+
+        watcher = FakeWatcher()
+        process = Process('1', watcher.cmd, use_fds=True, watcher=watcher,
+                          spawn=False)
+        self.assertEqual(process.get_inherited_fds(), [5])
+
+        # a command that uses no socket gets all of them
+        watcher.cmd = 'serve'
+        process = Process('1', watcher.cmd, use_fds=True, watcher=watcher,
+                          spawn=False)
+        self.assertEqual(process.get_inherited_fds(), [5, 6])
+
+        process = Process('1', watcher.cmd, watcher=watcher, spawn=False)
+        self.assertEqual(process.get_inherited_fds(), [])
+
+    def test_spawn_spec(self):
+
+        class FakeWatcher(object):
+            cmd = 'serve --fd $(circus.sockets.web) --id $(circus.wid)'
+            optnames = ('numprocesses',)
+            numprocesses = 4
+            calls = 0
+
+            def _get_sockets_fds(self):
+                self.calls += 1
+                return {'web': 5}
+
+        watcher = FakeWatcher()
+        spec = SpawnSpec(watcher.cmd, args='--of $(circus.numprocesses)',
+                         use_fds=True, watcher=watcher)
+        processes = [Process(wid, watcher.cmd, spec=spec, spawn=False)
+                     for wid in (1, 2)]
+
+        # only the wid is formatted for each process
+        self.assertEqual(processes[0].format_args(),
+                         ['serve', '--fd', '5', '--id', '1', '--of', '4'])
+        self.assertEqual(processes[1].format_args(),
+                         ['serve', '--fd', '5', '--id', '2', '--of', '4'])
+        self.assertEqual(processes[1].get_inherited_fds(), [5])
+        self.assertEqual(watcher.calls, 1)
@@ -0,0 +1,101 @@
+import errno
+import os
+import socket
+import sys
+
+from psutil import Process as PSProcess
+
+from circus.process import Process
+from circus.spawner import Spawner
+from circus.tests.support import TestCircus
+from circus.util import set_child_subreaper
+
+
+class TestSpawner(TestCircus):
+
+    def setUp(self):
+        super(TestSpawner, self).setUp()
+        if not Spawner.available() or not set_child_subreaper():
+            raise self.skipTest('the spawner needs Linux 3.4 or later')
+        self.spawner = Spawner()
+
+    def tearDown(self):
+        self.spawner.close()
+        super(TestSpawner, self).tearDown()
+
+    def _wait(self, pid):
+        _, status = os.waitpid(pid, 0)
+        return os.WEXITSTATUS(status)
+
+    def test_spawn(self):
+        process = Process('test', sys.executable,
+                          args=['-c', 'import os; print os.getppid()'],
+                          spawner=self.spawner)
+
+        # the process is a child of circusd, not of the spawner
+        self.assertEqual(self._wait(process.pid), 0)
+        self.assertEqual(process.stdout.read().strip(), str(os.getpid()))
+        self.assertNotEqual(self.spawner.pid, os.getpid())
+        process.stop()
+
+    def test_spawn_options(self):
+        wdir = self.get_tmpfile()
+        os.remove(wdir)
+        os.mkdir(wdir)
+        try:
+            code = ('import os, resource; '
+                    'print os.getcwd(), os.environ["FOO"], '
+                    'resource.getrlimit(resource.RLIMIT_NOFILE)[0], '
+                    'os.getsid(0) == os.getpid()')
+            process = Process('test', sys.executable, args=['-c', code],
+                              working_dir=wdir, env={'FOO': 'bar'},
+                              rlimits={'nofile': 100}, spawner=self.spawner)
+            self.assertEqual(self._wait(process.pid), 0)
+            self.assertEqual(process.stdout.read().split(),
+                             [os.path.realpath(wdir), 'bar', '100', 'True'])
+            process.stop()
+        finally:
+            os.rmdir(wdir)
+
+    def test_fds(self):
+        sock = socket.socket()
+        try:
+            fd = sock.fileno()
+            code = 'import os, sys; os.fstat(int(sys.argv[1]))'
+            pid, stdout, stderr = self.spawner.spawn(
+                [sys.executable, '-c', code, str(fd)], fds=[fd])
+            self.assertEqual(self._wait(pid), 0)
+
+            # the other fds are not inherited
+            pid, stdout, stderr = self.spawner.spawn(
+                [sys.executable, '-c', code, str(fd)])
+            self.assertEqual(self._wait(pid), 1)
+        finally:
+            sock.close()
+
+    def test_exec_error(self):
+        try:
+            Process('test', 'make-me-a-coffee', spawner=self.spawner)
+        except OSError, e:
+            self.assertEqual(e.errno, errno.ENOENT)
+        else:
+            raise AssertionError('OSError not raised')
+
+        # the spawner is still there
+        process = Process('test', sys.executable, args=['-c', 'pass'],
+                          spawner=self.spawner)
+        self.assertEqual(self._wait(process.pid), 0)
+
+    def test_spawner_restarted(self):
+        self.spawner.start()
+        pid = self.spawner.pid
+        PSProcess(pid).kill()
+        os.waitpid(pid, 0)
+
+        self.assertRaises(OSError, Process, 'test', sys.executable,
+                          args=['-c', 'pass'], spawner=self.spawner)
+
+        process = Process('test', sys.executable, args=['-c', 'pass'],
+                          spawner=self.spawner)
+        self.assertNotEqual(self.spawner.pid, pid)
+        self.assertEqual(self._wait(process.pid), 0)
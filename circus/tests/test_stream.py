@@ -1,16 +1,23 @@
+import errno
 import time
 import sys
 import os
 import tempfile
+import threading
 import unittest
 
 from datetime import datetime
 from cStringIO import StringIO
 
+from mock import patch
+from zmq.eventloop import ioloop
+
 from circus.client import make_message
 from circus.tests.support import TestCircus, poll_for, truncate_file
 from circus.stream import FileStream
 from circus.stream import FancyStdoutStream
+from circus.stream import Redirector, QueueStream, StreamWriter
+from circus.stream import get_stream
 
 
 def run_process(*args, **kw):
@@ -66,6 +73,281 @@ class TestWatcher(TestCircus):
         self.assertTrue(poll_for(self.stderr, 'stderr'))
 
 
+class FakeProcess(object):
+
+    pid = 1234
+
+
+class TestRedirector(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = ioloop.IOLoop()
+        self.received = []
+        self.detached = []
+        self.redirector = Redirector(self.received.append, loop=self.loop,
+                                     on_detach=self._detached)
+        r, w = os.pipe()
+        self.pipe = os.fdopen(r, 'rb', 0)
+        self.writer = w
+
+    def tearDown(self):
+        self.redirector.kill()
+        self.pipe.close()
+        if self.writer is not None:
+            os.close(self.writer)
+        self.loop.close()
+
+    def _detached(self, name, process, reason):
+        self.detached.append((name, process.pid, reason))
+
+    def _run_loop(self, timeout=.1):
+        self.loop.add_timeout(time.time() + timeout, self.loop.stop)
+        self.loop.start()
+
+    def test_read_when_readable(self):
+        process = FakeProcess()
+        self.redirector.add_redirection('stdout', process, self.pipe)
+        self.redirector.start()
+        self.assertTrue(self.pipe.fileno() in self.loop._handlers)
+
+        os.write(self.writer, 'data')
+        self._run_loop()
+        self.assertEqual(self.received, [{'data': 'data', 'pid': 1234,
+                                          'name': 'stdout'}])
+
+        # the pipe is not watched anymore once at its end
+        os.close(self.writer)
+        self.writer = None
+        self._run_loop()
+        self.assertFalse(self.pipe.fileno() in self.loop._handlers)
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.detached, [('stdout', 1234, 'eof')])
+        self.assertEqual(self.redirector.pipes, [])
+
+    def test_drain(self):
+        process = FakeProcess()
+        self.redirector.max_read = 8192
+        self.redirector.add_redirection('stdout', process, self.pipe)
+        self.redirector.start()
+        pipe = self.redirector.pipes[0]
+
+        # the pipe is read until it's empty or max_read is reached, with
+        # a buffer growing as the reads fill it
+        os.write(self.writer, 'x' * 20000)
+        self.redirector._handle_events(pipe.fileno(), ioloop.IOLoop.READ)
+        self.assertEqual(len(self.received), 1)
+        size = len(self.received[0]['data'])
+        self.assertTrue(8192 <= size < 20000)
+        self.assertTrue(pipe.buffer > 1024)
+
+        self._run_loop()
+        self.assertEqual(sum(len(data['data']) for data in self.received),
+                         20000)
+
+    def test_failures(self):
+        process = FakeProcess()
+        self.redirector.add_redirection('stdout', process, self.pipe)
+        self.redirector.start()
+        pipe = self.redirector.pipes[0]
+
+        # a stream that fails doesn't stop the pipe from being read
+        self.redirector.redirect = None
+        os.write(self.writer, 'lost')
+        self.redirector._handle_events(pipe.fileno(), ioloop.IOLoop.READ)
+        self.assertEqual(self.redirector.pipes, [pipe])
+
+        # a pipe that can't be read is detached
+        error = OSError(errno.EBADF, 'Bad file descriptor')
+        with patch.object(pipe, 'read', side_effect=error):
+            self.redirector._handle_events(pipe.fileno(), ioloop.IOLoop.READ)
+        self.assertEqual(self.detached, [('stdout', 1234, 'EBADF')])
+        self.assertEqual(self.redirector.pipes, [])
+        self.assertFalse(self.pipe.fileno() in self.loop._handlers)
+
+    def test_remove_redirection(self):
+        process = FakeProcess()
+        self.redirector.add_redirection('stdout', process, self.pipe)
+        self.redirector.start()
+
+        # what is left in the pipe is read before it's forgotten
+        os.write(self.writer, 'last words')
+        self.redirector.remove_redirection('stdout', process)
+        self.assertEqual(self.received[0]['data'], 'last words')
+        self.assertFalse(self.pipe.fileno() in self.loop._handlers)
+        self.assertEqual(self.redirector.pipes, [])
+
+
+class TestFileStream(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        for suffix in ('', '.1', '.2'):
+            if os.path.exists(self.filename + suffix):
+                os.remove(self.filename + suffix)
+
+    def _read(self, suffix=''):
+        with open(self.filename + suffix) as f:
+            return f.read()
+
+    def test_rollover(self):
+        with open(self.filename, 'w') as f:
+            f.write('12345')
+
+        # the options come as strings from the configuration files
+        stream = FileStream(self.filename, max_bytes='10',
+                            backup_count='2')
+        for data in ('abcd', 'efgh', 'ijkl', 'mnop'):
+            stream({'data': data})
+        stream.close()
+        self.assertEqual(self._read(), 'mnop')
+        self.assertEqual(self._read('.1'), 'efghijkl')
+        self.assertEqual(self._read('.2'), '12345abcd')
+
+    def test_buffering(self):
+        stream = FileStream(self.filename, max_bytes=100, backup_count=1,
+                            flush_size=10)
+        stream({'data': 'abcd'})
+        stream({'data': 'efgh'})
+        self.assertEqual(self._read(), '')
+        stream({'data': 'ijkl'})
+        self.assertEqual(self._read(), 'abcdefghijkl')
+
+        # the buffered data counts for the rollover
+        stream({'data': 'x' * 80})
+        stream({'data': 'y' * 5})
+        stream({'data': 'z' * 5})
+        stream.close()
+        self.assertEqual(self._read(), 'z' * 5)
+        self.assertEqual(self._read('.1'),
+                         'abcdefghijkl' + 'x' * 80 + 'y' * 5)
+
+    def test_flush_interval(self):
+        stream = FileStream(self.filename, flush_size=1024,
+                            flush_interval=.1)
+        stream({'data': 'abcd'})
+        self.assertEqual(self._read(), '')
+        start = time.time()
+        while not self._read() and time.time() - start < 5:
+            time.sleep(.05)
+        self.assertEqual(self._read(), 'abcd')
+        stream.close()
+
+    def test_flush_interval_alone(self):
+        stream = FileStream(self.filename, flush_interval=.1)
+        stream({'data': 'abcd'})
+        stream({'data': 'efgh'})
+        self.assertEqual(self._read(), '')
+        start = time.time()
+        while not self._read() and time.time() - start < 5:
+            time.sleep(.05)
+        self.assertEqual(self._read(), 'abcdefgh')
+        stream.close()
+
+    def test_write_after_close(self):
+        stream = FileStream(self.filename, flush_interval=.1)
+        stream({'data': 'abcd'})
+        stream.close()
+        stream({'data': 'efgh'})
+        stream.flush()
+        stream.close()
+        self.assertEqual(self._read(), 'abcd')
+
+
+class SlowStream(object):
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.received = []
+        self.closed = False
+
+    def __call__(self, data):
+        self.gate.wait()
+        self.received.append(data['data'])
+
+    def close(self):
+        self.closed = True
+
+
+class TestStreamWriter(unittest.TestCase):
+
+    def _fill(self, overflow, **kw):
+        stream = SlowStream()
+        writer = StreamWriter(stream, queue_size=10, overflow=overflow, **kw)
+        writer({'data': 'first'})
+        # wait for the thread to be stuck on the first chunk
+        start = time.time()
+        while not writer._busy and time.time() - start < 5:
+            time.sleep(.01)
+
+        for data in ('01234', '56789', 'abcde', 'fghij'):
+            writer({'data': data})
+        stream.gate.set()
+        writer.close()
+        self.assertTrue(stream.closed)
+        return writer, stream.received
+
+    def test_drop_oldest(self):
+        writer, received = self._fill('drop_oldest')
+        self.assertEqual(received, ['first', 'abcde', 'fghij'])
+        self.assertEqual((writer.dropped, writer.dropped_bytes), (2, 10))
+
+    def test_drop_newest(self):
+        writer, received = self._fill('drop_newest')
+        self.assertEqual(received, ['first', '01234', '56789'])
+        self.assertEqual((writer.dropped, writer.dropped_bytes), (2, 10))
+
+    def test_spill(self):
+        writer, received = self._fill('spill',
+                                      spill_dir=tempfile.gettempdir())
+        # nothing is lost, and the order is kept
+        self.assertEqual(received, ['first', '01234', '56789', 'abcde',
+                                    'fghij'])
+        self.assertEqual(writer.dropped, 0)
+        self.assertEqual(writer.spilled_bytes, 10)
+
+    def test_block(self):
+        stream = SlowStream()
+        writer = StreamWriter(stream, queue_size=10)
+        for data in ('first', '01234', '56789'):
+            writer({'data': data})
+
+        # the next chunk waits for the stream to catch up
+        blocked = threading.Thread(target=writer, args=({'data': 'abcde'},))
+        blocked.start()
+        blocked.join(.1)
+        self.assertTrue(blocked.is_alive())
+        stream.gate.set()
+        blocked.join()
+        writer.flush()
+        self.assertEqual(stream.received, ['first', '01234', '56789',
+                                           'abcde'])
+        writer.close()
+
+    def test_get_stream(self):
+        stream = get_stream({'class': 'StdoutStream', 'queue_size': '1024',
+                             'overflow': 'drop_newest'})['stream']
+        self.assertTrue(isinstance(stream, StreamWriter))
+        self.assertEqual(stream.queue_size, 1024)
+        self.assertEqual(stream.overflow, 'drop_newest')
+        stream.close()
+
+    def test_bounded_queue_stream(self):
+        queue = QueueStream(maxsize=2, overflow='drop_oldest')
+        for data in ('a', 'b', 'c'):
+            queue({'data': data})
+        self.assertEqual([queue.get()['data'] for i in range(2)], ['b', 'c'])
+        self.assertEqual(queue.dropped_bytes, 1)
+
+        queue = QueueStream(maxsize=2, overflow='drop_newest')
+        for data in ('a', 'b', 'c'):
+            queue({'data': data})
+        self.assertEqual([queue.get()['data'] for i in range(2)], ['a', 'b'])
+        self.assertEqual(queue.dropped, 1)
+
+
 class TestFancyStdoutStream(unittest.TestCase):
 
     def color_start(self, code):
@@ -6,7 +6,8 @@ from psutil import Popen
 
 from circus.util import (get_info, bytes2human, to_bool, parse_env_str,
                          env_to_str, to_uid, to_gid, replace_gnu_args,
-                         StrictConfigParser)
+                         StrictConfigParser, Histogram, get_socket_names,
+                         ProcessTree, get_process_tree, reset_process_tree)
 
 
 class TestUtil(unittest.TestCase):
@@ -110,7 +111,46 @@ class TestUtil(unittest.TestCase):
                           repl('thats an int $(me)', prefix=None,
                           me=2))
 
+    def test_get_socket_names(self):
+        self.assertEqual(get_socket_names('serve $(circus.wid)', None), set())
+        self.assertEqual(
+            get_socket_names('serve --fd $(CIRCUS.SOCKETS.Web)',
+                             ['--admin', '$(circus.sockets.admin)']),
+            set(['web', 'admin']))
+
+    def test_process_tree(self):
+        worker = Popen(["python -c 'import time;time.sleep(5)'"], shell=True)
+        try:
+            tree = ProcessTree()
+            self.assertTrue(worker.pid in tree.get_children(os.getpid()))
+            self.assertTrue(os.getpid() in tree.get_children(os.getppid()))
+            self.assertEqual(tree.get_session(worker.pid), os.getsid(0))
+        finally:
+            worker.terminate()
+            worker.wait()
+
+        # the snapshot is shared until it's reset or too old
+        reset_process_tree()
+        tree = get_process_tree()
+        self.assertTrue(get_process_tree() is tree)
+        self.assertFalse(get_process_tree(max_age=-1) is tree)
+        tree = get_process_tree()
+        reset_process_tree()
+        self.assertFalse(get_process_tree() is tree)
+
     def test_strict_parser(self):
         cp = StrictConfigParser()
         bad_ini = os.path.join(os.path.dirname(__file__), 'bad.ini')
         self.assertRaises(ValueError, cp.read, bad_ini)
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for duration in (0.0005, 0.002, 0.002, 7.):
+            histogram.add(duration)
+
+        data = histogram.to_dict()
+        self.assertEqual(data['count'], 4)
+        self.assertEqual(data['max'], 7.)
+        self.assertEqual(data['buckets']['1ms'], 1)
+        self.assertEqual(data['buckets']['5ms'], 2)
+        self.assertEqual(data['buckets']['inf'], 1)
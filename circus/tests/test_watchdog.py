@@ -0,0 +1,62 @@
+from thread import get_ident
+import time
+import unittest
+
+from mock import patch
+
+from circus.watchdog import LoopWatchdog
+
+
+class FakeController(object):
+    probe_deadline = None
+
+
+class TestLoopWatchdog(unittest.TestCase):
+
+    def test_stall(self):
+        controller = FakeController()
+        watchdog = LoopWatchdog(controller, .1, get_ident())
+
+        with patch('circus.watchdog.logger') as logger:
+            watchdog.check()
+            controller.probe_deadline = time.time() + 1
+            watchdog.check()
+            self.assertFalse(logger.warning.called)
+
+            controller.probe_deadline = time.time() - 1
+            watchdog.check()
+            self.assertEqual(logger.warning.call_count, 1)
+            self.assertTrue('test_stall' in logger.warning.call_args[0][2])
+
+            # a stall is reported once
+            watchdog.check()
+            self.assertEqual(logger.warning.call_count, 1)
+
+    def test_thread(self):
+        controller = FakeController()
+        watchdog = LoopWatchdog(controller, .05, get_ident())
+        controller.probe_deadline = time.time() - 1
+
+        with patch('circus.watchdog.logger') as logger:
+            watchdog.start()
+            try:
+                start = time.time()
+                while not logger.warning.called and time.time() - start < 5:
+                    time.sleep(.01)
+            finally:
+                watchdog.stop()
+                watchdog.join()
+
+        self.assertTrue(logger.warning.called)
+
+    def test_stop(self):
+        watchdog = LoopWatchdog(FakeController(), .05, get_ident())
+        # like Python 2.6, where Event.wait returns None
+        wait = watchdog._stopped.wait
+        with patch.object(watchdog._stopped, 'wait',
+                          side_effect=lambda timeout: wait(timeout) and None):
+            watchdog.start()
+            watchdog.stop()
+            watchdog.join(5)
+
+        self.assertFalse(watchdog.is_alive())
@@ -1,14 +1,18 @@
+import errno
 import signal
 import sys
 import os
 import threading
+import time
 
+from mock import patch
 from zmq.eventloop import ioloop
 
 from circus.tests.support import TestCircus, poll_for, truncate_file
 from circus.stream import QueueStream
 from circus.watcher import Watcher
 from circus.process import UNEXISTING
+from circus.util import ProcessTree, reset_process_tree
 
 
 class TestWatcher(TestCircus):
@@ -145,6 +149,30 @@ class TestWatcherInitialization(TestCircus):
         data = ''.join(data)
         self.assertTrue('XYZ' in data, data)
 
+    def test_spawn_spec(self):
+        watcher = Watcher("foo", "serve $(circus.numprocesses) $(circus.wid)")
+        spec = watcher._get_spawn_spec()
+        self.assertTrue(watcher._get_spawn_spec() is spec)
+        self.assertEqual(spec.format_args(3), ['serve', '1', '3'])
+
+        # the spec is computed again once an option changes
+        watcher.set_opt('numprocesses', 2)
+        spec = watcher._get_spawn_spec()
+        self.assertEqual(spec.format_args(3), ['serve', '2', '3'])
+
+        watcher.initialize(None, {}, None)
+        self.assertFalse(watcher._get_spawn_spec() is spec)
+
+    def test_orphan_policy(self):
+        self.assertRaises(ValueError, Watcher, "foo", "foobar",
+                          orphan_policy="adopt")
+        watcher = Watcher("foo", "foobar")
+        watcher.set_opt('orphan_policy', 'kill')
+        self.assertEqual(watcher.orphan_policy, 'kill')
+        self.assertRaises(ValueError, watcher.set_opt, 'orphan_policy',
+                          'adopt')
+        self.assertEqual(watcher.orphan_policy, 'kill')
+
 
 class SomeWatcher(threading.Thread):
 
@@ -284,6 +312,168 @@ def oneshot_process(test_file):
     pass
 
 
+def stubborn_process(test_file):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    with open(test_file, 'a+') as f:
+        f.write('START')
+    while True:
+        time.sleep(.1)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+        return False
+    return True
+
+
+class StopTest(TestCircus):
+
+    def test_stop_does_not_block(self):
+        stubborn_process = 'circus.tests.test_watcher.stubborn_process'
+        testfile, arbiter = self._create_circus(stubborn_process,
+                                                graceful_timeout=1)
+        try:
+            self.assertTrue(poll_for(testfile, 'START'))
+            pid = self.call('list', name='test')['pids'][0]
+
+            start = time.time()
+            self.call('stop', name='test')
+            self.assertEqual(self.call('status', name='test')['status'],
+                             'stopped')
+            # the arbiter keeps answering while the process is stopping
+            self.assertEqual(self.call('list')['status'], 'ok')
+            self.assertTrue(time.time() - start < 1)
+            self.assertTrue(_is_running(pid))
+
+            # SIGTERM is ignored, so it gets killed after graceful_timeout
+            while _is_running(pid) and time.time() - start < 5:
+                time.sleep(.1)
+            self.assertFalse(_is_running(pid))
+            self.assertTrue(time.time() - start >= 1)
+        finally:
+            arbiter.stop()
+
+
+class StopStartTest(TestCircus):
+
+    def test_start_while_stopping(self):
+        watcher = Watcher('test', 'sleep 10', stopped=False)
+        watcher.spawn_processes()
+        watcher.evpub_socket = object()
+        events = []
+        stopped = []
+
+        with patch.object(watcher, 'notify_event',
+                          side_effect=lambda topic, msg: events.append(topic)):
+            with patch.object(watcher.loop, 'running', return_value=True):
+                watcher.stop(callback=lambda: stopped.append(True))
+                self.assertTrue(watcher.start())
+
+            # nothing starts before the old processes are gone
+            self.assertEqual(len(watcher.processes), 0)
+            self.assertFalse(stopped)
+            start = time.time()
+            while watcher._stop_pending and time.time() - start < 5:
+                watcher._check_stopping()
+                time.sleep(.1)
+
+        try:
+            self.assertEqual(stopped, [True])
+            self.assertEqual([e for e in events if e in ('stop', 'start')],
+                             ['stop', 'start'])
+            self.assertFalse(watcher.stopped)
+            self.assertEqual(len(watcher.processes), 1)
+        finally:
+            watcher.evpub_socket = None
+            watcher.stop()
+
+
+class KillTest(TestCircus):
+
+    def test_stop_waits_for_killed_processes(self):
+        code = ('import signal, sys, time\n'
+                'signal.signal(signal.SIGTERM, signal.SIG_IGN)\n'
+                'print "ready"\n'
+                'sys.stdout.flush()\n'
+                'while True: time.sleep(.1)\n')
+        watcher = Watcher('test', sys.executable, args=['-c', code],
+                          graceful_timeout=0, stopped=False)
+        process = watcher.spawn_process()
+        process.stdout.readline()
+        stopped = []
+
+        with patch.object(watcher.loop, 'running', return_value=True):
+            watcher.stop(callback=lambda: stopped.append(True))
+        watcher._check_stopping()
+
+        # the SIGKILL is sent, but the stop waits for the process to exit
+        self.assertTrue(process.pid in watcher._stopping)
+        self.assertFalse(stopped)
+        start = time.time()
+        while watcher._stopping and time.time() - start < 5:
+            time.sleep(.1)
+            watcher._check_stopping()
+        self.assertEqual(stopped, [True])
+        self.assertEqual(process.returncode, -signal.SIGKILL)
+
+
+class ProcessTreeTest(TestCircus):
+
+    def test_stop_reads_the_tree_once(self):
+        watcher = Watcher('test', 'sleep 10', numprocesses=5, stopped=False)
+        watcher.spawn_processes()
+        self.assertEqual(len(watcher.processes), 5)
+
+        reset_process_tree()
+        with patch.object(ProcessTree, '_read_stats',
+                          side_effect=ProcessTree._read_stats,
+                          autospec=True) as read_stats:
+            watcher.stop()
+
+        self.assertEqual(len(watcher.processes), 0)
+        self.assertEqual(read_stats.call_count, 1)
+
+
+class KillpgTest(TestCircus):
+
+    def test_stop_signals_the_group(self):
+        watcher = Watcher('test', 'sh -c "sleep 10 & sleep 10 & wait"',
+                          use_killpg=True, stopped=False)
+        watcher.spawn_processes()
+        process = watcher.processes.values()[0]
+        start = time.time()
+        while len(process.children()) < 2 and time.time() - start < 5:
+            time.sleep(.1)
+            reset_process_tree()
+        children = process.children()
+        self.assertEqual(len(children), 2)
+
+        with patch.object(process, 'send_signal_child') as send_signal_child:
+            watcher.stop()
+
+        # the children got the signal with the process, not one by one
+        self.assertFalse(send_signal_child.called)
+        self.assertEqual(len(watcher.processes), 0)
+        start = time.time()
+        while (any(_is_running(pid) for pid in children) and
+               time.time() - start < 5):
+            time.sleep(.1)
+            for pid in children:
+                # the test runner is their subreaper once an arbiter ran
+                # in it
+                try:
+                    os.waitpid(pid, os.WNOHANG)
+                except OSError as e:
+                    if e.errno != errno.ECHILD:
+                        raise
+        for pid in children:
+            self.assertFalse(_is_running(pid))
+
+
 class RespawnTest(TestCircus):
     def test_not_respawning(self):
         oneshot_process = 'circus.tests.test_watcher.oneshot_process'
@@ -295,6 +485,13 @@ class RespawnTest(TestCircus):
             resp = self.call("numprocesses", name="test")
             self.assertEquals(resp['numprocesses'], 1)
 
+            # wait for the process to exit: only the processes that exited
+            # are reaped
+            start = time.time()
+            while ([p for p in watcher.processes.values()
+                    if p.poll() is None] and time.time() - start < 5):
+                time.sleep(.1)
+
             # let's reap processes and explicitely ask for process management
             watcher.reap_and_manage_processes()
 
@@ -307,3 +504,190 @@ class RespawnTest(TestCircus):
             self.assertEquals(len(watcher.processes), 1)
         finally:
             arbiter.stop()
+
+
+class WarmupDelayTest(TestCircus):
+
+    def test_spawns_are_paced(self):
+        watcher = Watcher('test', 'foo', numprocesses=3, warmup_delay=10,
+                          stopped=False)
+
+        def spawn_process():
+            pid = len(watcher.processes) + 1
+            watcher.processes[pid] = pid
+
+        watcher.spawn_process = spawn_process
+
+        with patch.object(watcher.loop, 'add_timeout') as add_timeout:
+            # a single process is spawned, the next one is scheduled
+            watcher.spawn_processes()
+            self.assertEqual(len(watcher.processes), 1)
+            deadline, spawn_next = add_timeout.call_args[0]
+            self.assertTrue(deadline > time.time() + 9)
+
+            # the pending spawn isn't scheduled twice
+            watcher.spawn_processes()
+            self.assertEqual(len(watcher.processes), 1)
+            self.assertEqual(add_timeout.call_count, 1)
+
+            spawn_next()
+            self.assertEqual(len(watcher.processes), 2)
+            self.assertEqual(add_timeout.call_count, 2)
+
+            spawn_next()
+            self.assertEqual(len(watcher.processes), 3)
+            self.assertEqual(add_timeout.call_count, 2)
+
+    def test_after_start_once_spawned(self):
+        spawned = []
+
+        def after_start(watcher, arbiter, hook_name):
+            spawned.append(len(watcher.processes))
+            return True
+
+        watcher = Watcher('test', 'foo', numprocesses=3, warmup_delay=10,
+                          hooks={'after_start': (after_start, False)})
+
+        def spawn_process():
+            pid = len(watcher.processes) + 1
+            watcher.processes[pid] = pid
+
+        watcher.spawn_process = spawn_process
+
+        with patch.object(watcher.loop, 'add_timeout') as add_timeout:
+            self.assertTrue(watcher.start())
+            self.assertEqual(spawned, [])
+            spawn_next = add_timeout.call_args[0][1]
+            spawn_next()
+            self.assertEqual(spawned, [])
+            spawn_next()
+
+        # the hook ran once, with all the processes
+        self.assertEqual(spawned, [3])
+
+
+class FakeProcess(object):
+
+    status = None
+    returncode = None
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def poll(self):
+        return self.returncode
+
+    def release_psutil(self):
+        pass
+
+    def __lt__(self, other):
+        return self.pid < other.pid
+
+
+class FakeForkServer(object):
+
+    ready = False
+
+    def __init__(self):
+        self.callbacks = []
+
+    def when_ready(self, callback):
+        if callback not in self.callbacks:
+            self.callbacks.append(callback)
+
+    def set_ready(self):
+        self.ready = True
+        for callback in self.callbacks:
+            callback()
+
+
+class RollingReloadTest(TestCircus):
+
+    def _make_watcher(self, numprocesses=4):
+        watcher = Watcher('test', 'foo', numprocesses=numprocesses,
+                          reload_batch_size=2, reload_settle_time=10,
+                          stopped=False)
+        watcher.notify_event = lambda topic, msg: None
+        pids = iter(range(1, 100))
+
+        def spawn_process():
+            process = FakeProcess(pids.next())
+            watcher.processes[process.pid] = process
+            return process
+
+        def terminate_process(process):
+            watcher.processes.pop(process.pid)
+
+        watcher.spawn_process = spawn_process
+        watcher.terminate_process = terminate_process
+        for i in range(numprocesses):
+            spawn_process()
+        return watcher
+
+    def test_batches(self):
+        watcher = self._make_watcher()
+        reloaded = []
+
+        with patch.object(watcher.loop, 'add_timeout') as add_timeout:
+            watcher.reload(callback=lambda: reloaded.append(True))
+
+            # the first batch runs alongside the old processes
+            self.assertEqual(sorted(watcher.processes), [1, 2, 3, 4, 5, 6])
+            deadline, check = add_timeout.call_args[0]
+            self.assertTrue(deadline > time.time() + 9)
+
+            # the processes of the batch are kept by the checks
+            watcher._terminate_extra_processes()
+            self.assertEqual(len(watcher.processes), 6)
+
+            check()
+            self.assertEqual(sorted(watcher.processes), [3, 4, 5, 6, 7, 8])
+            self.assertEqual(reloaded, [])
+
+            check = add_timeout.call_args[0][1]
+            check()
+            self.assertEqual(sorted(watcher.processes), [5, 6, 7, 8])
+            self.assertEqual(reloaded, [True])
+            self.assertEqual(add_timeout.call_count, 2)
+
+    def test_batches_wait_for_the_template(self):
+        watcher = self._make_watcher()
+        watcher.preload = 'circus.tests.support'
+        forkserver = FakeForkServer()
+        watcher._get_forkserver = lambda: forkserver
+        watcher._retire_forkserver = lambda: None
+
+        with patch.object(watcher.loop, 'add_timeout') as add_timeout:
+            watcher.reload()
+
+            # nothing is spawned before the template is ready
+            self.assertEqual(sorted(watcher.processes), [1, 2, 3, 4])
+            self.assertFalse(add_timeout.called)
+
+            forkserver.set_ready()
+            self.assertEqual(sorted(watcher.processes), [1, 2, 3, 4, 5, 6])
+            self.assertEqual(add_timeout.call_count, 1)
+
+    def test_failed_batch(self):
+        watcher = self._make_watcher()
+
+        with patch.object(watcher.loop, 'add_timeout') as add_timeout:
+            watcher.reload()
+            check = add_timeout.call_args[0][1]
+            watcher.processes[6].status = UNEXISTING
+            check()
+
+        # the old processes are kept, and the reload is over
+        self.assertEqual(sorted(watcher.processes), [1, 2, 3, 4])
+        self.assertEqual(watcher._rolling, None)
+        self.assertEqual(add_timeout.call_count, 1)
+
+    def test_failed_hook(self):
+        watcher = self._make_watcher()
+        watcher.hooks['after_reload_batch'] = lambda **kw: False
+
+        with patch.object(watcher.loop, 'add_timeout') as add_timeout:
+            watcher.reload()
+            add_timeout.call_args[0][1]()
+
+        self.assertEqual(sorted(watcher.processes), [1, 2, 3, 4])
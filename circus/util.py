@@ -1,3 +1,4 @@
+from bisect import bisect_left
 import logging
 from datetime import timedelta
 import grp
@@ -14,7 +15,7 @@ from ConfigParser import (ConfigParser, MissingSectionHeaderError,
                           ParsingError, DEFAULTSECT)
 
 from psutil.error import AccessDenied, NoSuchProcess
-from psutil import Process
+from psutil import Process, process_iter
 
 
 # default endpoints
@@ -210,6 +211,74 @@ def get_info(process=None, interval=0, with_childs=False):
     return info
 
 
+class ProcessTree(object):
+    """A snapshot of the parent to children tree of all the processes,
+    and of their sessions, read in one pass over /proc, or with psutil
+    where there's no /proc.
+    """
+    def __init__(self):
+        self.created = time.time()
+        self._children = {}
+        self._sessions = {}
+        for pid, ppid, session in self._read_stats():
+            self._children.setdefault(ppid, []).append(pid)
+            self._sessions[pid] = session
+
+    def _read_stats(self):
+        if not os.path.exists('/proc/self/stat'):
+            for process in process_iter():
+                try:
+                    yield process.pid, process.ppid, os.getsid(process.pid)
+                except (NoSuchProcess, AccessDenied, OSError):
+                    pass
+            return
+
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                with open('/proc/%s/stat' % name) as f:
+                    stat = f.read()
+            except IOError:
+                # the process is gone
+                continue
+            # the name of the command is between parens, and can contain
+            # anything: the parent pid is the second field after it, and
+            # the session the fourth
+            fields = stat.rsplit(')', 1)[1].split()
+            yield int(name), int(fields[1]), int(fields[3])
+
+    def get_children(self, pid):
+        """Return the pids of the children of *pid*."""
+        return list(self._children.get(pid, ()))
+
+    def get_session(self, pid):
+        """Return the session id of *pid*, or None if it's not in the
+        snapshot."""
+        return self._sessions.get(pid)
+
+
+_TREE = None
+
+
+def get_process_tree(max_age=1.):
+    """Return the :class:`ProcessTree` snapshot shared by the callers until
+    :func:`reset_process_tree` is called, or until it's older than
+    *max_age* seconds.
+    """
+    global _TREE
+    if _TREE is None or time.time() - _TREE.created > max_age:
+        _TREE = ProcessTree()
+    return _TREE
+
+
+def reset_process_tree():
+    """Drop the snapshot of the process tree: the arbiter calls it on each
+    check and each command, so they get their own."""
+    global _TREE
+    _TREE = None
+
+
 def to_bool(s):
     if isinstance(s, bool):
         return s
@@ -296,6 +365,50 @@ def close_on_exec(fd):
     fcntl.fcntl(fd, fcntl.F_SETFD, flags)
 
 
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    flags |= os.O_NONBLOCK
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+
+def close_fds_on_exec(keep=()):
+    """Mark the fds of this process, but 0, 1, 2 and the ones in *keep*,
+    close-on-exec.
+
+    The open fds are listed in /proc/self/fd, instead of trying every fd
+    up to the RLIMIT_NOFILE limit like :mod:`subprocess` does.
+    """
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = range(3, os.sysconf('SC_OPEN_MAX'))
+
+    for fd in fds:
+        if fd > 2 and fd not in keep:
+            try:
+                close_on_exec(fd)
+            except IOError:
+                # not open, e.g. the fd used to list the others
+                pass
+
+
+PR_SET_CHILD_SUBREAPER = 36
+
+
+def set_child_subreaper():
+    """Make the orphaned descendants of this process its children,
+    instead of the children of init.
+
+    Returns False if the system doesn't support it (Linux < 3.4).
+    """
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+    except (ImportError, OSError, AttributeError, MemoryError):
+        return False
+
+
 INDENTATION_LEVEL = 0
 
 
@@ -334,6 +447,31 @@ def convert_opt(key, val):
     return val
 
 
+class Histogram(object):
+    """Counts durations, in seconds, in buckets of increasing size.
+
+    Each bucket is named after its upper bound in milliseconds.
+    """
+    bounds = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+    def __init__(self):
+        self.count = 0
+        self.total = self.max = 0.
+        self.buckets = [0] * (len(self.bounds) + 1)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.buckets[bisect_left(self.bounds, duration * 1000)] += 1
+
+    def to_dict(self):
+        names = ['%dms' % bound for bound in self.bounds] + ['inf']
+        mean = self.count and self.total / self.count
+        return {'count': self.count, 'mean': mean, 'max': self.max,
+                'buckets': dict(zip(names, self.buckets))}
+
+
 # taken from werkzeug
 class ImportStringError(ImportError):
     """Provides information about a failed :func:`import_string` attempt."""
@@ -422,6 +560,22 @@ def resolve_name(import_name, silent=False):
 
 
 _CIRCUS_VAR = re.compile(r'\$\(circus\.([\w\.]+)\)', re.I)
+_SOCKET_VAR = re.compile(r'\$\(circus\.sockets\.([\w\.]+)\)', re.I)
+
+
+def get_socket_names(*values):
+    """Return the names of the sockets used in the
+    *$(circus.sockets.NAME)* variables of *values*, lowercased. Each value
+    is a string or a list of strings."""
+    names = set()
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, basestring):
+            value = [value]
+        for item in value:
+            names.update(name.lower() for name in _SOCKET_VAR.findall(item))
+    return names
 
 
 def replace_gnu_args(data, prefix='circus', **options):
@@ -0,0 +1,50 @@
+import sys
+from threading import Thread, Event
+import time
+import traceback
+
+from circus import logger
+
+
+class LoopWatchdog(Thread):
+    """Thread checking that the loop of a :class:`Controller` keeps
+    running its callbacks.
+
+    When the loop lag probe is more than *timeout* seconds late, the
+    stack of the thread running the loop is logged, once per stall.
+    """
+    def __init__(self, controller, timeout, loop_ident):
+        Thread.__init__(self, name='circus-watchdog')
+        self.daemon = True
+        self.controller = controller
+        self.timeout = timeout
+        self.loop_ident = loop_ident
+        self._stopped = Event()
+        self._reported = None
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        # Event.wait returns None before Python 2.7
+        while not self._stopped.is_set():
+            self._stopped.wait(self.timeout / 2.)
+            if not self._stopped.is_set():
+                self.check()
+
+    def check(self):
+        deadline = self.controller.probe_deadline
+        if deadline is None or deadline == self._reported:
+            return
+
+        stall = time.time() - deadline
+        if stall <= self.timeout:
+            return
+
+        self._reported = deadline
+        frame = sys._current_frames().get(self.loop_ident)
+        if frame is None:
+            return
+
+        stack = ''.join(traceback.format_stack(frame))
+        logger.warning('The loop is stalled for %.2fs:\n%s', stall, stack)
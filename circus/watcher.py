@@ -10,10 +10,12 @@ from psutil import NoSuchProcess
 from zmq.utils.jsonapi import jsonmod as json
 from zmq.eventloop import ioloop
 
-from circus.process import Process, DEAD_OR_ZOMBIE, UNEXISTING
+from circus.forkserver import ForkServer
+from circus.process import Process, ForkedProcess, SpawnSpec, UNEXISTING
 from circus import logger
 from circus import util
 from circus.stream import get_pipe_redirector, get_stream
+from circus.py3compat import string_types
 from circus.util import parse_env_dict, resolve_name
 
 
@@ -65,13 +67,17 @@ class Watcher(object):
       - **class**: the stream class. Defaults to
         `circus.stream.FileStream`
       - **filename**: the filename, if using a FileStream
-      - **refresh_time**: the delay between two stream checks. Defaults
-        to 0.3 seconds.
+      - **refresh_time**: not used anymore, the pipes are read as soon
+        as they have data.
       - **max_bytes**: maximum file size, after which a new output file is
         opened. defaults to 0 which means no maximum size.
       - **backup_count**: how many backups to retain when rotating files
         according to the max_bytes parameter. defaults to 0 which means
         no backups are made.
+      - **flush_size**, **flush_interval**: with a FileStream, the output
+        is kept in memory until *flush_size* bytes are waiting, or for up
+        to *flush_interval* seconds. Defaults to 0, the output is written
+        as it comes.
 
       This mapping will be used to create a stream callable of the specified
       class.
@@ -88,13 +94,17 @@ class Watcher(object):
       three keys:
       - **class**: the stream class. Defaults to `circus.stream.FileStream`
       - **filename**: the filename, if using a FileStream
-      - **refresh_time**: the delay between two stream checks. Defaults
-        to 0.3 seconds.
+      - **refresh_time**: not used anymore, the pipes are read as soon
+        as they have data.
       - **max_bytes**: maximum file size, after which a new output file is
         opened. defaults to 0 which means no maximum size.
       - **backup_count**: how many backups to retain when rotating files
         according to the max_bytes parameter. defaults to 0 which means
         no backups are made.
+      - **flush_size**, **flush_interval**: with a FileStream, the output
+        is kept in memory until *flush_size* bytes are waiting, or for up
+        to *flush_interval* seconds. Defaults to 0, the output is written
+        as it comes.
 
       This mapping will be used to create a stream callable of the specified
       class.
@@ -114,8 +124,9 @@ class Watcher(object):
       (default:False)
 
     - **use_sockets** -- If True, the processes will inherit the file
-      descriptors, thus can reuse the sockets opened by circusd.
-      (default: False)
+      descriptors of the sockets opened by circusd, thus can reuse them.
+      Only the sockets used in **cmd** and **args** are inherited, unless
+      they use none. (default: False)
 
     - **on_demand** -- If True, the processes will be started only
       at the first connection to the socket
@@ -136,13 +147,48 @@ class Watcher(object):
       same time.  A process will live between max_age and
       max_age + max_age_variance seconds.
 
+    - **reload_batch_size**: If set, the reloads replace the processes
+      *reload_batch_size* at a time. The old processes of a batch are
+      stopped once the new ones ran for *reload_settle_time* seconds. If
+      one of them died by then, the reload is aborted: the new processes
+      of the batch are stopped and the old ones keep running. With
+      **send_hup**, the processes are sent the HUP signal in batches the
+      same way. (default: 0, all the processes are replaced at once)
+
+    - **reload_settle_time**: The time the processes of a batch must run
+      before the reload moves on to the next batch. (default: 1)
+
+    - **preload**: a list of Python modules, or a string listing them
+      separated by spaces or commas. If set, a template process imports
+      them once and the processes are forked from it, instead of being
+      executed. **cmd** is then the dotted name of the callable the
+      processes run, called with **args** as arguments. The processes
+      inherit the working dir, the user, the rlimits and the output of
+      the template, which is replaced by a new one on reload.
+      (default: None)
+
+    - **preload_timeout**: the number of seconds the template has to
+      import the **preload** modules, then to fork a process. The
+      processes are spawned once it's done, the loop doesn't wait for it.
+      (default: 30)
+
+    - **use_killpg**: If True, the signals that stop or reload the
+      processes are sent to their process group with :func:`os.killpg`,
+      so they reach all their descendants at once, instead of being sent
+      to the processes and their children one by one. (default: False)
+
+    - **orphan_policy**: what becomes of the descendants a process leaves
+      behind when it exits. They are reparented to circusd, where the
+      system supports it. "reap": they keep running, and are reaped when
+      they exit. "kill": they are killed right away. (default: "reap")
+
     - **hooks**: callback functions for hooking into the watcher startup
       and shutdown process. **hooks** is a dict where each key is the hook
       name and each value is a 2-tuple with the name of the callable
       or the callabled itself and a boolean flag indicating if an
       exception occuring in the hook should not be ignored.
       Possible values for the hook name: *before_start*, *after_start*,
-      *before_stop*, *after_stop*.
+      *before_stop*, *after_stop*, *after_reload_batch*.
 
     - **options** -- extra options for the worker. All options
       found in the configuration file for instance, are passed
@@ -152,6 +198,14 @@ class Watcher(object):
     - **respawn** -- If set to False, the processes handled by a watcher will
       not be respawned automatically. (default: True)
     """
+
+    # delay between two checks of the processes being stopped
+    stop_check_delay = .1
+
+    # how long a process that got a SIGKILL is waited for, before it's
+    # forgotten
+    kill_grace_period = 5.
+
     def __init__(self, name, cmd, args=None, numprocesses=1, warmup_delay=0.,
                  working_dir=None, shell=False, uid=None, max_retry=5,
                  gid=None, send_hup=False, env=None, stopped=True,
@@ -160,7 +214,10 @@ class Watcher(object):
                  stderr_stream=None, priority=0, loop=None,
                  singleton=False, use_sockets=False, copy_env=False,
                  copy_path=False, max_age=0, max_age_variance=30,
-                 hooks=None, respawn=True, autostart=True, on_demand=False, **options):
+                 hooks=None, respawn=True, autostart=True, on_demand=False,
+                 reload_batch_size=0, reload_settle_time=1., preload=None,
+                 preload_timeout=30., use_killpg=False, orphan_policy='reap',
+                 **options):
         self.name = name
         self.use_sockets = use_sockets
         self.on_demand = on_demand
@@ -187,6 +244,12 @@ class Watcher(object):
         self.copy_path = copy_path
         self.max_age = int(max_age)
         self.max_age_variance = int(max_age_variance)
+        self.reload_batch_size = int(reload_batch_size)
+        self.reload_settle_time = float(reload_settle_time)
+        self.preload = preload
+        self.preload_timeout = float(preload_timeout)
+        self.use_killpg = use_killpg
+        self.orphan_policy = orphan_policy
         self.ignore_hook_failure = ['before_stop', 'after_stop']
         self.hooks = self._resolve_hooks(hooks)
         self.respawn = respawn
@@ -197,12 +260,18 @@ class Watcher(object):
             raise ValueError("Cannot have %d processes with a singleton "
                              " watcher" % self.numprocesses)
 
+        if orphan_policy not in ('reap', 'kill'):
+            raise ValueError("Unknown orphan policy %r" % orphan_policy)
+
         self.optnames = (("numprocesses", "warmup_delay", "working_dir",
                           "uid", "gid", "send_hup", "shell", "env",
                           "max_retry", "cmd", "args", "graceful_timeout",
                           "executable", "use_sockets", "priority", "copy_env",
                           "singleton", "stdout_stream_conf", "on_demand",
-                          "stderr_stream_conf", "max_age", "max_age_variance")
+                          "stderr_stream_conf", "max_age", "max_age_variance",
+                          "reload_batch_size", "reload_settle_time",
+                          "preload", "preload_timeout", "use_killpg",
+                          "orphan_policy")
                          + tuple(options.keys()))
 
         if not working_dir:
@@ -233,13 +302,45 @@ class Watcher(object):
         self.sockets = self.evpub_socket = None
         self.arbiter = None
 
+        # processes that were asked to stop, mapped to the time after
+        # which they get a SIGKILL
+        self._stopping = {}
+        self._stop_checker = None
+        self._stop_pending = False
+        self._stop_callbacks = []
+
+        # number of running processes to replace by new ones, and the
+        # timeout of the next spawn when they are paced by warmup_delay
+        self._replacements = 0
+        self._spawn_timeout = None
+        # the watcher is starting, but its processes are still spawning
+        self._start_pending = False
+
+        # state of the rolling reload: the processes left to replace, the
+        # processes of the current batch and the timeout of its check
+        self._rolling = None
+        self._rolling_batch = []
+        self._rolling_timeout = None
+
+        # the fork servers running the templates of a preload watcher: the
+        # last one forks the new processes unless it's retired. The number
+        # of templates in a row that failed to import the code.
+        self._forkservers = []
+        self._template_failures = 0
+
+        # the spawn spec of the processes and the fds of the sockets,
+        # computed on the first spawn and dropped when they change
+        self._spawn_spec = None
+        self._sockets_fds = None
+
     def _create_redirectors(self):
         if self.stdout_stream:
             if (self.stdout_redirector is not None and
                     self.stdout_redirector.running):
                 self.stdout_redirector.kill()
             self.stdout_redirector = get_pipe_redirector(
-                self.stdout_stream, loop=self.loop)
+                self.stdout_stream, loop=self.loop,
+                on_detach=self._pipe_detached)
         else:
             self.stdout_redirector = None
 
@@ -249,7 +350,8 @@ class Watcher(object):
                 self.stderr_redirector.kill()
 
             self.stderr_redirector = get_pipe_redirector(
-                self.stderr_stream, loop=self.loop)
+                self.stderr_stream, loop=self.loop,
+                on_detach=self._pipe_detached)
         else:
             self.stderr_redirector = None
 
@@ -298,10 +400,21 @@ class Watcher(object):
         self.evpub_socket = evpub_socket
         self.sockets = sockets
         self.arbiter = arbiter
+        self._reset_spawn_spec()
 
     def __len__(self):
         return len(self.processes)
 
+    def _add_process(self, process):
+        self.processes[process.pid] = process
+        if self.arbiter is not None:
+            self.arbiter.register_process(self, process)
+
+    def _pop_process(self, pid, *default):
+        if self.arbiter is not None:
+            self.arbiter.unregister_process(pid)
+        return self.processes.pop(pid, *default)
+
     def notify_event(self, topic, msg):
         """Publish a message on the event publisher channel"""
 
@@ -321,53 +434,44 @@ class Watcher(object):
 
     @util.debuglog
     def reap_process(self, pid, status=None):
-        """ensure that the process is killed (and not a zombie)"""
-        process = self.processes.pop(pid)
+        """Forget a process that exited.
 
-        if not status:
-            while True:
-                try:
-                    _, status = os.waitpid(pid, os.WNOHANG)
-                except OSError as e:
-                    if e.errno == errno.EAGAIN:
-                        time.sleep(0.001)
-                        continue
-                    elif e.errno == errno.ECHILD:
-                        # nothing to do here, we do not have any child
-                        # process running
-                        return
-                    else:
-                        raise
-
-        # get return code
-        if os.WIFSIGNALED(status):
-            os.WTERMSIG(status)
-        # process exited using exit(2) system call; return the
-        # integer exit(2) system call has been called with
-        elif os.WIFEXITED(status):
-            os.WEXITSTATUS(status)
+        *status* is its exit status, when circusd already waited for it.
+        """
+        if pid in self._stopping:
+            process = self._stopping.pop(pid)[0]
+            if self.arbiter is not None:
+                self.arbiter.unregister_process(pid)
         else:
-            # should never happen
-            raise RuntimeError("Unknown process exit status")
+            process = self._pop_process(pid, None)
+
+        if process is None:
+            # killed once its graceful timeout was over, and forgotten
+            return
 
-        # if the process is dead or a zombie try to definitely stop it.
-        if process.status in (DEAD_OR_ZOMBIE, UNEXISTING):
-            process.stop()
+        if status is not None:
+            process.set_exit_status(status)
+
+        # make sure the process is gone, and close its pipes once they
+        # are not read anymore
+        self._remove_redirections(process)
+        process.stop()
 
         logger.debug('reaping process %s [%s]' % (pid, self.name))
         self.notify_event("reap", {"process_pid": pid, "time": time.time()})
 
     @util.debuglog
     def reap_processes(self):
-        """Reap all the processes for this watcher.
+        """Reap all the processes for this watcher that exited.
         """
         if self.stopped:
             logger.debug('do not reap processes as the watcher is stopped')
             return
 
-        # reap_process changes our dict, look through the copy of keys
-        for pid in self.processes.keys():
-            self.reap_process(pid)
+        # reap_process changes our dict, look through a copy
+        for pid, process in self.processes.items():
+            if process.poll() is not None:
+                self.reap_process(pid)
 
     @util.debuglog
     def manage_processes(self):
@@ -385,18 +489,29 @@ class Watcher(object):
                                        "time": time.time()})
                     self.kill_process(process)
 
+        # the psutil objects are only kept while the processes are
+        # looked at, by the stats for instance
+        for process in self.processes.itervalues():
+            process.release_psutil()
+
         if self.respawn and len(self.processes) < self.numprocesses:
             self.spawn_processes()
 
+        self._terminate_extra_processes()
+
+    def _terminate_extra_processes(self):
+        # the oldest processes go first
         processes = self.processes.values()
         processes.sort()
-        while len(processes) > self.numprocesses:
+        # the processes replaced by a rolling reload are stopped once the
+        # new ones have settled
+        numprocesses = self.numprocesses + len(self._rolling_batch)
+        while len(processes) > numprocesses:
             process = processes.pop(0)
-            if process.status == DEAD_OR_ZOMBIE:
-                self.processes.pop(process.pid)
+            if process.poll() is not None:
+                self.reap_process(process.pid)
             else:
-                self.processes.pop(process.pid)
-                self.kill_process(process)
+                self.terminate_process(process)
 
     @util.debuglog
     def reap_and_manage_processes(self):
@@ -409,55 +524,206 @@ class Watcher(object):
     @util.debuglog
     def spawn_processes(self):
         """Spawn processes.
+
+        When *warmup_delay* is set, a single process is spawned and the
+        next spawn is scheduled on the loop, so the delay only slows down
+        this watcher.
         """
         # when an on_demand process dies, do not restart it until the next event
         if self.on_demand and not self.arbiter.socket_event:
             self.stopped = True
             return
-        for i in range(self.numprocesses - len(self.processes)):
+
+        if self._spawn_timeout is None:
+            self._spawn_next()
+
+    def _respawn_processes(self, callback=None):
+        """Replace the running processes by new ones, paced like
+        :func:`spawn_processes`, or in batches when *reload_batch_size* is
+        set. *callback* is called once the replacement is under way, or
+        over for a rolling reload."""
+        self._retire_forkserver()
+        if self.reload_batch_size > 0:
+            return self._rolling_reload(callback=callback)
+
+        self._replacements = self.numprocesses
+        if self._spawn_timeout is None:
+            self._spawn_next()
+
+        if callback is not None:
+            callback()
+
+    def _rolling_reload(self, hup=False, callback=None):
+        self._cancel_rolling_reload()
+        self._rolling = {'processes': sorted(self.processes.values()),
+                         'hup': hup, 'callback': callback}
+        self._next_rolling_batch()
+
+    def _next_rolling_batch(self):
+        self._rolling_timeout = None
+        rolling = self._rolling
+
+        # the processes that died meanwhile don't need to be replaced
+        processes = [process for process in rolling['processes']
+                     if process.pid in self.processes]
+        if self.stopped or not processes:
+            return self._end_rolling_reload()
+
+        if (self.preload and not rolling['hup'] and
+                not self._forkserver_ready(self._rolling_template_ready)):
+            # the batch is spawned once the template imported the code
+            return
+
+        batch = processes[:self.reload_batch_size]
+        rolling['processes'] = processes[len(batch):]
+
+        if rolling['hup']:
+            for process in batch:
+                logger.info("SENDING HUP to %s" % process.pid)
+                self.signal_process(process, signal.SIGHUP)
+            rolling['batch'] = batch
+        else:
+            rolling['replaced'] = batch
+            for i in range(len(batch)):
+                process = self.spawn_process()
+                if process is None:
+                    # spawn_process gave up and stopped the watcher
+                    return self._end_rolling_reload()
+                self._rolling_batch.append(process)
+            rolling['batch'] = self._rolling_batch
+
+        self._rolling_timeout = self.loop.add_timeout(
+            time.time() + self.reload_settle_time, self._check_rolling_batch)
+
+    def _rolling_template_ready(self):
+        if self._rolling is not None and self._rolling_timeout is None:
+            self._next_rolling_batch()
+
+    def _check_rolling_batch(self):
+        self._rolling_timeout = None
+        rolling = self._rolling
+
+        dead = [process for process in rolling['batch']
+                if process.pid not in self.processes or
+                process.status == UNEXISTING]
+
+        if dead or not self.call_hook('after_reload_batch'):
+            logger.error('%s: the reload failed, aborting it', self.name)
+            self.notify_event("reload_failed",
+                              {"process_pids": [p.pid for p in dead],
+                               "time": time.time()})
+            if not rolling['hup']:
+                # roll back: the old processes of the batch are kept
+                for process in self._rolling_batch:
+                    if process.pid in self.processes:
+                        self.terminate_process(process)
+            return self._end_rolling_reload()
+
+        if not rolling['hup']:
+            self._rolling_batch = []
+            for process in rolling['replaced']:
+                if process.pid in self.processes:
+                    self.terminate_process(process)
+
+        self._next_rolling_batch()
+
+    def _end_rolling_reload(self):
+        rolling, self._rolling = self._rolling, None
+        self._rolling_batch = []
+        if rolling is not None and rolling['callback'] is not None:
+            rolling['callback']()
+
+    def _cancel_rolling_reload(self):
+        if self._rolling_timeout is not None:
+            self.loop.remove_timeout(self._rolling_timeout)
+            self._rolling_timeout = None
+        self._end_rolling_reload()
+
+    def _need_spawn(self):
+        return (self._replacements > 0 or
+                len(self.processes) < self.numprocesses)
+
+    def _spawn_next(self):
+        self._spawn_timeout = None
+
+        if self.preload and not self.stopped and not self._forkserver_ready():
+            # the spawns go on once the template imported the code
+            return
+
+        while not self.stopped and self._need_spawn():
+            if self._replacements > 0:
+                self._replacements -= 1
             self.spawn_process()
-            time.sleep(self.warmup_delay)
+            if self.warmup_delay > 0:
+                break
+
+        if self.stopped:
+            self._replacements = 0
+            return
+
+        self._terminate_extra_processes()
+
+        if self._need_spawn():
+            self._spawn_timeout = self.loop.add_timeout(
+                time.time() + self.warmup_delay, self._spawn_next)
+        elif self._start_pending:
+            self._start_pending = False
+            self._started()
 
     def _get_sockets_fds(self):
-        # XXX should be cached
         if self.sockets is None:
             return {}
-        fds = {}
-        for name, sock in self.sockets.items():
-            fds[name] = sock.fileno()
-        return fds
+        if self._sockets_fds is None:
+            self._sockets_fds = dict((name, sock.fileno())
+                                     for name, sock in self.sockets.items())
+        return self._sockets_fds
+
+    def _get_spawn_spec(self):
+        if self._spawn_spec is None:
+            self._spawn_spec = SpawnSpec(self.cmd, args=self.args,
+                                         working_dir=self.working_dir,
+                                         shell=self.shell, uid=self.uid,
+                                         gid=self.gid, env=self.env,
+                                         rlimits=self.rlimits,
+                                         executable=self.executable,
+                                         use_fds=self.use_sockets,
+                                         watcher=self)
+        return self._spawn_spec
+
+    def _reset_spawn_spec(self):
+        """Drop the spawn spec, after a change of the options or of the
+        sockets the command line may use."""
+        self._spawn_spec = None
+        self._sockets_fds = None
 
     def spawn_process(self):
         """Spawn process.
+
+        Returns the new process, or None if it could not be spawned.
         """
         if self.stopped:
             return
 
-        cmd = util.replace_gnu_args(self.cmd, sockets=self._get_sockets_fds())
+        spec = self._get_spawn_spec()
         self._process_counter += 1
         nb_tries = 0
         while nb_tries < self.max_retry or self.max_retry == -1:
             process = None
             try:
-                process = Process(self._process_counter, cmd,
-                                  args=self.args, working_dir=self.working_dir,
-                                  shell=self.shell, uid=self.uid, gid=self.gid,
-                                  env=self.env, rlimits=self.rlimits,
-                                  executable=self.executable,
-                                  use_fds=self.use_sockets, watcher=self)
-
-                # stream stderr/stdout if configured
-                if self.stdout_redirector is not None:
-                    self.stdout_redirector.add_redirection('stdout',
-                                                           process,
-                                                           process.stdout)
-
-                if self.stderr_redirector is not None:
-                    self.stderr_redirector.add_redirection('stderr',
-                                                           process,
-                                                           process.stderr)
-
-                self.processes[process.pid] = process
+                if self.preload:
+                    process = ForkedProcess(self._process_counter, spec.cmd,
+                                            self._get_forkserver(),
+                                            spec=spec)
+                else:
+                    spawner = None
+                    if self.arbiter is not None:
+                        spawner = self.arbiter.spawner
+
+                    process = Process(self._process_counter, spec.cmd,
+                                      spawner=spawner, spec=spec)
+                    self._add_redirections(process)
+
+                self._add_process(process)
                 logger.debug('running %s process [pid %d]', self.name,
                              process.pid)
             except OSError, e:
@@ -469,31 +735,135 @@ class Watcher(object):
             else:
                 self.notify_event("spawn", {"process_pid": process.pid,
                                             "time": time.time()})
-                time.sleep(self.warmup_delay)
-                return
+                return process
 
         self.stop()
 
-    def kill_process(self, process, sig=signal.SIGTERM):
-        """Kill process.
-        """
-        # remove redirections
+    def _add_redirections(self, process):
+        # stream stderr/stdout if configured
+        if self.stdout_redirector is not None:
+            self.stdout_redirector.add_redirection('stdout', process,
+                                                   process.stdout)
+
+        if self.stderr_redirector is not None:
+            self.stderr_redirector.add_redirection('stderr', process,
+                                                   process.stderr)
+
+    def _remove_redirections(self, process):
         if self.stdout_redirector is not None:
             self.stdout_redirector.remove_redirection('stdout', process)
 
         if self.stderr_redirector is not None:
             self.stderr_redirector.remove_redirection('stderr', process)
 
+    def _pipe_detached(self, name, process, reason):
+        self.notify_event("detach", {"process_pid": process.pid,
+                                     "name": name, "reason": reason,
+                                     "time": time.time()})
+
+    def _get_forkserver(self):
+        """Return the fork server of a preload watcher, starting its
+        template process if needed."""
+        if self._forkservers and not self._forkservers[-1].retired:
+            return self._forkservers[-1]
+
+        modules = self.preload
+        if isinstance(modules, string_types):
+            modules = modules.replace(',', ' ').split()
+
+        forkserver = ForkServer(list(modules), self._forked_process_exited,
+                                self._forkserver_closed,
+                                working_dir=self.working_dir, uid=self.uid,
+                                gid=self.gid, env=self.env,
+                                rlimits=self.rlimits,
+                                use_fds=self.use_sockets,
+                                timeout=self.preload_timeout, loop=self.loop,
+                                watcher=self)
+        self._add_redirections(forkserver.process)
+        self._forkservers.append(forkserver)
+        logger.debug('%s: template process started [pid %d]', self.name,
+                     forkserver.pid)
+        return forkserver
+
+    def _forkserver_ready(self, callback=None):
+        """Return True if the template imported the code. Otherwise, the
+        spawns go on once it's done, and *callback* is called."""
+        try:
+            forkserver = self._get_forkserver()
+        except OSError:
+            # spawn_process reports the error
+            return True
+
+        if forkserver.ready:
+            return True
+        forkserver.when_ready(self._template_ready)
+        if callback is not None:
+            forkserver.when_ready(callback)
+        return False
+
+    def _template_ready(self):
+        self._template_failures = 0
+        if not self.stopped and self._spawn_timeout is None:
+            self._spawn_next()
+
+    def _retire_forkserver(self):
+        # the next processes are forked from a new template, which
+        # imports the code again
+        if self._forkservers:
+            self._forkservers[-1].retire()
+
+    def _forked_process_exited(self, pid, status):
+        if pid in self.processes or pid in self._stopping:
+            self.reap_process(pid, status)
+            self.manage_processes()
+
+    def _forkserver_closed(self, forkserver):
+        self._remove_redirections(forkserver.process)
+        self._forkservers.remove(forkserver)
+        if forkserver.retired or self.stopped:
+            return
+
+        if not forkserver.ready:
+            # the template failed to import the code
+            self._template_failures += 1
+            if (self.max_retry != -1 and
+                    self._template_failures >= self.max_retry):
+                logger.error('%s: the template process failed %d times, '
+                             'stopping', self.name, self._template_failures)
+                self._template_failures = 0
+                self.stop()
+                return
+
+        # nobody reports the exits of the processes of a lost template:
+        # they are replaced by processes forked from a new one
+        forkserver.retired = True
+        for process in self.processes.values():
+            if process.pid in forkserver.workers:
+                self.terminate_process(process)
+        self.manage_processes()
+
+    def kill_process(self, process, sig=signal.SIGTERM):
+        """Kill process.
+        """
+        self._remove_redirections(process)
+
         logger.debug("%s: kill process %s", self.name, process.pid)
         try:
-            # sending the same signal to all the children
-            for child_pid in process.children():
-                process.send_signal_child(child_pid, sig)
-                self.notify_event("kill", {"process_pid": child_pid,
-                                  "time": time.time()})
-
-            # now sending the signal to the process itself
-            self.send_signal(process.pid, sig)
+            if not self.use_killpg:
+                # sending the same signal to all the children
+                for child_pid in process.children():
+                    try:
+                        process.send_signal_child(child_pid, sig)
+                    except OSError as e:
+                        if e.errno != errno.ESRCH:
+                            raise
+                        continue
+                    self.notify_event("kill", {"process_pid": child_pid,
+                                      "time": time.time()})
+
+            # now sending the signal to the process itself, or to its
+            # whole group
+            self.signal_process(process, sig)
             self.notify_event("kill", {"process_pid": process.pid,
                                        "time": time.time()})
 
@@ -503,6 +873,87 @@ class Watcher(object):
 
         process.stop()
 
+    def signal_process(self, process, sig):
+        """Send *sig* to the process, or to its process group when
+        *use_killpg* is set."""
+        if self.use_killpg:
+            process.send_signal_group(sig)
+        else:
+            process.send_signal(sig)
+
+    def terminate_process(self, process):
+        """Ask a process to stop.
+
+        The process is sent a SIGTERM and gets a SIGKILL if it's still
+        running after *graceful_timeout* seconds.
+        """
+        self._terminate_process(process)
+        self._start_stop_checker()
+
+    def _terminate_process(self, process):
+        # the process stays registered to the arbiter until it's reaped
+        self.processes.pop(process.pid, None)
+        deadline = time.time() + self.graceful_timeout
+        self._stopping[process.pid] = process, deadline, False
+
+        try:
+            self.kill_process(process, signal.SIGTERM)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _start_stop_checker(self):
+        if self._stop_checker is not None:
+            return
+
+        if not self.loop.running():
+            # nobody will run the checks for us, block until it's done
+            while self._stopping or self._stop_pending:
+                self._check_stopping()
+                time.sleep(self.stop_check_delay)
+            return
+
+        self._stop_checker = ioloop.PeriodicCallback(
+            self._check_stopping, self.stop_check_delay * 1000, self.loop)
+        self._stop_checker.start()
+        # the first check is done right away
+        self.loop.add_callback(self._check_stopping)
+
+    def _check_stopping(self):
+        now = time.time()
+        for pid, (process, deadline, killed) in self._stopping.items():
+            if process.poll() is not None:
+                self.reap_process(pid)
+            elif deadline > now:
+                continue
+            elif not killed:
+                logger.debug('%s: process %s did not stop in time, '
+                             'killing it', self.name, pid)
+                # the stop is over once the process is gone, so its
+                # sockets are released
+                self._stopping[pid] = (process, now + self.kill_grace_period,
+                                       True)
+                try:
+                    self.kill_process(process, signal.SIGKILL)
+                except OSError as e:
+                    if e.errno != errno.ESRCH:
+                        raise
+            else:
+                logger.warning('%s: process %s is still running after a '
+                               'SIGKILL, forgetting it', self.name, pid)
+                del self._stopping[pid]
+
+        if self._stopping:
+            return
+
+        if self._stop_checker is not None:
+            self._stop_checker.stop()
+            self._stop_checker = None
+
+        if self._stop_pending:
+            self._stop_pending = False
+            self._stopped()
+
     @util.debuglog
     def kill_processes(self, sig):
         """Kill all the processes of this watcher.
@@ -549,6 +1000,18 @@ class Watcher(object):
         process = self.processes[int(pid)]
         process.send_signal_children(signum)
 
+    @util.debuglog
+    def send_signal_recursive(self, pid, signum):
+        """Send signal to the process and all its children: to its process
+        group when *use_killpg* is set.
+        """
+        process = self.processes[int(pid)]
+        if self.use_killpg:
+            process.send_signal_group(signum)
+        else:
+            process.send_signal(signum)
+            process.send_signal_children(signum)
+
     @util.debuglog
     def status(self):
         if self.stopped:
@@ -566,9 +1029,21 @@ class Watcher(object):
                      for proc in self.processes.values()])
 
     @util.debuglog
-    def stop(self):
+    def stop(self, callback=None):
         """Stop.
+
+        Every process is sent a SIGTERM, and the ones that are still
+        running after *graceful_timeout* seconds get a SIGKILL. This is
+        done on the loop so this method returns right away, *callback* is
+        called once all the processes are gone.
         """
+        if callback is not None:
+            self._stop_callbacks.append(callback)
+
+        if self._stop_pending and not self.processes:
+            # we're already waiting for the processes to go away
+            return
+
         logger.debug('stopping the %s watcher' % self.name)
         # stop redirectors
         if self.stdout_redirector is not None:
@@ -577,33 +1052,50 @@ class Watcher(object):
         if self.stderr_redirector is not None:
             self.stderr_redirector.kill()
 
-        limit = time.time() + self.graceful_timeout
-
         logger.debug('gracefully stopping processes [%s] for %ss' % (
                      self.name, self.graceful_timeout))
 
         # We ignore the hook result
         self.call_hook('before_stop')
 
-        while self.get_active_processes() and time.time() < limit:
-            self.kill_processes(signal.SIGTERM)
-            self.reap_processes()
+        self.stopped = True
+        self._stop_pending = True
+        self._start_pending = False
+
+        # cancel the pending spawns
+        if self._spawn_timeout is not None:
+            self.loop.remove_timeout(self._spawn_timeout)
+            self._spawn_timeout = None
+        self._replacements = 0
+        self._cancel_rolling_reload()
+
+        for process in self.processes.values():
+            self._terminate_process(process)
+
+        self._start_stop_checker()
 
-        self.kill_processes(signal.SIGKILL)
+    def _stopped(self):
+        for forkserver in list(self._forkservers):
+            forkserver.close()
 
         if self.evpub_socket is not None:
             self.notify_event("stop", {"time": time.time()})
 
-        self.stopped = True
-
         # We ignore the hook result
         self.call_hook('after_stop')
         logger.info('%s stopped', self.name)
 
+        callbacks, self._stop_callbacks = self._stop_callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception('Stop callback %r failed' % callback)
+
     def get_active_processes(self):
         """return a list of pids of active processes (not already stopped)"""
         return [p for p in self.processes.values()
-                if p.status not in (DEAD_OR_ZOMBIE, UNEXISTING)]
+                if p.status != UNEXISTING]
 
     @property
     def pids(self):
@@ -635,10 +1127,21 @@ class Watcher(object):
     @util.debuglog
     def start(self):
         """Start.
+
+        When the watcher is still stopping, it's started once its
+        processes are gone. When *warmup_delay* paces the spawns, the
+        *after_start* hook is called and the "start" event published once
+        the last process is spawned.
         """
         if not self.stopped:
             return
 
+        if self._stop_pending:
+            # the stop is seen through, then the watcher starts over
+            if self.start not in self._stop_callbacks:
+                self._stop_callbacks.append(self.start)
+            return True
+
         if self.on_demand and not self.arbiter.socket_event:
             return
 
@@ -653,52 +1156,78 @@ class Watcher(object):
         self.reap_processes()
         self.spawn_processes()
 
-        if not self.call_hook('after_start'):
-            logger.debug('Aborting startup')
-            self.stop()
-            return False
+        if not self.stopped and self._need_spawn():
+            # the processes left are spawned on the loop
+            self._start_pending = True
+            self._start_redirectors()
+            return True
+
+        return self._started()
 
+    def _start_redirectors(self):
         if self.stdout_redirector is not None:
             self.stdout_redirector.start()
 
         if self.stderr_redirector is not None:
             self.stderr_redirector.start()
 
+    def _started(self):
+        if not self.call_hook('after_start'):
+            logger.debug('Aborting startup')
+            self.stop()
+            return False
+
+        self._start_redirectors()
         logger.info('%s started' % self.name)
         self.notify_event("start", {"time": time.time()})
         return True
 
     @util.debuglog
-    def restart(self):
+    def restart(self, callback=None):
         """Restart.
+
+        The processes are started once the old ones are stopped, then
+        *callback* is called.
         """
         self.notify_event("restart", {"time": time.time()})
-        self.stop()
-        if self.start():
-            logger.info('%s restarted', self.name)
-        else:
-            logger.info('Failed to restart %s', self.name)
+
+        def _start():
+            if self.start():
+                logger.info('%s restarted', self.name)
+            else:
+                logger.info('Failed to restart %s', self.name)
+
+            if callback is not None:
+                callback()
+
+        self.stop(callback=_start)
 
     @util.debuglog
-    def reload(self, graceful=True):
+    def reload(self, graceful=True, callback=None):
         """ reload
+
+        *callback* is called once the reload is under way: the new
+        processes may still be spawning when *warmup_delay* is set.
         """
         if self.prereload_fn is not None:
             self.prereload_fn(self)
 
         if not graceful:
-            return self.restart()
+            return self.restart(callback=callback)
 
-        if self.send_hup:
+        self.notify_event("reload", {"time": time.time()})
+        logger.info('%s reloaded', self.name)
+
+        if self.send_hup and self.reload_batch_size > 0:
+            self._rolling_reload(hup=True, callback=callback)
+        elif self.send_hup:
             for process in self.processes.values():
                 logger.info("SENDING HUP to %s" % process.pid)
-                process.send_signal(signal.SIGHUP)
+                self.signal_process(process, signal.SIGHUP)
+            if callback is not None:
+                callback()
         else:
-            for i in range(self.numprocesses):
-                self.spawn_process()
-            self.manage_processes()
-        self.notify_event("reload", {"time": time.time()})
-        logger.info('%s reloaded', self.name)
+            self._respawn_processes(callback=callback)
 
     def set_numprocesses(self, np):
         if self.singleton and np != 1:
@@ -707,6 +1236,7 @@ class Watcher(object):
             np = 0
 
         self.numprocesses = np
+        self._reset_spawn_spec()
         self.manage_processes()
 
         return self.numprocesses
@@ -770,6 +1300,24 @@ class Watcher(object):
         elif key == "max_age_variance":
             self.max_age_variance = int(val)
             action = 1
+        elif key == "reload_batch_size":
+            self.reload_batch_size = int(val)
+        elif key == "reload_settle_time":
+            self.reload_settle_time = float(val)
+        elif key == "preload":
+            self.preload = val
+            action = 1
+        elif key == "preload_timeout":
+            self.preload_timeout = float(val)
+        elif key == "use_killpg":
+            self.use_killpg = val
+        elif key == "orphan_policy":
+            if val not in ('reap', 'kill'):
+                raise ValueError("Unknown orphan policy %r" % val)
+            self.orphan_policy = val
+
+        # the command line may use any option
+        self._reset_spawn_spec()
 
         # send update event
         self.notify_event("updated", {"time": time.time()})
@@ -779,9 +1327,7 @@ class Watcher(object):
         # trigger needed action
         self.stopped = False
         if num == 1:
-            for i in range(self.numprocesses):
-                self.spawn_process()
-            self.manage_processes()
+            self._respawn_processes()
         else:
             self.reap_and_manage_processes()
 